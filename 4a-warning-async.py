@@ -1,98 +1,100 @@
 # server cannot request computer deployed 移动办公, but can reversely connect.
 # Hence we need to keep asking server to fetch messages
 from typing import *
+import os
 import asyncio
-import shortuuid
 import time
 import tempfile
 from pathlib import Path
-from aiofiles import open as aopen
-import base64
 import traceback
-import aiohttp
+
+from dotenv import load_dotenv
 
 from schemas import SendMessage
 from chatbots import CmccChatClient
-from logg import logger
+from logg import logger, WORK_DIR
+from attachment_store import AttachmentStore
+from oa_client import OAClient, UIActor, Backoff
+from business_mux import BusinessMux, parse_weights
 
-chatbot_client = CmccChatClient(cache_session_map=False)
-message_queue = asyncio.Queue()
-message_semaphore = asyncio.Semaphore(1) # UI操作是不可抢占的
-consumer_tasks:List[asyncio.Task] = []
-temp_dir=tempfile.TemporaryDirectory(prefix="中移移动办公UI机器人",delete=False)
+load_dotenv(dotenv_path=WORK_DIR / ".env")
+SERVER_API=os.getenv("SERVER_API","http://10.248.230.35:12030")
+OA_PROTOCOL=os.getenv("OA_PROTOCOL", "poll")
+OA_BUFFER_SIZE=int(os.getenv("OA_BUFFER_SIZE", 1))
+OA_BACKOFF_BASE=float(os.getenv("OA_BACKOFF_BASE", 0.5))
+OA_BACKOFF_CAP=float(os.getenv("OA_BACKOFF_CAP", 30))
+OA_MAX_RETRIES=int(os.getenv("OA_MAX_RETRIES", 10))
+OA_MIN_CREDIT=int(os.getenv("OA_MIN_CREDIT", 1))
+OA_MAX_CREDIT=int(os.getenv("OA_MAX_CREDIT", 16))
+OA_BUSINESS_WEIGHTS=parse_weights(os.getenv("OA_BUSINESS_WEIGHTS", ""))
+OA_PREFETCH_PER_BUSINESS=int(os.getenv("OA_PREFETCH_PER_BUSINESS", 2))
+OA_REPORT_INTERVAL=float(os.getenv("OA_REPORT_INTERVAL", 60))
 
-def b64decode(string:str):
-    string = string.removeprefix("data:")
-    mime_type, file_bytes = string.split(";base64,",1)
-    decoded = base64.b64decode(file_bytes)
-    return decoded, mime_type
+chatbot_client = CmccChatClient(cache_session_map=False)
+# 使用mkdtemp替代TemporaryDirectory(delete=False)，python 3.12 以下不支持参数 `delete`
+temp_dir_path = tempfile.mkdtemp(prefix="中移移动办公UI机器人")
+attachment_store = AttachmentStore(Path(temp_dir_path))
 
-async def async_wrapper(callable:Callable,*args,**kwargs):
-    result = await asyncio.to_thread(callable, *args, **kwargs)
-    return result
+def execute_send_message(message:SendMessage)->bool:
+    "UI handler of `UIActor`, runs in its worker thread"
+    try:
+        if message.Content:
+            at_list = []
+            if message.SenderWxid:
+                at_list.append(message.SenderWxid)
+            chatbot_client.send_message(
+                session_name=message.FromWxid,
+                message=message.Content,
+                from_clipboard=True,
+                at_list=at_list
+            )
+        if message.File:
+            with attachment_store.checkout_b64(message.File, message.Filename) as temp_filepath:
+                chatbot_client.send_file(
+                    session_name=message.FromWxid,
+                    filepath=temp_filepath
+                )
+    except Exception as exc:
+        logger.error(f"[ERROR EXECUTING SENDING MSG] {exc}")
+        logger.error(traceback.format_exc())
+        return False
+    finally:
+        #XXX necessary to sleep a bit(0.5s checked in concurrent mode)
+        time.sleep(0.5)
+    return True
 
-async def execute_send_message():
-    "consumer function"
-    while True:
-        message:SendMessage = await message_queue.get()
-        async with message_semaphore:
-            try:
-                if message.Content:
-                    at_list = []
-                    if message.SenderWxid:
-                        at_list.append(message.SenderWxid)
-                    await async_wrapper(
-                        chatbot_client.send_message,
-                        session_name=message.FromWxid,
-                        message=message.Content,
-                        from_clipboard=True,
-                        at_list=at_list
-                    )
-                if message.File:
-                    filename = message.Filename or shortuuid.uuid()
-                    b64decoded_bytes,mime_type = b64decode(message.File)
-                    temp_filepath=Path(temp_dir.name).joinpath(filename)
-                    async with aopen(str(temp_filepath),"wb") as f:
-                        await f.write(b64decoded_bytes)
-                    temp_send_result=await async_wrapper(
-                                                chatbot_client.send_file,
-                                                session_name=message.FromWxid,
-                                                filepath=temp_filepath.absolute()
-                                            )
-            except Exception as exc:
-                await async_wrapper(logger.error, f"[ERROR EXECUTING SENDING MSG] {exc}")
-                await async_wrapper(logger.error, traceback.format_exc())
-            finally:
-                #XXX delete temp file
-                #XXX necessary to sleep a bit(0.5s checked in concurrent mode)
-                await asyncio.sleep(0.5)
-                #XXX mark task done
-                message_queue.task_done()
+def new_client()->OAClient:
+    return OAClient(
+        SERVER_API, protocol=OA_PROTOCOL,
+        backoff=Backoff(base=OA_BACKOFF_BASE, cap=OA_BACKOFF_CAP), max_retries=OA_MAX_RETRIES,
+        min_credit=OA_MIN_CREDIT, max_credit=OA_MAX_CREDIT)
 
-async def main_oa_server(business:str):
+async def main_oa_server(businesses:List[str]):
     """
-    4a-warning main function. Keep asking && receiving messages from server
+    4a-warning main function. Keep asking && receiving messages of the businesses from server,
+    sending them through the one desktop client by turns, weighted by `OA_BUSINESS_WEIGHTS`
     """
-    global message_queue
-    task=asyncio.create_task(execute_send_message())
-    async with aiohttp.ClientSession(base_url="http://10.248.230.35:12030/",timeout=aiohttp.ClientTimeout(10.0)) as session:
-        while True:
-            if message_queue.empty():
-                async with session.post(url="get-messages",json={"business":business},) as resp:
-                    msg = await resp.json()
-                    if "msg" in msg.keys():
-                        await async_wrapper(logger.info, msg['msg'])
-                        await async_wrapper(logger.info, "消息发送完毕。退出程序")
-                        break
-                    msg=SendMessage(**msg)
-                    await async_wrapper(
-                        logger.info,
-                        f"message received:\nsend to {msg.FromWxid}\nbrief content :{msg.Content[:50]}"
-                    )
-                    await message_queue.put(msg)
-            else:
-                await asyncio.sleep(0.1)  # 避免空转
-    await task
+    weights = {business: OA_BUSINESS_WEIGHTS.get(business, 1.0) for business in businesses}
+    async with new_client() as client:
+        mux:BusinessMux = None
+        def on_result(message:SendMessage, succeeded:bool):
+            mux.on_result(message, succeeded)
+            if succeeded:
+                client.ack_soon(str(message.id))
+        #NOTE the actor is the only consumer. It holds `OA_BUFFER_SIZE` messages at most,
+        # so fetching waits on it instead of busy polling
+        async with UIActor(execute_send_message, buffer_size=OA_BUFFER_SIZE, on_result=on_result) as actor:
+            mux = BusinessMux(
+                client, actor, weights,
+                prefetch=OA_PREFETCH_PER_BUSINESS, report_interval=OA_REPORT_INTERVAL)
+            await mux.run()
+        logger.info("消息发送完毕。退出程序")
+        mux.log_report()
+        logger.debug(f"[4a client] {client.stats()} [ui actor] {actor.stats()}")
+
+async def get_businesses_available()->List[str]:
+    async with new_client() as client:
+        return await client.businesses()
 
 
 if __name__ == '__main__':
@@ -107,10 +109,12 @@ if __name__ == '__main__':
     #     help="选择要执行的业务类型"
     # )
     # args = parser.parse_args()
-    # asyncio.run(main_oa_server(args.business))
+    # asyncio.run(main_oa_server([args.business]))
     try:
-        business = input("请输入您想处理的业务（可选：['信控停机预警','低质专线预警','代付欠费超逾期缴费预警']）：")
-        asyncio.run(main_oa_server(business))
+        available_services = asyncio.run(get_businesses_available())
+        answer = input(f"请输入您想处理的业务，多个业务用逗号分隔（可选：{available_services}）：")
+        businesses = [business.strip() for business in answer.replace("，", ",").split(",") if business.strip()]
+        asyncio.run(main_oa_server(businesses))
     except Exception as e:
         print(f"程序出错: {e}")
         traceback.print_exc()
@@ -119,4 +123,3 @@ if __name__ == '__main__':
     finally:
         time.sleep(1.0)
         input("按Enter键退出...")
-
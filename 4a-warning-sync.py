@@ -3,15 +3,12 @@
 import os
 import json
 import asyncio
-import base64
 import traceback
 import tempfile
 from typing import *
 from pathlib import Path
 
 import requests
-import shortuuid
-import pandas as pd
 from requests.adapters import HTTPAdapter, Retry
 from datetime import datetime
 from pytz import timezone
@@ -21,11 +18,37 @@ from schemas import SendMessage
 from chatbots import CmccChatClient
 from logg import logger, LOGGER_DIR, WORK_DIR
 from tools import send_stable
+from attachment_store import AttachmentStore
+from attachment_prefetch import AttachmentPrefetcher
+from recipient_grouper import RecipientGrouper, recipient_of
+from delivery_verifier import DeliveryVerifier, PendingSend
+from sse_reader import SSEReader
+from ack_outbox import AckOutbox
+from run_checkpoint import RunCheckpoint
+from run_report import RunReportWriter
 
 load_dotenv(dotenv_path=WORK_DIR / ".env")
 WAIT_BEFORE_REFRESH=os.getenv("WAIT_BEFORE_REFRESH",5)
 WAIT_BEFORE_REFRESH=float(WAIT_BEFORE_REFRESH)
+ATTACHMENT_CACHE_MB=float(os.getenv("ATTACHMENT_CACHE_MB", 512))
+ATTACHMENT_LOOKAHEAD=int(os.getenv("ATTACHMENT_LOOKAHEAD", 4))
+ATTACHMENT_PREFETCH_MB=float(os.getenv("ATTACHMENT_PREFETCH_MB", 128))
+ATTACHMENT_PREFETCH_WORKERS=int(os.getenv("ATTACHMENT_PREFETCH_WORKERS", 2))
+RECIPIENT_LOOKAHEAD=int(os.getenv("RECIPIENT_LOOKAHEAD", 16))
+RECIPIENT_MAX_RUN=int(os.getenv("RECIPIENT_MAX_RUN", 0))
+DELIVERY_MODE=os.getenv("DELIVERY_MODE", "confirm")
+VERIFY_BATCH_SESSIONS=int(os.getenv("VERIFY_BATCH_SESSIONS", 20))
+VERIFY_MAX_DELAY=float(os.getenv("VERIFY_MAX_DELAY", 60))
+VERIFY_MAX_CHECKS=int(os.getenv("VERIFY_MAX_CHECKS", 3))
 SERVER_API=os.getenv("SERVER_API","http://10.248.230.35:12030")
+SSE_BUFFER_SIZE=int(os.getenv("SSE_BUFFER_SIZE", 32))
+SSE_MAX_RECONNECTS=int(os.getenv("SSE_MAX_RECONNECTS", 10))
+ACK_OUTBOX_PATH=os.getenv("ACK_OUTBOX_PATH", str(WORK_DIR / "ack_outbox.jsonl"))
+ACK_BATCH_SIZE=int(os.getenv("ACK_BATCH_SIZE", 50))
+ACK_REPLAY_TIMEOUT=float(os.getenv("ACK_REPLAY_TIMEOUT", 30))
+CHECKPOINT_PATH=os.getenv("CHECKPOINT_PATH", str(WORK_DIR / "checkpoint.db"))
+REPORT_DIR=os.getenv("REPORT_DIR", str(LOGGER_DIR / "reports"))
+REPORT_FORMAT=os.getenv("REPORT_FORMAT", "xlsx")
 print("[config] WAIT_BEFORE_REFRESH: ",WAIT_BEFORE_REFRESH)
 print("[config] SERVER_API: ",SERVER_API)
 
@@ -41,34 +64,74 @@ consumer_tasks:List[asyncio.Task] = []
 # temp_dir=tempfile.TemporaryDirectory(prefix="中移移动办公UI机器人") #XXX delete=False  python 3.10 does not support parameter `delete`
 # 使用mkdtemp替代TemporaryDirectory，确保程序退出后文件不被清理
 temp_dir_path = tempfile.mkdtemp(prefix="中移移动办公UI机器人")
+# 相同内容的附件只落盘一次，所有接收人复用同一路径
+attachment_store = AttachmentStore(Path(temp_dir_path), max_bytes=int(ATTACHMENT_CACHE_MB*1024*1024))
+# 后台线程池提前解码、落盘后续消息的附件，UI发送时文件已就绪
+attachment_prefetcher = AttachmentPrefetcher(
+    attachment_store, lookahead=ATTACHMENT_LOOKAHEAD,
+    max_bytes=int(ATTACHMENT_PREFETCH_MB*1024*1024), workers=ATTACHMENT_PREFETCH_WORKERS)
+# 发送成功的消息先写入本地发件箱，由后台线程批量回报服务器，程序崩溃后重启时补发
+ack_outbox = AckOutbox(ACK_OUTBOX_PATH, request_client, f"{SERVER_API}/update-msg-status", batch_size=ACK_BATCH_SIZE)
+# burst模式下消息发送后不等待确认，攒够一批会话后逐个会话读取一次历史消息确认，只重发显示失败的消息
+delivery_verifier = DeliveryVerifier(
+    chatbot_client, batch_sessions=VERIFY_BATCH_SESSIONS, max_delay=VERIFY_MAX_DELAY,
+    min_age=WAIT_BEFORE_REFRESH, max_checks=VERIFY_MAX_CHECKS)
+# 记录每个业务本轮已发送/失败的消息，程序重启后跳过已发送的消息
+checkpoint = RunCheckpoint(CHECKPOINT_PATH)
 log_filepath = LOGGER_DIR.joinpath("log_df.jsonl")
 log_filepath.touch()
-log_file_cursor=log_filepath.open("a+",encoding='utf8')
+log_file_cursor=log_filepath.open("a",encoding='utf8')
+run_report:RunReportWriter = None
+"report of the current run, written row by row. Replaces exporting the whole `log_df.jsonl` at the end"
+last_recipient = None
+"recipient the last message was sent to. Its session is still open, the next message to it doesn't switch again"
 
-def b64decode(string:str):
-    string = string.removeprefix("data:")
-    mime_type, file_bytes = string.split(";base64,",1)
-    decoded = base64.b64decode(file_bytes)
-    return decoded, mime_type
+def write_log_entry(log_entry:dict):
+    log_file_cursor.write(json.dumps(log_entry,ensure_ascii=False)+"\n")
+    log_file_cursor.flush()
+    if run_report:
+        run_report.write(log_entry)
 
 
-def concat_jsonl_to_excel():
-    log_df_path = LOGGER_DIR / "log_df.xlsx"
-    logger.debug(f"正在导出excel日志记录至: {log_df_path}")
-    log_file_cursor.seek(0)
-    lines=log_file_cursor.readlines()
-    data = [json.loads(line) for line in lines]
-    log_df = pd.DataFrame(data=data)
-    log_df.to_excel(log_df_path)
-    logger.debug(f"成功导出excel日志记录")
+def log_send_result(message:SendMessage, failure:Optional[str]=None):
+    log_entry = {
+        "发送时间": datetime.now(tz=timezone("Asia/Shanghai")).isoformat(timespec="seconds"),
+        "角色":message.Role,
+        "姓名":message.ActualName,
+        "联系电话":message.FromWxid,
+        "发送结果":"失败" if failure else "成功",
+        "报错原因（若报错）":failure
+    }
+    write_log_entry(log_entry)
+
+
+def in_burst(message:SendMessage)->bool:
+    "whether the message is sent without waiting for confirmation. Only one-to-one messages are, @ in groups are confirmed"
+    return DELIVERY_MODE=="burst" and not message.SenderWxid
 
 
 def execute_send_message(message:SendMessage):
-    "consumer function"
+    """
+    consumer function.
+    In burst, the message is sent without waiting for confirmation && its parts are recorded
+    to `delivery_verifier`, its result is logged once verified
+    """
+    global last_recipient
+    recipient = recipient_of(message)
+    burst = in_burst(message)
+    sent:List[Tuple[str, str]] = []
+    "parts sent in burst, as (kind, content)"
+    #NOTE cleared till this one is sent, a failure may leave another session open
+    previous_recipient, last_recipient = last_recipient, None
     try:
-        logger.debug(f"切换到目标会话: {message.ActualName}:{message.FromWxid}")
-        chatbot_client.switch_session(message.FromWxid,
-                                      top_bar_name=message.ActualName, retries=2, ignore_error=False)
+        if recipient != previous_recipient:
+            logger.debug(f"切换到目标会话: {message.ActualName}:{message.FromWxid}")
+            chatbot_client.switch_session(message.FromWxid,
+                                          top_bar_name=message.ActualName, retries=2, ignore_error=False)
+        #NOTE the session is open from here on: sends only check the topbar, && switch again if it differs
+        if burst and not delivery_verifier.knows(message.FromWxid):
+            #NOTE sends are confirmed by history entries after this read only. Verification passes keep it up to date
+            delivery_verifier.watch(message.FromWxid, chatbot_client.get_session_history_msgs(only_last_msg=False))
         # log_error(search_exc, f"搜索联系人失败: {message.FromWxid}")
             
         if message.Content:
@@ -76,118 +139,216 @@ def execute_send_message(message:SendMessage):
             at_list = []
             if message.SenderWxid:
                 at_list.append(message.SenderWxid)
-            send_stable(
-                chatbot_client,
-                chatbot_client.send_message,
+            send_kwargs = dict(
                 session_name=message.FromWxid,
                 message=message.Content,
                 from_clipboard=True,
                 at_list=at_list,
                 top_bar_name=message.ActualName,
-                retries=2,ignore_error=False
+                retries=2,ignore_error=False,
+                assume_current=True
             )
+            if burst:
+                chatbot_client.send_message(**send_kwargs)
+                sent.append(("text", message.Content))
+            else:
+                send_stable(chatbot_client, chatbot_client.send_message, **send_kwargs)
             
         if message.File:
             logger.debug(f"处理文件消息，文件名: {message.Filename}")
-            filename = message.Filename or shortuuid.uuid()
-            b64decoded_bytes,mime_type = b64decode(message.File)
-            # 修改为使用我们新创建的临时目录路径
-            temp_filepath=Path(temp_dir_path).joinpath(filename)
-            with temp_filepath.open('wb') as temp_f:
-                temp_f.write(b64decoded_bytes)
-
-            send_stable(
-                chatbot_client,
-                chatbot_client.send_file,
-                message=message,
-                session_name=message.FromWxid,
-                filepath=temp_filepath.absolute(),
-                top_bar_name=message.ActualName,
-                retries=2,ignore_error=False
-            )
-            logger.debug(f"文件消息发送成功 - 文件: {filename}")
+            with attachment_prefetcher.checkout(message) as temp_filepath:
+                send_kwargs = dict(
+                    message=message,
+                    session_name=message.FromWxid,
+                    filepath=temp_filepath,
+                    top_bar_name=message.ActualName,
+                    retries=2,ignore_error=False,
+                    assume_current=True
+                )
+                if burst:
+                    chatbot_client.send_file(**send_kwargs)
+                    sent.append(("file", temp_filepath.name))
+                else:
+                    send_stable(chatbot_client, chatbot_client.send_file, **send_kwargs)
+            logger.debug(f"文件消息发送成功 - 文件: {temp_filepath.name}")
     except Exception as exc:
         # logger.error(f"[ERROR EXECUTING SENDING MSG] {exc}")
         msg=f"消息发送失败 - 接收人: {message.ActualName}:{message.FromWxid}\n报错信息：{str(exc)}"
         logger.error(msg)
         trace = traceback.format_exc()
         logger.debug(trace)
-        log_entry = {
-            "发送时间": datetime.now(tz=timezone("Asia/Shanghai")).isoformat(timespec="seconds"),
-            "角色":message.Role,
-            "姓名":message.ActualName,
-            "联系电话":message.FromWxid,
-            "发送结果":"失败",
-            "报错原因（若报错）":str(exc)
-        }
-        log_file_cursor.write(json.dumps(log_entry,ensure_ascii=False)+"\n")
+        #NOTE parts sent before the error aren't verified, the message failed as a whole
+        log_send_result(message, str(exc))
         # traceback.print_exc()
         return False
     else:
+        last_recipient = recipient
+        if burst:
+            for kind, content in sent:
+                delivery_verifier.record(message, kind, content, message.FromWxid, message.ActualName)
+            logger.debug(f"消息已发送，等待批量确认")
+            return True
         logger.debug(f"消息处理完成")
-        log_entry={
-            "发送时间": datetime.now(tz=timezone("Asia/Shanghai")).isoformat(timespec="seconds"),
-            "角色":message.Role,
-            "姓名":message.ActualName,
-            "联系电话":message.FromWxid,
-            "发送结果":"成功",
-            "报错原因（若报错）": None
-        }
-        log_file_cursor.write(json.dumps(log_entry,ensure_ascii=False)+"\n")
+        log_send_result(message)
         return True
 
+def resend_part(part:PendingSend)->Optional[Tuple[SendMessage, Optional[str]]]:
+    """
+    send again a part `delivery_verifier` found failed, in burst.
+    Returns:
+        out(tuple[SendMessage, str|None]|None): the message && its failure reason if it's done, as `DeliveryVerifier.verify`
+    """
+    message = part.message
+    logger.info(f"【消息发送失败】重新发送 - 接收人: {message.ActualName}:{message.FromWxid}，第{part.sends}次重发")
+    try:
+        chatbot_client.switch_session(message.FromWxid, top_bar_name=message.ActualName, retries=2, ignore_error=False)
+        if part.kind=="text":
+            chatbot_client.send_message(
+                session_name=message.FromWxid, message=message.Content, from_clipboard=True,
+                top_bar_name=message.ActualName, retries=2, ignore_error=False, assume_current=True)
+        else:
+            with attachment_prefetcher.checkout(message) as temp_filepath:
+                chatbot_client.send_file(
+                    message=message, session_name=message.FromWxid, filepath=temp_filepath,
+                    top_bar_name=message.ActualName, retries=2, ignore_error=False, assume_current=True)
+    except Exception as exc:
+        logger.error(f"消息重发失败 - 接收人: {message.ActualName}:{message.FromWxid}\n报错信息：{str(exc)}")
+        logger.debug(traceback.format_exc())
+        return delivery_verifier.give_up(part, str(exc))
+    delivery_verifier.resent_part(part)
+    return None
+
 def main_oa_server(business:str):
     """
     4a-warning main function. Keep asking && receiving messages from server
     """
+    global run_report
+    ack_outbox.start()
+    if ack_outbox.replayed:
+        #NOTE acknowledge messages delivered by the last run first, so the server doesn't send them again
+        logger.info(f"补发上次运行未确认的消息状态: {ack_outbox.replayed} 条")
+        if not ack_outbox.wait_empty(ACK_REPLAY_TIMEOUT):
+            logger.warning(f"补发未完成，剩余 {ack_outbox.pending()} 条在后台继续补发，这些消息不会重复发送")
+    run_id, resumed = checkpoint.begin(business)
+    progress = checkpoint.summary(run_id)
+    if resumed:
+        print(
+            f"[断点续发] 继续 {progress['started_time']} 开始的 {business} 业务: "
+            f"已发送 {progress['delivered']} 条，失败 {progress['failed']} 条，已读取 {progress['position']} 条消息")
+    run_report = RunReportWriter(REPORT_DIR, run_id, business, REPORT_FORMAT, started_time=progress["started_time"])
     logger.debug(f"开始连接服务器获取消息 - 业务类型: {business}")
-    with request_client.post(
-        url=f"{SERVER_API}/get-messages",
-        json={"business":business},
-        stream=True
-    ) as resp:
-        if resp.status_code!=200:
-            # logger.info(f"/get-messages 请求报错：{resp.text}")
-            # log_error(Exception(f"服务器请求失败: {resp.status_code}"), f"获取消息失败: {resp.text}")
-            logger.error(f"服务器请求失败: {resp.status_code} 获取消息失败: {resp.text}")
+    #NOTE the stream is read in a background thread into a bounded buffer,
+    # so it keeps being read while a message is sent through UI, && reconnects if it breaks
+    reader = SSEReader(
+        request_client, f"{SERVER_API}/get-messages", {"business":business},
+        buffer_size=SSE_BUFFER_SIZE, max_reconnects=SSE_MAX_RECONNECTS)
+    message_count = 0
+    position = progress["position"]
+    def already_sent(msg:SendMessage)->bool:
+        return checkpoint.is_delivered(run_id, str(msg.id)) or str(msg.id) in ack_outbox or str(msg.id) in delivery_verifier
+    positions:dict[str, int] = dict()
+    "position in the stream of messages sent in burst && not verified yet, by uid"
+    def settle_deliveries(wait:bool=False):
+        "verify messages sent in burst, send the failed parts again, && record the messages done"
+        global last_recipient
+        done, resend = delivery_verifier.verify(wait=wait)
+        last_recipient = None #NOTE verifying switched sessions
+        for part in resend:
+            result = resend_part(part)
+            if result is not None:
+                done.append(result)
+        for message, failure in done:
+            log_send_result(message, failure)
+            checkpoint.record(run_id, str(message.id), positions.pop(str(message.id)), failure_reason=failure)
+            if not failure:
+                ack_outbox.add(str(message.id))
+        if done:
+            logger.info(f"[批量确认] 确认 {len(done)} 条消息，重发 {len(resend)} 条，待确认 {delivery_verifier.pending()} 条")
+    def settle_all():
+        #NOTE passes that can't read any history, e.g. the UI is gone, end it after `max_checks` in a row
+        stalled = 0
+        while delivery_verifier.pending() and stalled < delivery_verifier.max_checks:
+            history_reads = delivery_verifier.history_reads
+            settle_deliveries(wait=True)
+            stalled = 0 if delivery_verifier.history_reads > history_reads else stalled+1
+        if delivery_verifier.pending():
+            logger.warning(f"[批量确认] {delivery_verifier.pending()} 条消息无法确认，未记录为已发送，下次运行会重新发送")
+    #NOTE messages to the same recipient within `RECIPIENT_LOOKAHEAD` are sent back to back, switching session once
+    grouper = RecipientGrouper(window=RECIPIENT_LOOKAHEAD, max_run=RECIPIENT_MAX_RUN or None)
+    with reader:
+        try:
+            #NOTE attachments of the next `ATTACHMENT_LOOKAHEAD` messages are decoded && written in background
+            for msg in attachment_prefetcher.iterate(grouper.iterate(reader), skip=already_sent):
+                message_count += 1
+                position += 1
+                if already_sent(msg):
+                    logger.info(f"[已发送] 跳过消息 {msg.id}")
+                    continue
+                logger.info("#"*50)
+                logger.info((
+                    "准备推送消息:\n"
+                    f"业务: {msg.Business.value}\n"
+                    f"接收人：{msg.ActualName}:{msg.FromWxid}\n"
+                    f"消息前缀：{msg.Content[:30]}..."
+                ))
+                logger.info("#"*50)
+                # logger.debug(f"处理第 {message_count} 条消息 - 接收人: {msg.FromWxid}")
+
+                send_result = execute_send_message(msg)
+                attachment_prefetcher.discard(msg) #NOTE no-op unless it failed before sending the attachment
+                if not send_result:
+                    # log_error(Exception("消息发送失败"), f"第 {message_count} 条消息发送失败")
+                    logger.error(f"[消息发送失败] 第 {message_count} 条消息发送失败")
+                    checkpoint.record(run_id, str(msg.id), position, failure_reason="发送失败")
+                    continue
+
+                if str(msg.id) in delivery_verifier:
+                    #NOTE sent in burst, recorded && acknowledged once verified
+                    positions[str(msg.id)] = position
+                    if delivery_verifier.due():
+                        settle_deliveries()
+                    continue
+
+                #NOTE recorded before acknowledging, so a crash from here on never sends it twice
+                checkpoint.record(run_id, str(msg.id), position)
+
+                #NOTE acknowledged by the background sender, the UI goes on to the next message
+                ack_outbox.add(str(msg.id))
+            settle_all()
+        except requests.HTTPError as exc:
+            logger.error(f"服务器请求失败: 获取消息失败: {exc}")
             return
+        finally:
+            if delivery_verifier.pending():
+                #NOTE whatever ended the run, what's sent is verified still, so it's not sent again next run
+                try:
+                    settle_all()
+                except Exception:
+                    logger.exception("[批量确认] 结束前确认已发送消息失败")
+            logger.debug(f"[消息流统计] {reader.stats()}")
+            logger.debug(f"[附件预处理统计] {attachment_prefetcher.stats()}")
+            if DELIVERY_MODE=="burst":
+                logger.info(f"[批量确认统计] {delivery_verifier.stats()}")
+            grouping = grouper.stats()
+            logger.info(
+                f"[按接收人分组] 调整顺序 {grouping['reordered']} 条，会话切换 {grouping['switches']} 次，"
+                f"比按原顺序发送少切换 {grouping['switches_avoided']} 次")
+            progress = checkpoint.summary(run_id)
+            print(f"[进度] 已发送 {progress['delivered']} 条，失败 {progress['failed']} 条，已读取 {progress['position']} 条消息")
+    checkpoint.finish(run_id)
+    export_run_report(finished=True)
+    logger.info("消息发送完毕。退出程序")
+    logger.debug(f"所有消息处理完毕，共处理 {message_count} 条消息")
 
-        logger.debug("成功连接到服务器，开始接收消息")
-        message_count = 0
-        
-        for chunk in resp.iter_lines(delimiter="\n\n",decode_unicode=True):
-            if not chunk.startswith("data: "):
-                continue
-            chunk = chunk.removeprefix("data: ")
-            if chunk=="[DONE]":
-                logger.info("消息发送完毕。退出程序")
-                logger.debug(f"所有消息处理完毕，共处理 {message_count} 条消息")
-                return
-            
-            msg = SendMessage.model_validate_json(chunk)
-            message_count += 1
-            logger.info("#"*50)
-            logger.info((
-                "准备推送消息:\n"
-                f"业务: {msg.Business.value}\n"
-                f"接收人：{msg.ActualName}:{msg.FromWxid}\n"
-                f"消息前缀：{msg.Content[:30]}..."
-            ))
-            logger.info("#"*50)
-            # logger.debug(f"处理第 {message_count} 条消息 - 接收人: {msg.FromWxid}")
-            
-            send_result = execute_send_message(msg)
-            if not send_result:
-                # log_error(Exception("消息发送失败"), f"第 {message_count} 条消息发送失败")
-                logger.error(f"[消息发送失败] 第 {message_count} 条消息发送失败")
-                continue
-
-            with request_client.post(
-                url=f"{SERVER_API}/update-msg-status",
-                json={"uid":str(msg.id)}
-            ) as update_resp:
-                logger.debug(f"[UPDATE RESPONSE]{update_resp.json().get('msg')}")
-                logger.debug(f"更新消息状态完成 - 消息ID: {msg.id}")
+def export_run_report(finished:bool):
+    "close the report of the current run, if any. Unfinished runs are exported too && resumed next time"
+    global run_report
+    if run_report is None:
+        return
+    logger.debug(f"正在导出本轮发送记录")
+    report_path = run_report.close(finished)
+    logger.info(f"本轮发送记录已导出至: {report_path} {run_report.rollup()}")
+    run_report = None
 
 def get_businesses_available()->list:
     with request_client.get(f"{SERVER_API}/businesses-available") as resp:
@@ -225,11 +386,16 @@ if __name__ == '__main__':
         traceback.print_exc()
     else:
         print("程序执行完毕！")
+        logger.debug(f"[附件去重统计] {attachment_store.stats()}")
         if business:
             logger.debug(f"程序正常结束 - 业务: {business}", business)
-        concat_jsonl_to_excel()
     finally:
         # temp_dir.cleanup() #XXX 临时文件不删除
+        export_run_report(finished=False) #NOTE no-op if the run finished
+        attachment_prefetcher.close()
+        ack_outbox.close(ACK_REPLAY_TIMEOUT)
+        logger.debug(f"[消息状态回报统计] {ack_outbox.stats()}")
+        checkpoint.close()
         request_client.close()
         log_file_cursor.close()
         input("按Enter键退出...")
@@ -0,0 +1,226 @@
+import os
+import json
+import threading
+from typing import *
+from pathlib import Path
+
+import requests
+
+from logg import logger
+
+
+def bulk_acked(uids:List[str], body:Any)->Optional[List[str]]:
+    """
+    uids a bulk acknowledgement response confirms: those listed in `{"acked": [...]}`,
+    || all of them if `{"success": true}`, none if `{"success": false}`.
+    Returns:
+        out(list[str]|None): None if the body carries neither, e.g. a server ignoring `uids`: nothing is confirmed by it
+    """
+    if not isinstance(body, dict):
+        return None
+    if isinstance(body.get("acked"), list):
+        acked = set(body["acked"])
+        return [uid for uid in uids if uid in acked]
+    if isinstance(body.get("success"), bool):
+        return list(uids) if body["success"] else []
+    return None
+
+
+class AckOutbox:
+    """
+    Acknowledges delivered messages to the server in the background, through a local append-only outbox.
+
+    `add` appends the uid to the outbox file (fsync'ed) && returns at once, so the UI thread never waits for the server.
+    A sender thread posts pending uids in batches && appends an `ack` line for every batch the server accepted.
+    Failed posts are retried with exponential backoff. Uids left pending by a crash are replayed when reopened.
+
+    The server is first asked with a bulk body `{"uids": [...]}`. A 200 alone confirms nothing, only the uids
+    its body confirms (see `bulk_acked`) are dropped. If it doesn't support bulk (404/405/422, || a body confirming nothing),
+    uids are posted one by one as `{"uid": ...}` from then on, over the same keep-alive session.
+
+    Thread safe.
+    """
+
+    def __init__(
+            self,
+            path:Union[str,Path],
+            session:requests.Session,
+            url:str,
+            batch_size:int=50,
+            linger:float=0.5,
+            max_backoff:float=60.0,
+            timeout:float=10.0):
+        """
+        Args:
+            path(str|Path): outbox file. Created if not exists.
+            session(requests.Session): session to post with.
+            url(str): `/update-msg-status` of the server.
+            batch_size(int): uids posted in one bulk acknowledgement at most.
+            linger(float): seconds the sender waits for more uids before posting a batch that's not full.
+            max_backoff(float): cap of seconds between retries.
+            timeout(float): seconds to wait for the server per post, a post timed out is retried.
+        """
+        self.path = Path(path)
+        self.session = session
+        self.url = url
+        self.batch_size = batch_size
+        self.linger = linger
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.bulk = True
+        "whether the server accepts bulk acknowledgements, turned off at the first rejection"
+        self._pending:dict[str, None] = dict()
+        "uids not acknowledged yet, in the order they were added"
+        self._cond = threading.Condition()
+        self._file_lock = threading.Lock()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, name="ack-outbox", daemon=True)
+        self.acked = 0
+        self.failures = 0
+        self.replayed = self._load()
+        self._file = self.path.open("a", encoding="utf8")
+
+    def _load(self)->int:
+        "read pending uids left by the last run && compact the file to them"
+        if not self.path.exists():
+            return 0
+        with self.path.open("r", encoding="utf8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    #NOTE torn write of a crash, only the last line can be
+                    continue
+                if record["op"]=="add":
+                    self._pending[record["uid"]] = None
+                else:
+                    for uid in record["uids"]:
+                        self._pending.pop(uid, None)
+        self._rewrite()
+        return len(self._pending)
+
+    def _rewrite(self):
+        "replace the file by `add` lines of pending uids only"
+        temp_path = self.path.with_suffix(self.path.suffix+".tmp")
+        with temp_path.open("w", encoding="utf8") as f:
+            for uid in self._pending:
+                f.write(json.dumps(dict(op="add", uid=uid))+"\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+
+    def _append(self, record:dict):
+        with self._file_lock:
+            self._file.write(json.dumps(record)+"\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def start(self)->"AckOutbox":
+        self._thread.start()
+        return self
+
+    def add(self, uid:str):
+        "record the message as delivered. Acknowledged to the server later"
+        self._append(dict(op="add", uid=uid))
+        with self._cond:
+            self._pending[uid] = None
+            self._cond.notify_all()
+
+    def __contains__(self, uid:str)->bool:
+        "whether the uid is delivered && waiting for acknowledgement"
+        with self._cond:
+            return uid in self._pending
+
+    def pending(self)->int:
+        with self._cond:
+            return len(self._pending)
+
+    def wait_empty(self, timeout:Optional[float]=None)->bool:
+        """
+        wait till every pending uid is acknowledged.
+        Returns:
+            out(bool): False if timed out
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda : not self._pending, timeout)
+
+    def close(self, timeout:float=30.0):
+        "try to acknowledge what's left within `timeout` seconds, then stop. Uids still pending are kept for the next run"
+        if self._thread.is_alive():
+            self.wait_empty(timeout)
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if self._thread.is_alive():
+            self._thread.join(timeout=5.0)
+        with self._file_lock:
+            self._file.close()
+            with self._cond:
+                self._rewrite()
+
+    def stats(self)->dict:
+        return dict(pending=self.pending(), acked=self.acked, failures=self.failures, replayed=self.replayed, bulk=self.bulk)
+
+    def _post(self, uids:List[str]):
+        "acknowledge the uids the server accepted. Raises if it didn't accept them all"
+        if self.bulk:
+            with self.session.post(url=self.url, json={"uids":uids}, timeout=self.timeout) as resp:
+                if resp.status_code in (404, 405, 422):
+                    logger.info(f"[ack] bulk acknowledgement not supported({resp.status_code}), acknowledging one by one")
+                    self.bulk = False
+                else:
+                    resp.raise_for_status()
+                    try:
+                        acked = bulk_acked(uids, resp.json())
+                    except ValueError:
+                        acked = None
+                    if not acked:
+                        #NOTE `{"success": false}` too: posting the same bulk again would never get through
+                        logger.info(f"[ack] bulk acknowledgement confirms no uid: {resp.text[:200]}, acknowledging one by one")
+                        self.bulk = False
+                    else:
+                        self._acknowledged(acked)
+                        if len(acked) < len(uids):
+                            raise RuntimeError(f"server acknowledged {len(acked)} of {len(uids)} messages")
+                        return
+        for uid in uids:
+            with self.session.post(url=self.url, json={"uid":uid}, timeout=self.timeout) as resp:
+                resp.raise_for_status()
+                logger.debug(f"[UPDATE RESPONSE]{resp.json().get('msg')}")
+            #NOTE record progress so a failure in the middle doesn't post the acknowledged ones again
+            self._acknowledged([uid])
+
+    def _acknowledged(self, uids:List[str]):
+        self._append(dict(op="ack", uids=uids))
+        with self._cond:
+            for uid in uids:
+                if uid in self._pending:
+                    del self._pending[uid]
+                    self.acked += 1
+            self._cond.notify_all()
+
+    def _run(self):
+        failures_in_row = 0
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda : self._pending or self._stopped)
+                if self._stopped:
+                    return
+                if len(self._pending) < self.batch_size:
+                    #NOTE linger a little, so uids added in a burst go in one post
+                    self._cond.wait_for(lambda : len(self._pending) >= self.batch_size or self._stopped, self.linger)
+                uids = list(self._pending)[:self.batch_size]
+                acked = self.acked
+            try:
+                self._post(uids)
+            except Exception as exc:
+                self.failures += 1
+                #NOTE posting one by one, some may have gone through: only failures without progress back off longer
+                failures_in_row = 1 if self.acked > acked else failures_in_row+1
+                backoff = min(2**(failures_in_row-1), self.max_backoff)
+                logger.warning(f"[ack] acknowledging {len(uids)} messages failed: {exc!r}, retry in {backoff}s")
+                with self._cond:
+                    self._cond.wait_for(lambda : self._stopped, backoff)
+                continue
+            failures_in_row = 0
+            logger.debug(f"更新消息状态完成 - {len(uids)} 条消息")
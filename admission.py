@@ -0,0 +1,112 @@
+import math
+from typing import *
+from collections import Counter
+
+from schemas import AdmissionRejected
+from tools import ServiceRateEstimator
+
+
+class AdmissionController:
+    """
+    Admission control for messages about to be enqueued.
+
+    The UI worker sends one message at a time, so the queue delay of a new message is
+    roughly `queue_depth * seconds per message`. A message is rejected when:
+    - the estimated queue delay exceeds `max_queue_delay`;
+    - the queue holds `max_queue_size` messages already (hard bound of memory);
+    - the caller already has `per_caller_quota` messages waiting.
+
+    Every rejection carries `retry_after`, the estimated seconds until it would be admitted.
+    """
+
+    def __init__(
+            self,
+            estimator:ServiceRateEstimator,
+            max_queue_delay:float=3600.0,
+            max_queue_size:int=10000,
+            per_caller_quota:int=0):
+        """
+        Args:
+            estimator(ServiceRateEstimator): measures UI service time, fed by the consumer.
+            max_queue_delay(float): seconds a new message may wait in queue at most.
+            max_queue_size(int): hard limit of queued messages.
+            per_caller_quota(int): messages a single caller may have waiting. 0 means unlimited.
+        """
+        self.estimator = estimator
+        self.max_queue_delay = max_queue_delay
+        self.max_queue_size = max_queue_size
+        self.per_caller_quota = per_caller_quota
+        self.outstanding:Counter[str] = Counter()
+        "number of waiting messages by caller"
+        self._owners:dict[str,str] = dict()
+        "message id -> caller"
+        self.rejected:Counter[str] = Counter()
+        "number of rejections by reason"
+
+    def admit(self, caller:str, message_id:str, queue_depth:int, caller_depth:Optional[int]=None):
+        """
+        admit the message or raise `AdmissionRejected`.
+        Admitted message holds a quota of its caller until `release`.
+
+        Args:
+            caller_depth(int): messages `caller` has waiting, if counted elsewhere (e.g. a queue shared by processes).
+                Then nothing is held, `release` is not needed.
+        """
+        outstanding = self.outstanding[caller] if caller_depth is None else caller_depth
+        mean = self.estimator.mean
+        if queue_depth >= self.max_queue_size:
+            self._reject("queue_full", "queue is full", mean*(queue_depth-self.max_queue_size+1))
+
+        delay = self.estimator.drain_seconds(queue_depth)
+        if delay > self.max_queue_delay:
+            self._reject(
+                "queue_delay",
+                f"estimated queue delay {delay:.0f}s exceeds {self.max_queue_delay:.0f}s",
+                delay-self.max_queue_delay)
+
+        if self.per_caller_quota and outstanding >= self.per_caller_quota:
+            #NOTE caller's earliest message leaves the queue in at most `delay` seconds
+            self._reject(
+                "caller_quota",
+                f"caller {caller} already has {outstanding} messages waiting",
+                min(delay, mean*outstanding) or mean)
+
+        if caller_depth is None:
+            self.outstanding[caller] += 1
+            self._owners[message_id] = caller
+
+    def room(self, queue_depth:int)->int:
+        """
+        messages that may enter the queue now without `admit` rejecting them for queue size || delay. Never raises.
+        For work accepted already, e.g. scheduled messages coming due && bulk recipients expanded,
+        which waits outside the queue while there's no room instead of being rejected.
+        """
+        room = self.max_queue_size - queue_depth
+        mean = self.estimator.mean
+        if mean > 0:
+            #NOTE `admit` accepts while `queue_depth*mean <= max_queue_delay`
+            room = min(room, math.floor(self.max_queue_delay/mean) + 1 - queue_depth)
+        return max(room, 0)
+
+    def release(self, message_id:str):
+        "give back the quota once the message leaves the queue"
+        caller = self._owners.pop(message_id, None)
+        if caller is None:
+            return
+        self.outstanding[caller] -= 1
+        if self.outstanding[caller] <= 0:
+            del self.outstanding[caller]
+
+    def stats(self)->dict:
+        return dict(
+            service_seconds=self.estimator.mean,
+            max_queue_delay=self.max_queue_delay,
+            max_queue_size=self.max_queue_size,
+            per_caller_quota=self.per_caller_quota,
+            outstanding=dict(self.outstanding),
+            rejected=dict(self.rejected),
+        )
+
+    def _reject(self, reason:str, message:str, retry_after:float):
+        self.rejected[reason] += 1
+        raise AdmissionRejected(message, reason=reason, retry_after=max(math.ceil(retry_after), 1))
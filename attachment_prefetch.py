@@ -0,0 +1,196 @@
+import time
+import queue
+import threading
+from typing import *
+from pathlib import Path
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, Future
+
+from logg import logger
+from schemas import SendMessage
+from tools import b64decode
+from attachment_store import AttachmentStore
+
+
+class _Done:
+    "sentinel put into the lookahead buffer when the source is exhausted"
+
+
+class _Job:
+    def __init__(self, future:Future, budget:int):
+        self.future = future
+        self.budget = budget
+        "bytes counted against the budget till the file is released"
+
+
+class AttachmentPrefetcher:
+    """
+    Decodes && writes attachments of upcoming messages in a thread pool, ahead of the UI.
+
+    `iterate` wraps a message iterable: a feeder thread reads up to `lookahead` messages ahead of the consumer,
+    && submits a job for the `File` of each one: base64 decode, store into the `AttachmentStore`,
+    && check the size on disk matches the decoded size. When the UI reaches the message, `checkout` hands
+    the file ready on disk; if its job failed || the message wasn't prefetched, it's decoded there as before.
+
+    Files prepared && not yet sent count against `max_bytes`: the feeder waits for sends to release some
+    before decoding more, so a run of large attachments can't fill memory || disk. One file is always allowed,
+    whatever its size.
+    """
+
+    def __init__(self, store:AttachmentStore, lookahead:int=4, max_bytes:int=128*1024*1024, workers:int=2):
+        """
+        Args:
+            store(AttachmentStore): store files are written into && released from.
+            lookahead(int): messages read ahead of the consumer at most.
+            max_bytes(int): decoded bytes prepared && not yet released at most.
+            workers(int): decoding threads.
+        """
+        self.store = store
+        self.lookahead = lookahead
+        self.max_bytes = max_bytes
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="attachment-prefetch")
+        self._jobs:dict[str, _Job] = dict()
+        self._budget = threading.Condition()
+        self._prepared_bytes = 0
+        self._stopped = threading.Event()
+        self.prefetched = 0
+        self.hits = 0
+        "files ready when the UI asked for them"
+        self.late = 0
+        "files still being prepared when the UI asked for them, counted in `hits` too once ready"
+        self.misses = 0
+        "files decoded by the UI itself: not prefetched || the job failed"
+        self.waited_seconds = 0.0
+        "seconds the UI waited on jobs not done yet"
+
+    def iterate(self, messages:Iterable[SendMessage], skip:Optional[Callable[[SendMessage], bool]]=None)->Iterator[SendMessage]:
+        """
+        yield the messages in order, their attachments prepared ahead.
+        Errors of `messages` are raised from the iteration, after the messages received before them.
+
+        Args:
+            messages(Iterable[SendMessage]): source, e.g. `SSEReader`. Iterated in the feeder thread.
+            skip(Callable[[SendMessage], bool]): messages it returns True for aren't prefetched, e.g. delivered ones.
+        """
+        buffer:queue.Queue = queue.Queue(maxsize=max(self.lookahead, 1))
+        feeder = threading.Thread(
+            target=self._feed, args=(messages, skip, buffer), name="attachment-prefetch-feeder", daemon=True)
+        feeder.start()
+        while True:
+            item = buffer.get()
+            if item is _Done:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+
+    def _put(self, buffer:queue.Queue, item)->bool:
+        while not self._stopped.is_set():
+            try:
+                buffer.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _feed(self, messages:Iterable[SendMessage], skip, buffer:queue.Queue):
+        try:
+            for message in messages:
+                if message.File and not (skip and skip(message)):
+                    self._submit(message)
+                if not self._put(buffer, message):
+                    return
+        except BaseException as exc:
+            self._put(buffer, exc)
+        else:
+            self._put(buffer, _Done)
+
+    def _submit(self, message:SendMessage):
+        #NOTE base64 is 4 chars per 3 bytes, close enough to budget before decoding
+        budget = len(message.File)*3//4
+        with self._budget:
+            while self._prepared_bytes and self._prepared_bytes+budget > self.max_bytes and not self._stopped.is_set():
+                self._budget.wait(0.5)
+            if self._stopped.is_set():
+                return
+            self._prepared_bytes += budget
+        future = self._pool.submit(self._prepare, message.File, message.Filename)
+        with self._budget:
+            self._jobs[str(message.id)] = _Job(future, budget)
+        self.prefetched += 1
+
+    def _prepare(self, string:str, filename:Optional[str])->Path:
+        "prefetch job: decode, store && verify"
+        decoded, mime_type = b64decode(string)
+        path = self.store.acquire(decoded, filename=filename, mime_type=mime_type)
+        size = path.stat().st_size
+        if size != len(decoded):
+            self.store.release(path)
+            raise IOError(f"{path} has {size} bytes on disk, {len(decoded)} expected")
+        return path
+
+    def _pop(self, message:SendMessage)->Optional[_Job]:
+        with self._budget:
+            return self._jobs.pop(str(message.id), None)
+
+    def _settle(self, job:_Job):
+        "give the budget of a job back"
+        with self._budget:
+            self._prepared_bytes -= job.budget
+            self._budget.notify_all()
+
+    @contextmanager
+    def checkout(self, message:SendMessage)->Iterator[Path]:
+        "path of the message's attachment, prepared ahead if possible. Released once the block exits"
+        job = self._pop(message)
+        path = None
+        if job is not None:
+            if not job.future.done():
+                self.late += 1
+            start = time.perf_counter()
+            try:
+                path = job.future.result()
+            except Exception as exc:
+                logger.warning(f"[attachment prefetch] preparing {message.Filename} failed: {exc!r}, decoding now")
+                self._settle(job)
+                job = None
+            else:
+                self.hits += 1
+            self.waited_seconds += time.perf_counter()-start
+        if path is None:
+            self.misses += 1
+            path = self.store.acquire_b64(message.File, message.Filename)
+        try:
+            yield path
+        finally:
+            self.store.release(path)
+            if job is not None:
+                self._settle(job)
+
+    def discard(self, message:SendMessage):
+        "release the attachment prepared for a message that won't be checked out, e.g. it failed before sending it"
+        job = self._pop(message)
+        if job is not None:
+            job.future.add_done_callback(lambda future: self._release(future, job))
+
+    def _release(self, future:Future, job:_Job):
+        if not future.cancelled() and future.exception() is None:
+            self.store.release(future.result())
+        self._settle(job)
+
+    def close(self):
+        "stop prefetching, && release what was prepared && not sent"
+        self._stopped.set()
+        with self._budget:
+            self._budget.notify_all()
+            jobs, self._jobs = list(self._jobs.values()), dict()
+        for job in jobs:
+            job.future.add_done_callback(lambda future, job=job: self._release(future, job))
+        self._pool.shutdown(wait=True, cancel_futures=True)
+
+    def stats(self)->dict:
+        with self._budget:
+            return dict(
+                prefetched=self.prefetched, hits=self.hits, late=self.late, misses=self.misses,
+                waited_seconds=round(self.waited_seconds, 3),
+                prepared_bytes=self._prepared_bytes, max_bytes=self.max_bytes)
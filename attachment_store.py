@@ -0,0 +1,199 @@
+import os
+import shutil
+import hashlib
+import mimetypes
+import threading
+from typing import *
+from pathlib import Path
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from pydantic import BaseModel, Field
+
+from logg import logger
+from tools import b64decode
+
+
+class AttachmentEntry(BaseModel):
+    """one piece of content stored in `AttachmentStore`"""
+
+    digest:str
+    "sha256 hex digest of the decoded bytes. Also the directory name the file stored in."
+
+    size:int
+    "size of the decoded bytes"
+
+    names:List[str]=Field(default_factory=list)
+    """filenames the content is linked as.
+    The first one owns the bytes, the rest are hard links(or copies if hard link is not supported)"""
+
+    refs:int=0
+    "number of sends still using the content. Entry with refs>0 is never evicted"
+
+
+class AttachmentStore:
+    """
+    Content-addressed attachment store.
+
+    Files are keyed by the sha256 of the decoded bytes and stored as `{root_dir}/{digest}/{filename}`,
+    so the same content is written to disk once no matter how many recipients it is sent to.
+    Entries are reference counted, and entries nobody uses are evicted in LRU order
+    once the total size exceeds `max_bytes`.
+
+    Thread safe. It's shared by the asyncio consumer and the threads it dispatches UI work to.
+    """
+
+    def __init__(self, root_dir:Union[str,Path], max_bytes:int=512*1024*1024):
+        """
+        Args:
+            root_dir(str|Path): directory to store attachments in. Created if not exists.
+            max_bytes(int): size bound of the store. Only unreferenced entries can be evicted,
+                so the store may exceed it temporarily while every entry is in use.
+        """
+        self.root_dir = Path(root_dir)
+        self.root_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._entries:OrderedDict[str, AttachmentEntry] = OrderedDict() #NOTE LRU order, most recent at the end
+        self._lock = threading.Lock()
+
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+        "bytes not written to disk thanks to deduplication"
+        self.evictions = 0
+
+
+    def acquire(self, data:bytes, filename:Optional[str]=None, mime_type:Optional[str]=None)->Path:
+        """
+        store `data` (or reuse the stored copy) and take a reference on it.
+        You must `release` the returned path after the file is sent.
+
+        Args:
+            data(bytes): decoded file bytes.
+            filename(str): filename the recipient sees. If None, generated from digest && mime type.
+            mime_type(str): used to guess file extension when `filename` is None.
+        Returns:
+            out(Path): absolute path of the stored file.
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        filename = self._safe_filename(filename, digest, mime_type)
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None:
+                self.misses += 1
+                entry = AttachmentEntry(digest=digest, size=len(data))
+                entry_dir = self.root_dir / digest
+                entry_dir.mkdir(exist_ok=True)
+                (entry_dir / filename).write_bytes(data)
+                entry.names.append(filename)
+                self._entries[digest] = entry
+                self.total_bytes += entry.size
+            else:
+                self.hits += 1
+                self.bytes_saved += entry.size
+                self._entries.move_to_end(digest)
+                if filename not in entry.names:
+                    self._link(entry, filename)
+                stored = self.root_dir / digest / filename
+                if not stored.exists() or stored.stat().st_size != entry.size:
+                    #NOTE removed || truncated on disk meanwhile, written again
+                    logger.warning(f"[attachment store] {stored} is missing || truncated, writing it again")
+                    stored.parent.mkdir(exist_ok=True)
+                    stored.write_bytes(data)
+            entry.refs += 1
+            self._evict()
+            return (self.root_dir / digest / filename).absolute()
+
+
+    def acquire_b64(self, string:str, filename:Optional[str]=None)->Path:
+        """
+        decode base64 string (`data:{mime};base64,{...}`) and `acquire` it.
+        """
+        decoded, mime_type = b64decode(string)
+        return self.acquire(decoded, filename=filename, mime_type=mime_type)
+
+
+    def release(self, path:Union[str,Path]):
+        "drop the reference taken by `acquire`."
+        digest = Path(path).parent.name
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is None:
+                logger.warning(f"[attachment store] release unknown attachment: {path}")
+                return
+            entry.refs = max(entry.refs-1, 0)
+            self._evict()
+
+
+    @contextmanager
+    def checkout_b64(self, string:str, filename:Optional[str]=None)->Iterator[Path]:
+        "`acquire_b64` && `release` once the block exits"
+        path = self.acquire_b64(string, filename)
+        try:
+            yield path
+        finally:
+            self.release(path)
+
+
+    def stats(self)->dict:
+        with self._lock:
+            return dict(
+                entries=len(self._entries),
+                total_bytes=self.total_bytes,
+                max_bytes=self.max_bytes,
+                hits=self.hits,
+                misses=self.misses,
+                bytes_saved=self.bytes_saved,
+                evictions=self.evictions,
+            )
+
+
+    def clear(self):
+        "remove every stored file, referenced or not. Used on shutdown."
+        with self._lock:
+            self._entries.clear()
+            self.total_bytes = 0
+        shutil.rmtree(self.root_dir, ignore_errors=True)
+
+
+    def _link(self, entry:AttachmentEntry, filename:str):
+        "expose the same content under another filename without storing its bytes again"
+        entry_dir = self.root_dir / entry.digest
+        source = entry_dir / entry.names[0]
+        target = entry_dir / filename
+        try:
+            os.link(source, target)
+        except OSError:
+            #NOTE hard link unsupported(e.g. FAT32), fall back to copy
+            shutil.copyfile(source, target)
+        entry.names.append(filename)
+
+
+    def _evict(self):
+        "evict unreferenced entries in LRU order until total size is under `max_bytes`. Lock must be held."
+        if self.total_bytes <= self.max_bytes:
+            return
+        for digest in list(self._entries.keys()):
+            if self.total_bytes <= self.max_bytes:
+                break
+            entry = self._entries[digest]
+            if entry.refs > 0:
+                continue
+            del self._entries[digest]
+            self.total_bytes -= entry.size
+            self.evictions += 1
+            shutil.rmtree(self.root_dir / digest, ignore_errors=True)
+            logger.debug(f"[attachment store] evicted {digest} ({entry.size} bytes)")
+
+
+    @staticmethod
+    def _safe_filename(filename:Optional[str], digest:str, mime_type:Optional[str])->str:
+        #NOTE caller-chosen filename may contain directories, only keep the basename.
+        # Either separator, the server may send windows paths
+        filename = Path(filename.replace("\\", "/")).name if filename else ""
+        if filename.strip(". "):
+            return filename
+        #NOTE `.`, `..` && the like would resolve outside the digest directory, named after the digest instead
+        extension = mimetypes.guess_extension(mime_type or "") or ""
+        return digest[:16] + extension
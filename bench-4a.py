@@ -0,0 +1,163 @@
+# End-to-end load test of the 4a pipeline, without the production server nor a desktop.
+# Serves a synthetic workload from `OAStub` on a local port, runs `4a-warning-sync.py` || `4a-warning-async.py`
+# against it with `SimulatedChatClient` in place of the desktop client, && reports throughput && latency:
+# - latency: from the stub first sending a message to the simulated UI finishing it;
+# - ack lag: from the UI finishing a message to the stub receiving its acknowledgement;
+# along with duplicates delivered, messages lost && the faults injected.
+# Runs on linux: everything the scripts write goes to a temporary directory, except their `logs/`.
+#
+# usage: python bench-4a.py [--script sync] [--delivery-mode burst] [--messages 500] [--attachment-ratio 0.2] [--error-rate 0.01] ...
+import os
+import sys
+import time
+import types
+import asyncio
+import argparse
+import tempfile
+import threading
+import importlib.util
+from pathlib import Path
+from collections import Counter
+
+from aiohttp import web
+
+from logg import logger, WORK_DIR
+from oa_stub import OAStub, add_arguments, config_from_args
+from simulated_chat import SimulatedChatClient
+
+
+def percentiles(samples:list)->str:
+    samples = sorted(samples)
+    if not samples:
+        return "no samples"
+    pick = lambda q: samples[min(int(len(samples)*q), len(samples)-1)]
+    return (f"n={len(samples):>6}  p50={pick(0.5):8.3f}s  p95={pick(0.95):8.3f}s  "
+            f"p99={pick(0.99):8.3f}s  max={samples[-1]:8.3f}s")
+
+
+def serve(stub:OAStub)->int:
+    "serve the stub in a background thread with its own event loop. Returns the port"
+    started = threading.Event()
+    port = []
+    async def run():
+        runner = web.AppRunner(stub.app(), access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        port.append(site._server.sockets[0].getsockname()[1])
+        started.set()
+        await asyncio.Event().wait()
+    threading.Thread(target=lambda: asyncio.run(run()), name="oa-stub", daemon=True).start()
+    started.wait()
+    return port[0]
+
+
+def load_script(name:str, client:SimulatedChatClient)->types.ModuleType:
+    #NOTE the scripts build their client from `chatbots.CmccChatClient`, which needs windows.
+    # A stand-in `chatbots` module hands them the simulated one
+    chatbots = types.ModuleType("chatbots")
+    chatbots.CmccChatClient = lambda *args, **kwargs: client
+    sys.modules["chatbots"] = chatbots
+    spec = importlib.util.spec_from_file_location(name.replace("-", "_"), WORK_DIR / f"{name}.py")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def run_sync(module:types.ModuleType, businesses:list, ack_timeout:float):
+    try:
+        for business in businesses:
+            module.main_oa_server(business)
+    finally:
+        #NOTE what `4a-warning-sync.py` does on exit
+        module.export_run_report(finished=False)
+        module.attachment_prefetcher.close()
+        module.ack_outbox.close(ack_timeout)
+        module.checkpoint.close()
+        module.request_client.close()
+        module.log_file_cursor.close()
+
+
+def report(stub:OAStub, client:SimulatedChatClient, seconds:float):
+    delivered_at = dict()
+    deliveries = Counter()
+    for delivery in client.deliveries:
+        if delivery.kind!="text":
+            continue
+        uid = stub.uid_of_content.get(delivery.content)
+        if uid is None:
+            continue
+        deliveries[uid] += 1
+        delivered_at.setdefault(uid, delivery.delivered_at)
+    latencies = [delivered_at[uid]-stub.emitted_at[uid] for uid in delivered_at if uid in stub.emitted_at]
+    ack_lags = [stub.acked_at[uid]-delivered_at[uid] for uid in delivered_at if uid in stub.acked_at]
+    stats = stub.stats()
+    print(f"[4a load test] {seconds:.1f}s")
+    print(f"  delivered      : {len(delivered_at)}/{stats['messages']}  "
+          f"({len(delivered_at)/seconds:.2f} msg/s, {len(delivered_at)/seconds*3600:.0f} msg/h)")
+    print(f"  duplicates     : {sum(count-1 for count in deliveries.values())} messages delivered more than once")
+    lost_acked = sum(1 for uid in stub.acked_at if uid not in delivered_at)
+    print(f"  lost           : {stats['messages']-len(delivered_at)} never delivered, {lost_acked} of them acknowledged")
+    print(f"  acknowledged   : {stats['acked']}/{stats['messages']}")
+    print(f"  latency        : {percentiles(latencies)}")
+    print(f"  ack lag        : {percentiles(ack_lags)}")
+    print(f"  server         : {stats}")
+    print(f"  simulated ui   : {client.stats()}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="end-to-end load test of the 4a scripts against a local stub server")
+    parser.add_argument("--script", choices=["sync","async"], default="sync", help="4a script under test")
+    parser.add_argument("--switch-seconds", type=float, default=0.05, help="simulated seconds to switch session")
+    parser.add_argument("--send-seconds", type=float, default=0.05, help="simulated seconds to send a text")
+    parser.add_argument("--file-seconds-per-mb", type=float, default=0.2, help="simulated seconds to send a file, per MB")
+    parser.add_argument("--read-seconds", type=float, default=0.05, help="simulated seconds to refresh && read a session history")
+    parser.add_argument("--confirm-polls", type=int, default=1, help="history reads a send shows as still sending for")
+    parser.add_argument("--send-failure-rate", type=float, default=0.0, help="share of sends failing in the simulated UI")
+    parser.add_argument("--confirm-wait", type=float, default=0.0, help="`WAIT_BEFORE_REFRESH` of the script")
+    parser.add_argument("--delivery-mode", choices=["confirm","burst"], default="confirm", help="`DELIVERY_MODE` of 4a-warning-sync")
+    parser.add_argument("--verify-batch-sessions", type=int, default=20, help="`VERIFY_BATCH_SESSIONS` of 4a-warning-sync")
+    parser.add_argument("--recipient-lookahead", type=int, default=16, help="`RECIPIENT_LOOKAHEAD` of 4a-warning-sync, 1 to send in stream order")
+    parser.add_argument("--ack-timeout", type=float, default=30.0, help="seconds to wait for acknowledgements on exit")
+    parser.add_argument("--verbose", action="store_true", help="keep the scripts' logs on stdout")
+    add_arguments(parser)
+    args = parser.parse_args()
+    if args.script=="sync" and args.protocol!="sse":
+        parser.error("4a-warning-sync reads the stream, use --protocol sse")
+
+    stub = OAStub(config_from_args(args))
+    port = serve(stub)
+    work_dir = Path(tempfile.mkdtemp(prefix="bench-4a"))
+    os.environ.update(
+        SERVER_API=f"http://127.0.0.1:{port}",
+        WAIT_BEFORE_REFRESH=str(args.confirm_wait),
+        DELIVERY_MODE=args.delivery_mode,
+        VERIFY_BATCH_SESSIONS=str(args.verify_batch_sessions),
+        RECIPIENT_LOOKAHEAD=str(args.recipient_lookahead),
+        CHECKPOINT_PATH=str(work_dir / "checkpoint.db"),
+        ACK_OUTBOX_PATH=str(work_dir / "ack_outbox.jsonl"),
+        REPORT_DIR=str(work_dir / "reports"),
+        OA_PROTOCOL=args.protocol,
+        OA_REPORT_INTERVAL="0",
+    )
+    if not args.verbose:
+        logger.remove()
+        logger.add(sys.stderr, level="WARNING")
+    client = SimulatedChatClient(
+        switch_seconds=args.switch_seconds, send_seconds=args.send_seconds,
+        file_seconds_per_mb=args.file_seconds_per_mb, read_seconds=args.read_seconds, confirm_polls=args.confirm_polls,
+        failure_rate=args.send_failure_rate, seed=args.seed)
+    module = load_script(f"4a-warning-{args.script}", client)
+    mode = f", {args.delivery_mode} delivery" if args.script=="sync" else ""
+    print(f"[4a load test] {args.script} script{mode}, {stub.stats()['messages']} messages over {args.protocol}, work dir {work_dir}")
+
+    start = time.monotonic()
+    if args.script=="sync":
+        run_sync(module, args.businesses, args.ack_timeout)
+    else:
+        asyncio.run(module.main_oa_server(args.businesses))
+    report(stub, client, time.monotonic()-start)
+
+
+if __name__ == '__main__':
+    main()
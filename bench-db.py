@@ -0,0 +1,142 @@
+# Mixed read/write benchmark of the status DB.
+# Reader processes query `/check/`-like lookups while a writer process inserts statuses, one row per commit
+# as the consumer does, || `--batch` rows per commit as a bulk import does. Each runs in its own process && event loop, so only the DB locks are shared between them,
+# as between `http_server` && another process writing the same DB, || the aiosqlite threads of one process.
+# Compares read latency idle && during a sustained write, with && without `StorageProfile`.
+#
+# usage: python bench-db.py [--seconds 5] [--readers 4] [--batch 1] [--preload 20000] [--dir .]
+import asyncio
+import argparse
+import tempfile
+import statistics
+import time
+import uuid
+from pathlib import Path
+from typing import *
+from concurrent.futures import ProcessPoolExecutor
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from schemas import HttpMessageStatus, HttpMessageStatusBase
+from tools import DB_Client, StorageProfile
+
+
+def percentiles(samples:list)->str:
+    samples = sorted(samples)
+    if not samples:
+        return "no samples"
+    pick = lambda q: samples[min(int(len(samples)*q), len(samples)-1)]*1000
+    return (f"n={len(samples):>6}  p50={pick(0.5):7.2f}ms  p95={pick(0.95):7.2f}ms  "
+            f"p99={pick(0.99):7.2f}ms  max={samples[-1]*1000:7.2f}ms")
+
+
+def p99(samples:list)->float:
+    samples = sorted(samples)
+    return samples[min(int(len(samples)*0.99), len(samples)-1)]
+
+
+def client(db_path:Path, profile:Optional[dict])->DB_Client:
+    return DB_Client(f"sqlite+aiosqlite:///{db_path.as_posix()}", profile=StorageProfile(**profile) if profile is not None else None)
+
+
+async def preload(db_path:Path, profile:Optional[dict], rows:int)->list:
+    db_client = client(db_path, profile)
+    await db_client.migrate()
+    message_ids = [str(uuid.uuid4()) for _ in range(rows)]
+    async with AsyncSession(db_client.adb_engine) as asess:
+        for i, message_id in enumerate(message_ids):
+            status = HttpMessageStatusBase(message_id=message_id, send_to=f"preload-{i}", content="x"*2048, success=True)
+            asess.add(HttpMessageStatus.model_validate(status))
+        await asess.commit()
+    await db_client.dispose()
+    return message_ids
+
+
+def read_process(db_path:Path, profile:Optional[dict], message_ids:list, start_at:float, seconds:float)->list:
+    "lookups by message id from `start_at` for `seconds`, one at a time -> latencies"
+    async def reads():
+        db_client = client(db_path, profile)
+        db_client.migrated = True
+        samples = []
+        #NOTE a connection is opened && warmed before the clock starts
+        _ = [r async for r in db_client.get(HttpMessageStatus, message_id=message_ids[0])]
+        await asyncio.sleep(max(start_at-time.time(), 0))
+        end, i = time.time()+seconds, 0
+        while time.time() < end:
+            start = time.perf_counter()
+            _ = [r async for r in db_client.get(HttpMessageStatus, message_id=message_ids[i % len(message_ids)])]
+            samples.append(time.perf_counter()-start)
+            i += 7919
+        await db_client.dispose()
+        return samples
+    return asyncio.run(reads())
+
+
+def write_process(db_path:Path, profile:Optional[dict], start_at:float, seconds:float, batch:int)->list:
+    "inserts `batch` rows per commit from `start_at` for `seconds` -> latencies per commit"
+    async def writes():
+        db_client = client(db_path, profile)
+        db_client.migrated = True
+        samples = []
+        await asyncio.sleep(max(start_at-time.time(), 0))
+        end, i = time.time()+seconds, 0
+        while time.time() < end:
+            statuses = [
+                HttpMessageStatusBase(message_id=str(uuid.uuid4()), send_to=f"bench-{i+j}", content="x"*2048, success=True)
+                for j in range(batch)]
+            start = time.perf_counter()
+            if batch==1:
+                await db_client.create(statuses[0], HttpMessageStatus)
+            else:
+                async with AsyncSession(db_client.adb_engine) as asess:
+                    asess.add_all(HttpMessageStatus.model_validate(status) for status in statuses)
+                    await asess.commit()
+            samples.append(time.perf_counter()-start)
+            i += batch
+        await db_client.dispose()
+        return samples
+    return asyncio.run(writes())
+
+
+def phase(pool:ProcessPoolExecutor, db_path:Path, profile:Optional[dict], message_ids:list, args, write:bool)->Tuple[list, list]:
+    "readers, && the writer if `write`, started together -> (read latencies, write latencies)"
+    start_at = time.time()+1.0
+    readers = [
+        pool.submit(read_process, db_path, profile, message_ids, start_at, args.seconds)
+        for _ in range(args.readers)]
+    writer = pool.submit(write_process, db_path, profile, start_at, args.seconds, args.batch) if write else None
+    reads = [sample for reader in readers for sample in reader.result()]
+    return reads, writer.result() if writer else []
+
+
+def run(name:str, profile:Optional[StorageProfile], args):
+    db_path = Path(tempfile.mkdtemp(prefix="bench-db", dir=args.dir)) / "store.db"
+    profile = profile.model_dump() if profile is not None else None
+    message_ids = asyncio.run(preload(db_path, profile, args.preload))
+    with ProcessPoolExecutor(max_workers=args.readers+1) as pool:
+        idle, _ = phase(pool, db_path, profile, message_ids, args, write=False)
+        busy, written = phase(pool, db_path, profile, message_ids, args, write=True)
+
+    print(f"[{name}]")
+    print(f"  read  idle   : {percentiles(idle)}")
+    print(f"  read  busy   : {percentiles(busy)}")
+    print(f"  write        : {percentiles(written)}  ({len(written)*args.batch/args.seconds:.0f} rows/s, {args.batch} per commit)")
+    if idle and busy:
+        print(f"  busy/idle    : p50 {statistics.median(busy)/statistics.median(idle):.2f}x, p99 {p99(busy)/p99(idle):.2f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--seconds", type=float, default=5.0, help="seconds each phase runs")
+    parser.add_argument("--readers", type=int, default=4, help="reader processes, one lookup at a time each")
+    parser.add_argument("--batch", type=int, default=1, help="rows per write commit. 1 as the consumer writes, more as a bulk import || archiving")
+    parser.add_argument("--preload", type=int, default=20000, help="rows in DB before benchmark")
+    parser.add_argument("--dir", default=None, help="directory the DB is created in, e.g. on the disk the service uses. Defaults to the system temp dir")
+    args = parser.parse_args()
+
+    run("default sqlite settings", None, args)
+    run("StorageProfile()", StorageProfile(), args)
+
+
+if __name__ == '__main__':
+    main()
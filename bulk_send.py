@@ -0,0 +1,302 @@
+import time
+import uuid
+import string
+import sqlite3
+import threading
+from typing import *
+from pathlib import Path
+from datetime import datetime
+from collections import OrderedDict
+
+from schemas import SendMessage, MessageStateEnum, MessageLifecycle, BulkTemplate, BulkRecipient
+from message_queues import business_label
+
+
+def check_template(template:str):
+    "raise ValueError if `template` isn't a valid template: unbalanced braces, || positional fields nothing fills"
+    for _, field_name, _, _ in string.Formatter().parse(template):
+        if field_name is not None and (field_name=="" or field_name[0].isdigit()):
+            raise ValueError(f"positional field {{{field_name}}} isn't supported, name it after a variable")
+
+
+def render(template:str, variables:dict)->str:
+    """
+    fill `template` with a recipient's variables.
+    Raises whatever `str.format_map` raises for them: KeyError, IndexError, ValueError, AttributeError, TypeError...
+    """
+    return template.format_map(variables)
+
+
+class BatchStore:
+    """
+    Persistent store of template-based bulk sends.
+
+    A batch keeps its template (with the attachment) once && one small row of variables per recipient.
+    Recipients are expanded into `SendMessage` lazily by `claim`, as the consumer has room,
+    so memory && payload grow with the number of recipients rather than recipients × message size.
+    Every recipient gets its own message id, its state is published back by the UI worker.
+
+    Thread safe. Every process opens its own instance.
+    """
+
+    def __init__(self, path:Union[str,Path], busy_timeout:float=5.0, cached_templates:int=32):
+        """
+        Args:
+            path(str|Path): sqlite file. Created if not exists.
+            busy_timeout(float): seconds to wait for the write lock held by other processes.
+            cached_templates(int): parsed templates kept in memory, so expanding a recipient doesn't load its template again.
+        """
+        self.path = Path(path)
+        self.cached_templates = cached_templates
+        self._templates:OrderedDict[str, BulkTemplate] = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            str(self.path), timeout=busy_timeout,
+            isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS batches(
+                batch_id TEXT PRIMARY KEY,
+                template TEXT NOT NULL,
+                caller TEXT NOT NULL DEFAULT '',
+                business TEXT NOT NULL DEFAULT 'none',
+                priority INTEGER NOT NULL,
+                created_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS recipients(
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                batch_id TEXT NOT NULL,
+                message_id TEXT NOT NULL UNIQUE,
+                recipient TEXT NOT NULL,
+                target TEXT NOT NULL DEFAULT '',
+                claimed INTEGER NOT NULL DEFAULT 0,
+                state TEXT NOT NULL,
+                failure_reason TEXT,
+                updated_at REAL NOT NULL
+            );
+        """)
+        self._add_missing_columns()
+        self._conn.executescript("""
+            CREATE INDEX IF NOT EXISTS recipients_batch ON recipients(batch_id, seq);
+            CREATE INDEX IF NOT EXISTS recipients_pending ON recipients(seq) WHERE state='queued' AND claimed=0;
+            CREATE INDEX IF NOT EXISTS recipients_target ON recipients(target) WHERE state='queued';
+            CREATE INDEX IF NOT EXISTS batches_business ON batches(business);
+        """)
+
+    def _add_missing_columns(self):
+        "stores created before `business` && `target` were columns get them, filled from the stored json once"
+        batch_columns = {row[1] for row in self._conn.execute("PRAGMA table_info(batches)")}
+        recipient_columns = {row[1] for row in self._conn.execute("PRAGMA table_info(recipients)")}
+        if "business" in batch_columns and "target" in recipient_columns:
+            return
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            if "business" not in batch_columns:
+                self._conn.execute("ALTER TABLE batches ADD COLUMN business TEXT NOT NULL DEFAULT 'none'")
+                self._conn.executemany("UPDATE batches SET business=? WHERE batch_id=?", [
+                    (business_label(BulkTemplate.model_validate_json(template)), batch_id)
+                    for batch_id, template in self._conn.execute("SELECT batch_id, template FROM batches").fetchall()])
+            if "target" not in recipient_columns:
+                self._conn.execute("ALTER TABLE recipients ADD COLUMN target TEXT NOT NULL DEFAULT ''")
+                self._conn.execute("UPDATE recipients SET target=json_extract(recipient, '$.FromWxid')")
+            self._conn.execute("COMMIT")
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def create(self, template:BulkTemplate, caller:str="")->str:
+        """
+        Returns:
+            out(str): batch id
+        """
+        batch_id = str(uuid.uuid4())
+        priority = template.Priority
+        if priority is None:
+            priority = SendMessage(Business=template.Business).priority
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO batches(batch_id, template, caller, business, priority, created_at) VALUES (?,?,?,?,?,?)",
+                (batch_id, template.model_dump_json(), caller, business_label(template), priority, time.time()))
+        return batch_id
+
+    def add(self, batch_id:str, recipients:List[BulkRecipient])->List[str]:
+        """
+        add recipients to the batch. They're visible to `claim` right away.
+        Returns:
+            out(list[str]): message ids of the recipients
+        """
+        now = time.time()
+        rows = [(batch_id, str(uuid.uuid4()), recipient.model_dump_json(), recipient.FromWxid, MessageStateEnum.queued.value, now)
+                for recipient in recipients]
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany(
+                    "INSERT INTO recipients(batch_id, message_id, recipient, target, state, updated_at) VALUES (?,?,?,?,?,?)", rows)
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return [row[1] for row in rows]
+
+    def claim(self, limit:int=1)->List[Tuple[str, SendMessage]]:
+        """
+        expand at most `limit` unclaimed recipients into messages, batches of higher priority first,
+        then batches created earlier, then recipients in the order they were added.
+        A recipient whose template can't be filled is marked failed && skipped.
+        Returns:
+            out(list[tuple[str, SendMessage]]): batch id && message of every recipient expanded
+        """
+        if limit <= 0:
+            return []
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._conn.execute(
+                    "SELECT r.seq, r.batch_id, r.message_id, r.recipient FROM recipients r JOIN batches b USING(batch_id)"
+                    " WHERE r.state='queued' AND r.claimed=0 ORDER BY b.priority DESC, b.created_at, r.seq LIMIT ?",
+                    (limit,)).fetchall()
+                messages, failures = [], []
+                for seq, batch_id, message_id, recipient in rows:
+                    try:
+                        messages.append((batch_id, self._expand(batch_id, message_id, BulkRecipient.model_validate_json(recipient))))
+                    except Exception as exc:
+                        #NOTE anything a recipient's variables raise fails that recipient alone, never the claim
+                        failures.append((f"template can't be filled: {exc!r}", time.time(), seq))
+                self._conn.executemany("UPDATE recipients SET claimed=1 WHERE seq=?", [(row[0],) for row in rows])
+                self._conn.executemany(
+                    "UPDATE recipients SET state='failed', failure_reason=?, updated_at=? WHERE seq=?", failures)
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return messages
+
+    def _expand(self, batch_id:str, message_id:str, recipient:BulkRecipient)->SendMessage:
+        template = self._template(batch_id)
+        return SendMessage(
+            id=message_id,
+            Business=template.Business,
+            Content=render(template.Template, recipient.Variables),
+            FromWxid=recipient.FromWxid,
+            ActualName=recipient.ActualName,
+            SenderWxid=recipient.SenderWxid,
+            File=template.File, #NOTE the same string object for every recipient, not a copy
+            Filename=template.Filename,
+            Priority=template.Priority,
+            Deadline=template.Deadline,
+            CreatedTime=datetime.now(),
+        )
+
+    def _template(self, batch_id:str)->BulkTemplate:
+        "called with lock held"
+        template = self._templates.get(batch_id)
+        if template is None:
+            row = self._conn.execute("SELECT template FROM batches WHERE batch_id=?", (batch_id,)).fetchone()
+            template = self._templates[batch_id] = BulkTemplate.model_validate_json(row[0])
+            while len(self._templates) > self.cached_templates:
+                self._templates.popitem(last=False)
+        self._templates.move_to_end(batch_id)
+        return template
+
+    def recover(self)->Tuple[int,int]:
+        """
+        call this when the UI worker starts. The same as `DurableQueue.recover`.
+        Returns:
+            out(tuple[int,int]): number of recipients requeued && number of recipients failed
+        """
+        now = time.time()
+        with self._lock:
+            requeued = self._conn.execute(
+                "UPDATE recipients SET claimed=0 WHERE state='queued' AND claimed=1").rowcount
+            failed = self._conn.execute(
+                "UPDATE recipients SET state='failed', failure_reason=?, updated_at=?"
+                " WHERE state NOT IN ('queued', 'sent', 'failed')",
+                ("UI worker restarted while sending, the message may or may not be sent", now)).rowcount
+        return requeued, failed
+
+    def cancel(self, kind:str, value:str, at:float)->Tuple[List[str], List[str]]:
+        """
+        mark recipients not started yet failed. Kinds are those of `CancellationIndex`, plus `batch_id`.
+        Returns:
+            out(tuple[list[str], list[str]]): ids of recipients not expanded yet,
+                && ids already expanded into the UI worker's queue, which need tombstones there
+        """
+        with self._lock:
+            if kind=="batch_id":
+                condition, params = "batch_id=?", (value,)
+            elif kind=="message_id":
+                condition, params = "message_id=?", (value,)
+            elif kind=="target":
+                condition, params = "target=? AND updated_at<=?", (value, at)
+            else:
+                condition, params = "batch_id IN (SELECT batch_id FROM batches WHERE business=?) AND updated_at<=?", (value, at)
+            rows = self._conn.execute(
+                f"SELECT message_id, claimed FROM recipients WHERE state='queued' AND {condition}", params).fetchall()
+            self._conn.execute(
+                f"UPDATE recipients SET state='failed', failure_reason=?, updated_at=? WHERE state='queued' AND {condition}",
+                (f"cancelled by {kind} {value}", time.time())+params)
+        return [i for i, claimed in rows if not claimed], [i for i, claimed in rows if claimed]
+
+    def publish(self, lifecycle:MessageLifecycle):
+        "record lifecycle transition of a recipient. Messages of no batch are ignored"
+        if lifecycle.state==MessageStateEnum.queued:
+            return
+        with self._lock:
+            self._conn.execute(
+                "UPDATE recipients SET state=?, failure_reason=?, updated_at=? WHERE message_id=?",
+                (lifecycle.state.value, lifecycle.failure_reason, time.time(), lifecycle.message_id))
+
+    def pending(self)->int:
+        "number of recipients not expanded yet"
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM recipients WHERE state='queued' AND claimed=0").fetchone()[0]
+
+    def summary(self, batch_id:str)->Optional[dict]:
+        "number of recipients by state, None if the batch doesn't exist"
+        with self._lock:
+            batch = self._conn.execute(
+                "SELECT caller, priority, created_at FROM batches WHERE batch_id=?", (batch_id,)).fetchone()
+            if batch is None:
+                return None
+            counts = self._conn.execute(
+                "SELECT state, COUNT(*) FROM recipients WHERE batch_id=? GROUP BY state", (batch_id,)).fetchall()
+        return dict(
+            batch_id=batch_id,
+            caller=batch[0],
+            priority=batch[1],
+            created_time=datetime.fromtimestamp(batch[2]).isoformat(),
+            total=sum(count for _, count in counts),
+            states=dict(counts),
+        )
+
+    def recipients(self, batch_id:str, offset:int=0, limit:int=100)->List[dict]:
+        "per-recipient status of the batch, in the order they were added"
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT message_id, target, state, failure_reason FROM recipients WHERE batch_id=?"
+                " ORDER BY seq LIMIT ? OFFSET ?", (batch_id, limit, offset)).fetchall()
+        return [
+            dict(message_id=message_id, send_to=target, state=state, failure_reason=failure_reason)
+            for message_id, target, state, failure_reason in rows
+        ]
+
+    def lifecycles(self, message_ids:Iterable[str])->dict[str, MessageLifecycle]:
+        "lifecycles of the recipients among `message_ids`, by message id"
+        message_ids = list(message_ids)
+        if not message_ids:
+            return dict()
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT message_id, state, failure_reason FROM recipients WHERE message_id IN ({','.join('?'*len(message_ids))})",
+                message_ids).fetchall()
+        return {
+            message_id: MessageLifecycle(message_id=message_id, state=state, failure_reason=failure_reason)
+            for message_id, state, failure_reason in rows
+        }
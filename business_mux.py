@@ -0,0 +1,198 @@
+# functions conclusion:
+# one runner for several 4a businesses at once: their message streams are merged into the one UI actor,
+# sharing it by weight (stride scheduling), with per-business throughput && backlog reporting.
+import time
+import asyncio
+import traceback
+from typing import *
+
+from schemas import SendMessage
+from logg import logger
+from oa_client import OAClient, UIActor
+
+
+def parse_weights(spec:str)->Dict[str, float]:
+    """
+    parse `business:weight` pairs separated by commas, e.g. `信控停机预警:3,低质专线预警:1`.
+    Returns:
+        out(dict[str, float]): weight by business
+    """
+    weights = dict()
+    for pair in spec.replace("，", ",").split(","):
+        if not pair.strip():
+            continue
+        business, _, weight = pair.rpartition(":")
+        if not business or float(weight) <= 0:
+            raise ValueError(f"invalid business weight: {pair!r}")
+        weights[business.strip()] = float(weight)
+    return weights
+
+
+class _Lane:
+    "one business: its prefetched messages, its place in the schedule && its counters"
+
+    def __init__(self, business:str, weight:float, prefetch:int):
+        self.business = business
+        self.weight = weight
+        self.queue:asyncio.Queue[SendMessage] = asyncio.Queue(maxsize=prefetch)
+        self.passes = 0.0
+        "virtual time this business has been served up to. The lane with the lowest goes next"
+        self.done = False
+        self.error:Optional[str] = None
+        self.received = 0
+        self.dispatched = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.started_at = time.monotonic()
+        self.last_result_at:Optional[float] = None
+
+    @property
+    def finished(self)->bool:
+        "no more messages from the server, && every one fetched has been sent"
+        return self.done and self.queue.empty() and self.dispatched==self.succeeded+self.failed
+
+
+class BusinessMux:
+    """
+    Merges the message streams of several businesses into one `UIActor`.
+
+    Each business is fetched by its own task into a small buffer (`prefetch` messages), so a busy business
+    can't starve the others of fetching, && a business whose buffer is full stops being fetched.
+    The UI is shared by stride scheduling: every message dispatched advances its business by `1/weight`,
+    && the business with the least advance goes next. Over any busy stretch, businesses get UI time
+    in proportion to their weights; a business idle for a while rejoins at the current virtual time,
+    so it doesn't get a burst to make up for it.
+
+    A stream failing (server errors past retries) ends that business only, the others go on.
+    """
+
+    def __init__(
+            self,
+            client:OAClient,
+            actor:UIActor,
+            weights:Dict[str, float],
+            prefetch:int=2,
+            report_interval:float=60.0):
+        """
+        Args:
+            client(OAClient): entered client, shared by every business.
+            actor(UIActor): entered actor. Its `on_result` should be `BusinessMux.on_result`.
+            weights(dict[str, float]): weight by business, every one of them is fetched.
+            prefetch(int): messages buffered per business at most.
+            report_interval(float): seconds between progress reports, 0 for none.
+        """
+        self.client = client
+        self.actor = actor
+        self.lanes = {business: _Lane(business, weight, prefetch) for business, weight in weights.items()}
+        self.report_interval = report_interval
+        self.vtime = 0.0
+        self._ready = asyncio.Event()
+        self._business_of:dict[str, str] = dict()
+        "business of the messages handed to the actor, by uid"
+
+    def on_result(self, message:SendMessage, succeeded:bool):
+        "count the result against its business. Pass it to `UIActor(on_result=...)`"
+        lane = self.lanes.get(self._business_of.pop(str(message.id), None))
+        if lane is None:
+            return
+        if succeeded:
+            lane.succeeded += 1
+        else:
+            lane.failed += 1
+        lane.last_result_at = time.monotonic()
+
+    async def _fetch(self, lane:_Lane):
+        try:
+            async for message in self.client.messages(lane.business, service=self.actor.service_estimator):
+                lane.received += 1
+                logger.info(f"[{lane.business}] message received:\nsend to {message.FromWxid}\nbrief content :{(message.Content or '')[:50]}")
+                await lane.queue.put(message)
+                self._ready.set()
+        except Exception as exc:
+            lane.error = f"{type(exc).__name__}: {exc}"
+            logger.error(f"[business mux] {lane.business} stream failed: {traceback.format_exc()}")
+        finally:
+            lane.done = True
+            self._ready.set()
+
+    def _next_lane(self)->Optional[_Lane]:
+        "the lane with messages && the least virtual time, None if every lane is empty"
+        chosen, chosen_passes = None, None
+        for lane in self.lanes.values():
+            if lane.queue.empty():
+                continue
+            #NOTE a lane that was idle rejoins at the current virtual time, its idle time isn't credited
+            passes = max(lane.passes, self.vtime)
+            if chosen is None or passes < chosen_passes:
+                chosen, chosen_passes = lane, passes
+        if chosen is not None:
+            self.vtime = chosen_passes
+            chosen.passes = chosen_passes + 1.0/chosen.weight
+        return chosen
+
+    async def _dispatch(self):
+        while True:
+            #NOTE cleared before looking, so a message put meanwhile sets it again && isn't missed
+            self._ready.clear()
+            lane = self._next_lane()
+            if lane is None:
+                if all(lane.done for lane in self.lanes.values()):
+                    return
+                await self._ready.wait()
+                continue
+            message = lane.queue.get_nowait()
+            self._business_of[str(message.id)] = lane.business
+            lane.dispatched += 1
+            await self.actor.put(message)
+
+    async def _report_periodically(self):
+        while True:
+            await asyncio.sleep(self.report_interval)
+            self.log_report()
+
+    async def run(self):
+        "fetch && dispatch till every business has no more messages"
+        fetchers = [asyncio.create_task(self._fetch(lane)) for lane in self.lanes.values()]
+        reporter = asyncio.create_task(self._report_periodically()) if self.report_interval>0 else None
+        try:
+            await self._dispatch()
+        finally:
+            for task in fetchers + ([reporter] if reporter else []):
+                task.cancel()
+            await asyncio.gather(*fetchers, *([reporter] if reporter else []), return_exceptions=True)
+
+    def report(self)->List[dict]:
+        """
+        per-business progress.
+        Returns:
+            out(list[dict]): one dict per business: weight, received, dispatched, succeeded, failed,
+                backlog (prefetched, not yet handed to the UI), share (of messages dispatched),
+                per_hour (succeeded per hour), finished, error
+        """
+        total = sum(lane.dispatched for lane in self.lanes.values()) or 1
+        now = time.monotonic()
+        rows = []
+        for lane in self.lanes.values():
+            elapsed = max(((lane.last_result_at or now) if lane.finished else now) - lane.started_at, 1e-6)
+            rows.append(dict(
+                business=lane.business,
+                weight=lane.weight,
+                received=lane.received,
+                dispatched=lane.dispatched,
+                succeeded=lane.succeeded,
+                failed=lane.failed,
+                backlog=lane.queue.qsize(),
+                share=round(lane.dispatched/total, 3),
+                per_hour=round(lane.succeeded/elapsed*3600, 1),
+                finished=lane.finished,
+                error=lane.error,
+            ))
+        return rows
+
+    def log_report(self):
+        lines = [
+            f"{row['business']}: 权重 {row['weight']:g}，已接收 {row['received']}，已发送 {row['succeeded']}，"
+            f"失败 {row['failed']}，待发送 {row['backlog']}，占比 {row['share']:.0%}，"
+            f"每小时 {row['per_hour']:g} 条{'，已结束' if row['finished'] else ''}{'，出错: '+row['error'] if row['error'] else ''}"
+            for row in self.report()]
+        logger.info("[业务进度]\n" + "\n".join(lines))
@@ -0,0 +1,83 @@
+import time
+import threading
+from typing import *
+
+from schemas import SendMessage
+from message_queues import business_label
+
+
+CancelKind = Literal["message_id", "business", "target"]
+
+
+def tombstone_matches(kind:CancelKind, value:str, at:float, message:SendMessage)->bool:
+    "whether the tombstone cancels `message`. Used by stores cancelling messages they hold"
+    if kind=="message_id":
+        return str(message.id)==value
+    created = message.CreatedTime.timestamp() if message.CreatedTime else 0.0
+    if created > at:
+        return False
+    if kind=="business":
+        return business_label(message)==value
+    return message.FromWxid==value
+
+
+class CancellationIndex:
+    """
+    Tombstones of cancelled messages, checked by the consumer before sending.
+
+    - by message id: that message;
+    - by business (`BusinessesEnum` name) || target (`FromWxid`): every message of it created before the cancellation,
+      so messages received afterwards go through as usual.
+
+    Cancelling && checking are both O(1), the queue is never scanned:
+    cancelled messages stay where they are && the consumer drops them when it gets to them.
+
+    Thread safe.
+    """
+
+    def __init__(self, ttl:float=86400.0):
+        """
+        Args:
+            ttl(float): seconds tombstones are kept. Should be longer than messages may wait in queue.
+        """
+        self.ttl = ttl
+        self._tombstones:dict[CancelKind, dict[str, float]] = dict(message_id=dict(), business=dict(), target=dict())
+        self._lock = threading.Lock()
+        self.skipped = 0
+        "messages dropped by the consumer"
+
+    def cancel(self, kind:CancelKind, value:str, at:Optional[float]=None):
+        "tombstone `value` of `kind`. Messages created before `at`(unix timestamp, defaults to now) are cancelled"
+        self.purge()
+        with self._lock:
+            self._tombstones[kind][value] = time.time() if at is None else at
+
+    def is_cancelled(self, message:SendMessage)->Optional[str]:
+        """
+        Returns:
+            out(str|None): why the message is cancelled, None if it's not
+        """
+        with self._lock:
+            if str(message.id) in self._tombstones["message_id"]:
+                return "cancelled by message id"
+            created = message.CreatedTime.timestamp() if message.CreatedTime else 0.0
+            for kind, value in (("business", business_label(message)), ("target", message.FromWxid)):
+                cancelled_at = self._tombstones[kind].get(value)
+                if cancelled_at is not None and created <= cancelled_at:
+                    return f"cancelled by {kind} {value}"
+        return None
+
+    def purge(self):
+        "drop tombstones older than `ttl`"
+        expired_before = time.time()-self.ttl
+        with self._lock:
+            for tombstones in self._tombstones.values():
+                for value in [value for value, at in tombstones.items() if at < expired_before]:
+                    del tombstones[value]
+
+    def stats(self)->dict:
+        with self._lock:
+            return dict(
+                tombstones={kind: len(tombstones) for kind, tombstones in self._tombstones.items()},
+                skipped=self.skipped,
+            )
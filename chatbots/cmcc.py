@@ -23,6 +23,7 @@ from .tools import (
     get_file_chosen_block,
 )
 from logg import logger
+from metrics import stage_timing
 
 class CmccChatClient(ChatBotClientBase):
     description = "移动办公desktop chatbot"
@@ -211,6 +212,7 @@ class CmccChatClient(ChatBotClientBase):
 
 
     # @time_consume
+    @stage_timing("switch")
     def switch_session(self, session_name:str,**kwargs):
         """
         switch the window to the foreground, search and switch to the session if get None in session_map.
@@ -231,8 +233,7 @@ class CmccChatClient(ChatBotClientBase):
         if top_bar_name:
             #NOTE if top_bar_name is provided, we will retry 3 times if switched topbar_name != top_bar_name
             retries=kwargs.pop("retries",3)
-            top_bar_name = (top_bar_name.replace('\u3000','').replace("\xa0","")
-                            .replace("\ufeff","").replace(" ","").strip())
+            top_bar_name = self._clean_name(top_bar_name)
         else:
             retries=1
         while retries!=0:
@@ -261,6 +262,39 @@ class CmccChatClient(ChatBotClientBase):
             retries-=1
 
 
+    @staticmethod
+    def _clean_name(name:str)->str:
+        return (name.replace('\u3000','').replace("\xa0","")
+                .replace("\ufeff","").replace(" ","").strip())
+
+    def is_current_session(self, top_bar_name:str|None)->bool:
+        """
+        whether the session open is `top_bar_name`, reading the topbar only. No click, no refresh.
+        False if top_bar_name is not provided || the chat interface can't be read.
+        """
+        if not top_bar_name:
+            return False
+        try:
+            current_topbar_name=self.get_chat_interface.top_bar.TextControl().Name
+        except Exception as exc:
+            logger.debug(f"[is_current_session] reading topbar failed: {exc!r}")
+            return False
+        return current_topbar_name==self._clean_name(top_bar_name)
+
+    def _ensure_session(self, session_name:str, kwargs:dict):
+        """
+        pop the switch kwargs of `send_message` && `send_file_logic`, && switch to the session.
+        With `assume_current`, the switch is skipped if the topbar already shows top_bar_name.
+        """
+        top_bar_name=kwargs.pop("top_bar_name",None)
+        retries=kwargs.pop("retries",3)
+        ignore_error=kwargs.pop("ignore_error", False)
+        if kwargs.pop("assume_current", False) and self.is_current_session(top_bar_name):
+            logger.debug(f"[switch skipped] {top_bar_name} already open")
+            return
+        self.switch_session(session_name, top_bar_name=top_bar_name, retries=retries, ignore_error=ignore_error)
+
+
     # @time_consume
     def get_session_history_msgs(self,only_last_msg:bool=True)->List[HistoryMessage]:
         """get session chat history.
@@ -376,43 +410,44 @@ class CmccChatClient(ChatBotClientBase):
 
             ignore_error(bool): ignore error if topbar name is still not top_bar_name after exceeding swtich retries.\
             default to False
+
+            assume_current(bool): the caller has the session open already, e.g. it sent the last message to it.\
+            Only the topbar is checked against top_bar_name, && the session is switched to only if it differs.\
+            default to False
         """
 
         if not check_is_foreground(self.root_control):
             switch_to_foreground(self.root_control)
 
-        self.switch_session(session_name,
-                            top_bar_name=kwargs.pop("top_bar_name",None),
-                            retries=kwargs.pop("retries",3),
-                            ignore_error=kwargs.pop("ignore_error", False),
-                            )
+        self._ensure_session(session_name, kwargs)
         chat_interface = self.get_chat_interface
 
         edit_block = chat_interface.edit_block
         edit_text_block:uia.TextControl=edit_block.text_edit_block
-        edit_text_block.Click(waitTime=0)
-        #XXX necessary to backspace all content before sending message
-        edit_text_block.SendKeys("{Ctrl}a{BACK}",waitTime=0)
-        #XXX at_list type first if not empty
-        if at_list:
-            only_at_all="*" in at_list
-            if only_at_all:
-                edit_text_block.SendKeys(f"@全体成员",waitTime=0)
-                edit_text_block.SendKeys("{Enter}",waitTime=0)
-            else: #NOTE if at all; ignore any other at
-                for member in at_list:
-                    edit_text_block.SendKeys(f"@{member}",waitTime=0)
+        with stage_timing("paste"):
+            edit_text_block.Click(waitTime=0)
+            #XXX necessary to backspace all content before sending message
+            edit_text_block.SendKeys("{Ctrl}a{BACK}",waitTime=0)
+            #XXX at_list type first if not empty
+            if at_list:
+                only_at_all="*" in at_list
+                if only_at_all:
+                    edit_text_block.SendKeys(f"@全体成员",waitTime=0)
                     edit_text_block.SendKeys("{Enter}",waitTime=0)
-                # _at = self.get_at_control_list
-        if not from_clipboard:
-            # NOTE Name has no setterz
-            # edit_block.text_edit_block.Name = msg
-            edit_text_block.SendKeys(message,waitTime=0)
-        else:
-            uia.SetClipboardText(message)
-            edit_text_block.SendKeys("{Ctrl}v",waitTime=0)
+                else: #NOTE if at all; ignore any other at
+                    for member in at_list:
+                        edit_text_block.SendKeys(f"@{member}",waitTime=0)
+                        edit_text_block.SendKeys("{Enter}",waitTime=0)
+                    # _at = self.get_at_control_list
+            if not from_clipboard:
+                # NOTE Name has no setterz
+                # edit_block.text_edit_block.Name = msg
+                edit_text_block.SendKeys(message,waitTime=0)
+            else:
+                uia.SetClipboardText(message)
+                edit_text_block.SendKeys("{Ctrl}v",waitTime=0)
 
-        edit_text_block.SendKeys("{Enter}",waitTime=0)
+            edit_text_block.SendKeys("{Enter}",waitTime=0)
 
     def send_file(self, session_name, filepath, **kwargs):
         """
@@ -429,6 +464,8 @@ class CmccChatClient(ChatBotClientBase):
 
             ignore_error(bool): ignore error if topbar name is still not top_bar_name after exceeding swtich retries.\
             default to False
+
+            assume_current(bool): only check the topbar, switch to the session if it differs. See `send_message`.
         """
         return super().send_file(session_name, filepath, **kwargs)
 
@@ -439,12 +476,7 @@ class CmccChatClient(ChatBotClientBase):
             **kwargs
         ):
         try:
-            self.switch_session(
-                session_name,
-                top_bar_name=kwargs.pop("top_bar_name",None),
-                retries=kwargs.pop("retries",3),
-                ignore_error=kwargs.pop("ignore_error", False),
-            )
+            self._ensure_session(session_name, kwargs)
             chat_interface = self.get_chat_interface
             file_transfer_btn=chat_interface.edit_block.file_transfer_btn
             file_transfer_btn.Click(waitTime=0)
@@ -479,6 +511,7 @@ class CmccChatClient(ChatBotClientBase):
             return True
     
 
+    @stage_timing("search")
     def search(self, search_keywords:str):
 
         #NOTE sometimes `search_keywords` contains special invisible characters: \ufeff, \xa0, \u3000. Replace needed
@@ -643,6 +676,7 @@ class CmccChatClient(ChatBotClientBase):
         return at_control_list
 
 
+    @stage_timing("refresh")
     def __refresh_ctrls(self):
         """
         refresh all controls. Sleep `self.wait_before_refresh` before refresh.
@@ -0,0 +1,264 @@
+import time
+from typing import *
+
+from logg import logger
+from metrics import stage_timing, SEND_RETRIES
+from schemas import SendMessage
+
+
+def normalize(text:Optional[str])->str:
+    "text without whitespace, as pasting && rendering may change line breaks"
+    return "".join((text or "").split())
+
+
+def entry_key(history_message)->tuple:
+    "what tells history entries apart, to find an entry again in a later read"
+    return (getattr(history_message, "member_name", None), history_message.message_type,
+            history_message.message, history_message.filename)
+
+
+class Baseline(NamedTuple):
+    "a session's history as last read: sends after it show after its last entry"
+    count:int
+    "entries shown"
+    last:Optional[tuple]
+    "`entry_key` of the newest entry, None if there's none"
+
+    @classmethod
+    def of(cls, history:list)->"Baseline":
+        return cls(len(history), entry_key(history[-1]) if history else None)
+
+    def start(self, history:list)->int:
+        "index of the first entry of `history` newer than the baseline"
+        if self.last is None:
+            return 0
+        if len(history) >= self.count and entry_key(history[self.count-1]) == self.last:
+            return self.count
+        #NOTE the history shown scrolled: the baseline entry moved up, || out of sight if it's not found
+        for index in range(min(self.count, len(history))-1, -1, -1):
+            if entry_key(history[index]) == self.last:
+                return index+1
+        return 0
+
+
+class PendingSend:
+    "one part(text || file) of a message, sent without waiting for confirmation"
+
+    def __init__(
+            self, message:SendMessage, kind:Literal["text","file"], content:str, session_name:str,
+            top_bar_name:Optional[str], baseline:Optional[Baseline]=None):
+        self.message = message
+        self.kind = kind
+        self.content = content
+        "text sent, || name of the file sent"
+        self.session_name = session_name
+        self.top_bar_name = top_bar_name
+        self.baseline = baseline
+        "history of the session before it was sent. Only entries after it can confirm the send"
+        self.sends = 1
+        self.checked_at = time.monotonic()
+        "when it was last sent || found neither sent nor failed"
+        self.checks = 0
+        "verification passes that found it neither sent nor failed"
+
+    def matches(self, history_message)->bool:
+        if self.kind=="file":
+            return history_message.message_type=="file" and history_message.filename==self.content
+        #NOTE contained, not equal: the history may show the text with @ mentions
+        return bool(history_message.message) and normalize(self.content) in normalize(history_message.message)
+
+
+class DeliveryVerifier:
+    """
+    Deferred, batched delivery confirmation of messages sent in burst.
+
+    `send_stable` waits on every message till the session history shows it sent, refreshing the history
+    several times. In burst, parts of a message are sent without waiting && `record`ed here instead.
+    `verify` then switches to each session with sends pending && reads its history once, matching the sends
+    to the history entries newer than the session's history before they were sent, by content, newest first:
+    - shown sent(`read_already` set): delivered;
+    - shown failed(`send_failure`): handed back to send again, `max_resends` times at most;
+    - still sending, || not shown: checked again by the next pass, `max_checks` passes at most, then failed
+      without sending again, as it may have gone through.
+    Sends of a session whose history can't be read are left as they are for the next pass, no check counted.
+    A message is done when all its parts are: delivered if they all are, failed otherwise.
+
+    The history before the sends is what `verify` last read of the session, || what `watch` was given
+    for a session not verified yet. Without either, a send may match an older entry of the same content.
+
+    Not thread safe: the UI thread sends && verifies.
+    """
+
+    def __init__(
+            self,
+            chatbot_client,
+            batch_sessions:int=20,
+            max_delay:float=60.0,
+            min_age:float=3.0,
+            max_checks:int=3,
+            max_resends:int=2):
+        """
+        Args:
+            chatbot_client(ChatBotClientBase): client the messages are sent through.
+            batch_sessions(int): sessions with sends pending that make a verification pass `due`.
+            max_delay(float): seconds the oldest send pending waits at most before a pass is `due`, for slow streams.
+            min_age(float): seconds after sending before a send is verified, as `WAIT_BEFORE_REFRESH` of `send_stable`.
+            max_checks(int): passes a send is checked by while it's neither sent nor failed.
+            max_resends(int): times a failed part is sent again at most.
+        """
+        self.chatbot_client = chatbot_client
+        self.batch_sessions = batch_sessions
+        self.max_delay = max_delay
+        self.min_age = min_age
+        self.max_checks = max_checks
+        self.max_resends = max_resends
+        self._pending:dict[str, List[PendingSend]] = dict()
+        "sends pending by session, in the order sent"
+        self._parts:dict[str, int] = dict()
+        "parts of a message not verified yet, by uid"
+        self._failures:dict[str, str] = dict()
+        "reason a part of the message failed, by uid"
+        self._oldest:Optional[float] = None
+        "when the oldest send pending was recorded"
+        self._baselines:dict[str, Baseline] = dict()
+        "history of each session as last read"
+        self.recorded = 0
+        self.delivered = 0
+        self.failed = 0
+        self.resent = 0
+        self.unconfirmed = 0
+        self.passes = 0
+        self.history_reads = 0
+
+    def knows(self, session_name:str)->bool:
+        "whether the history of the session before the next send is known"
+        return session_name in self._baselines
+
+    def watch(self, session_name:str, history:list):
+        "the history of the session, read before sending to it"
+        self._baselines[session_name] = Baseline.of(history)
+
+    def record(self, message:SendMessage, kind:Literal["text","file"], content:str, session_name:str, top_bar_name:Optional[str]=None):
+        "a part of the message was sent, verify it later"
+        self._pending.setdefault(session_name, []).append(
+            PendingSend(message, kind, content, session_name, top_bar_name, self._baselines.get(session_name)))
+        if self._oldest is None:
+            self._oldest = time.monotonic()
+        self._parts[str(message.id)] = self._parts.get(str(message.id), 0) + 1
+        self.recorded += 1
+
+    def resent_part(self, part:PendingSend):
+        "a part handed back by `verify` was sent again, verify it again"
+        part.checked_at = time.monotonic()
+        part.sends += 1
+        part.checks = 0
+        self._pending.setdefault(part.session_name, []).append(part)
+        if self._oldest is None:
+            self._oldest = part.checked_at
+        self.resent += 1
+
+    def give_up(self, part:PendingSend, reason:str)->Optional[Tuple[SendMessage, Optional[str]]]:
+        "a part handed back by `verify` couldn't be sent again. Returns the message if it's done, as `verify`"
+        return self._resolve(part, reason)
+
+    def pending(self)->int:
+        "messages sent && not verified yet"
+        return len(self._parts)
+
+    def __contains__(self, uid:str)->bool:
+        "whether the message is sent && waiting for verification"
+        return uid in self._parts
+
+    def due(self)->bool:
+        "whether enough sessions have sends pending, || the oldest has waited long enough"
+        if not self._pending:
+            return False
+        return len(self._pending) >= self.batch_sessions or time.monotonic()-self._oldest >= self.max_delay
+
+    def _resolve(self, part:PendingSend, failure:Optional[str]=None)->Optional[Tuple[SendMessage, Optional[str]]]:
+        "a part is done. Returns the message && its failure reason if it's the last part, None otherwise"
+        uid = str(part.message.id)
+        if failure:
+            self._failures.setdefault(uid, failure)
+        self._parts[uid] -= 1
+        if self._parts[uid] > 0:
+            return None
+        del self._parts[uid]
+        failure = self._failures.pop(uid, None)
+        if failure:
+            self.failed += 1
+        else:
+            self.delivered += 1
+        return part.message, failure
+
+    def verify(self, wait:bool=False)->Tuple[List[Tuple[SendMessage, Optional[str]]], List[PendingSend]]:
+        """
+        one verification pass over the sessions with sends old enough.
+        Args:
+            wait(bool): wait for the sends younger than `min_age` && verify them too, e.g. at the end of a run.
+        Returns:
+            out(tuple[list[tuple[SendMessage, str|None]], list[PendingSend]]):
+            - tuple[0], messages done, with their failure reason, None if delivered;
+            - tuple[1], parts shown failed, to send again && report by `resent_part` || `give_up`.
+        """
+        if wait and self._pending:
+            latest = max(part.checked_at for parts in self._pending.values() for part in parts)
+            time.sleep(max(self.min_age-(time.monotonic()-latest), 0))
+        self.passes += 1
+        done, resend = [], []
+        now = time.monotonic()
+        for session_name in list(self._pending):
+            parts = self._pending[session_name]
+            if now-max(part.checked_at for part in parts) < self.min_age:
+                #NOTE a send of the session may be still sending, check it next pass
+                continue
+            try:
+                self.chatbot_client.switch_session(session_name, top_bar_name=parts[-1].top_bar_name, retries=2, ignore_error=False)
+                with stage_timing("confirm"):
+                    history = self.chatbot_client.get_session_history_msgs(only_last_msg=False)
+                self.history_reads += 1
+                self._baselines[session_name] = Baseline.of(history)
+            except Exception as exc:
+                #NOTE nothing was checked: the parts stay pending as they are
+                logger.warning(f"[发送确认] 读取会话 {session_name} 历史消息失败，下轮重试: {exc}")
+                continue
+            del self._pending[session_name]
+            matched = set()
+            still_pending = []
+            for part in reversed(parts):
+                start = part.baseline.start(history) if part.baseline else 0
+                index = next(
+                    (index for index in range(len(history)-1, start-1, -1)
+                     if index not in matched and part.matches(history[index])),
+                    None)
+                if index is not None:
+                    matched.add(index)
+                    shown = history[index]
+                    if shown.send_failure:
+                        if part.sends <= self.max_resends:
+                            SEND_RETRIES.inc()
+                            resend.append(part)
+                        else:
+                            done.append(self._resolve(part, f"发送失败，已重发{part.sends-1}次"))
+                        continue
+                    if shown.read_already is not None:
+                        done.append(self._resolve(part))
+                        continue
+                part.checks += 1
+                if part.checks >= self.max_checks:
+                    #NOTE not shown failed, may have gone through: not sent again
+                    self.unconfirmed += 1
+                    done.append(self._resolve(part, "发送状态未确认"))
+                else:
+                    part.checked_at = time.monotonic()
+                    still_pending.append(part)
+            if still_pending:
+                self._pending[session_name] = list(reversed(still_pending))
+        resend.reverse()
+        self._oldest = min((part.checked_at for parts in self._pending.values() for part in parts), default=None)
+        return [result for result in done if result is not None], resend
+
+    def stats(self)->dict:
+        return dict(
+            recorded=self.recorded, pending=self.pending(), delivered=self.delivered, failed=self.failed,
+            resent=self.resent, unconfirmed=self.unconfirmed, passes=self.passes, history_reads=self.history_reads)
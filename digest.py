@@ -0,0 +1,66 @@
+from typing import *
+from datetime import datetime
+
+from schemas import SendMessage
+
+
+def digest_key(message:SendMessage)->Optional[tuple]:
+    """
+    messages of the same key can be merged into one digest: same target, business && @ list.
+    None if the message can't be merged: it has a file, or no text.
+    """
+    if message.File or not message.Content:
+        return None
+    return (message.FromWxid, message.Business, message.SenderWxid or "")
+
+
+def created_timestamp(message:SendMessage)->float:
+    return (message.CreatedTime or datetime.now()).timestamp()
+
+
+class DigestSelector:
+    """
+    picks messages to merge into the digest of `primary`.
+    Call `accepts` on candidates in queue order: it's stateful, every accepted message counts toward the caps.
+    """
+
+    def __init__(self, primary:SendMessage, window:float, max_messages:int=10, max_chars:int=2000):
+        """
+        Args:
+            primary(SendMessage): the message taken by the consumer.
+            window(float): seconds between `CreatedTime` of the primary && a merged message at most.
+            max_messages(int): messages in one digest at most, including the primary.
+            max_chars(int): length of the rendered digest at most.
+        """
+        self.key = digest_key(primary)
+        self.created = created_timestamp(primary)
+        self.window = window
+        self.max_messages = max_messages
+        self.max_chars = max_chars
+        self.accepted = [primary]
+        self.chars = len(render_digest(self.accepted))
+
+    @property
+    def full(self)->bool:
+        return len(self.accepted) >= self.max_messages
+
+    def accepts(self, message:SendMessage)->bool:
+        if self.key is None or self.full or digest_key(message)!=self.key:
+            return False
+        if abs(created_timestamp(message)-self.created) > self.window:
+            return False
+        chars = len(render_digest(self.accepted+[message]))
+        if chars > self.max_chars:
+            return False
+        self.accepted.append(message)
+        self.chars = chars
+        return True
+
+
+def render_digest(messages:List[SendMessage])->str:
+    "one message as is; several numbered, under a header of their business"
+    if len(messages)==1:
+        return messages[0].Content
+    business = messages[0].Business
+    header = f"【{business.value if business else '消息汇总'}】共{len(messages)}条"
+    return "\n".join([header]+[f"{i}. {message.Content}" for i, message in enumerate(messages, 1)])
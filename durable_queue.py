@@ -0,0 +1,351 @@
+import json
+import time
+import sqlite3
+import threading
+from typing import *
+from pathlib import Path
+from datetime import datetime, timedelta
+
+from schemas import SendMessage, MessageStateEnum, MessageLifecycle
+from message_queues import business_label
+
+
+class DurableQueue:
+    """
+    sqlite-backed message queue shared by processes on the same host.
+
+    Used when http_server runs with several uvicorn workers (`DEPLOY_MODE=split`):
+    API workers `put` messages, the single UI worker `claim`s them earliest-deadline-first,
+    && publishes lifecycle transitions && its stats back, which API workers read to answer `/check/`.
+
+    Every row is one message, it stays in the table after finished (without its payload)
+    until `purge_finished`, so `/check/` keeps working across processes.
+
+    Messages are ordered by effective deadline, then priority, then arrival, the same as `PriorityMessageQueue`.
+
+    Thread safe. Every process opens its own instance.
+    """
+
+    def __init__(self, path:Union[str,Path], busy_timeout:float=5.0):
+        """
+        Args:
+            path(str|Path): sqlite file. Created if not exists.
+            busy_timeout(float): seconds to wait for the write lock held by other processes.
+        """
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            str(self.path), timeout=busy_timeout,
+            isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(f"PRAGMA busy_timeout={int(busy_timeout*1000)}")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS queue(
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                message_id TEXT NOT NULL UNIQUE,
+                payload TEXT NOT NULL,
+                caller TEXT NOT NULL DEFAULT '',
+                idempotency_key TEXT,
+                target TEXT NOT NULL DEFAULT '',
+                business TEXT NOT NULL DEFAULT 'none',
+                deadline REAL NOT NULL,
+                priority INTEGER NOT NULL,
+                enqueued_at REAL NOT NULL,
+                claimed INTEGER NOT NULL DEFAULT 0,
+                state TEXT NOT NULL,
+                timestamps TEXT NOT NULL DEFAULT '{}',
+                failure_reason TEXT,
+                updated_at REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS queue_pending ON queue(deadline, priority DESC, seq) WHERE state='queued';
+            CREATE INDEX IF NOT EXISTS queue_caller ON queue(caller) WHERE state='queued';
+            CREATE INDEX IF NOT EXISTS queue_idempotency ON queue(idempotency_key) WHERE idempotency_key IS NOT NULL;
+            CREATE INDEX IF NOT EXISTS queue_finished ON queue(updated_at) WHERE state IN ('sent', 'failed');
+            CREATE TABLE IF NOT EXISTS cancellations(
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                kind TEXT NOT NULL,
+                value TEXT NOT NULL,
+                cancelled_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS worker_stats(
+                name TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            );
+        """)
+        self._add_missing_columns()
+        self._conn.executescript("""
+            CREATE INDEX IF NOT EXISTS queue_target ON queue(target) WHERE state='queued';
+            CREATE INDEX IF NOT EXISTS queue_business ON queue(business) WHERE state='queued';
+        """)
+
+    def _add_missing_columns(self):
+        "queues created before `target` && `business` were columns get them, filled from payloads of queued messages once"
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(queue)")}
+        if "business" in columns:
+            return
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._conn.execute("ALTER TABLE queue ADD COLUMN target TEXT NOT NULL DEFAULT ''")
+            self._conn.execute("ALTER TABLE queue ADD COLUMN business TEXT NOT NULL DEFAULT 'none'")
+            #NOTE both are only looked up among queued messages
+            rows = self._conn.execute("SELECT seq, payload FROM queue WHERE state='queued'").fetchall()
+            self._conn.executemany(
+                "UPDATE queue SET target=?, business=? WHERE seq=?",
+                [(message.FromWxid, business_label(message), seq)
+                 for seq, message in ((seq, SendMessage.model_validate_json(payload)) for seq, payload in rows)])
+            self._conn.execute("COMMIT")
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def put(
+            self,
+            message:SendMessage,
+            deadline:float,
+            caller:str="",
+            idempotency_window:float=0)->Optional[str]:
+        """
+        enqueue `message`, ordered by `deadline` in unix timestamp.
+        If `message.IdempotencyKey` was enqueued within `idempotency_window` seconds, nothing is enqueued.
+        Returns:
+            out(str|None): id of the message enqueued with the same key before, None if enqueued.
+        """
+        now = time.time()
+        message_id = str(message.id)
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                if message.IdempotencyKey and idempotency_window > 0:
+                    row = self._conn.execute(
+                        "SELECT message_id FROM queue WHERE idempotency_key=? AND enqueued_at>? ORDER BY seq DESC LIMIT 1",
+                        (message.IdempotencyKey, now-idempotency_window)).fetchone()
+                    if row:
+                        self._conn.execute("COMMIT")
+                        return row[0]
+                self._conn.execute(
+                    "INSERT INTO queue(message_id, payload, caller, idempotency_key, target, business, deadline, priority,"
+                    " enqueued_at, state, timestamps, updated_at) VALUES (?,?,?,?,?,?,?,?,?,?,?,?)",
+                    (message_id, message.model_dump_json(), caller, message.IdempotencyKey,
+                     message.FromWxid, business_label(message), deadline, message.priority,
+                     now, MessageStateEnum.queued.value,
+                     json.dumps({MessageStateEnum.queued.value: datetime.fromtimestamp(now).isoformat()}), now))
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return None
+
+    def find_duplicate(self, idempotency_key:str, idempotency_window:float)->Optional[str]:
+        "id of the message enqueued with `idempotency_key` within `idempotency_window` seconds, if any"
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT message_id FROM queue WHERE idempotency_key=? AND enqueued_at>? ORDER BY seq DESC LIMIT 1",
+                (idempotency_key, time.time()-idempotency_window)).fetchone()
+        return row[0] if row else None
+
+    def claim(self, limit:int=1)->List[SendMessage]:
+        "take at most `limit` unclaimed messages, earliest deadline first. Claimed messages are invisible to other claims"
+        if limit <= 0:
+            return []
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._conn.execute(
+                    "SELECT seq, payload FROM queue WHERE state='queued' AND claimed=0"
+                    " ORDER BY deadline, priority DESC, seq LIMIT ?", (limit,)).fetchall()
+                self._conn.executemany("UPDATE queue SET claimed=1 WHERE seq=?", [(seq,) for seq, _ in rows])
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return [SendMessage.model_validate_json(payload) for _, payload in rows]
+
+    def claim_matching(
+            self,
+            predicate:Callable[[SendMessage], bool],
+            from_wxid:str,
+            limit:int,
+            scan:int=1000)->List[SendMessage]:
+        """
+        claim at most `limit` unclaimed messages to `from_wxid` that `predicate` accepts, in queue order.
+        Only the first `scan` messages to `from_wxid` are looked at.
+        """
+        if limit <= 0:
+            return []
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._conn.execute(
+                    "SELECT seq, payload FROM queue WHERE state='queued' AND claimed=0"
+                    " AND target=? ORDER BY deadline, priority DESC, seq LIMIT ?",
+                    (from_wxid, scan)).fetchall()
+                claimed = []
+                for seq, payload in rows:
+                    message = SendMessage.model_validate_json(payload)
+                    if len(claimed) < limit and predicate(message):
+                        claimed.append((seq, message))
+                self._conn.executemany("UPDATE queue SET claimed=1 WHERE seq=?", [(seq,) for seq, _ in claimed])
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return [message for _, message in claimed]
+
+    def recover(self)->Tuple[int,int]:
+        """
+        call this when the UI worker starts.
+        Messages claimed but not started by a previous worker are queued again.
+        Messages the previous worker was sending are marked failed, since they may be sent already.
+        Returns:
+            out(tuple[int,int]): number of messages requeued && number of messages failed
+        """
+        now = time.time()
+        with self._lock:
+            requeued = self._conn.execute(
+                "UPDATE queue SET claimed=0 WHERE state='queued' AND claimed=1").rowcount
+            failed = self._conn.execute(
+                "UPDATE queue SET state='failed', payload='', failure_reason=?, updated_at=?"
+                " WHERE state NOT IN ('queued', 'sent', 'failed')",
+                ("UI worker restarted while sending, the message may or may not be sent", now)).rowcount
+        return requeued, failed
+
+    def cancel(self, kind:str, value:str, at:float)->List[str]:
+        """
+        mark unclaimed messages the tombstone matches failed, && record the tombstone for the UI worker,
+        which drops the claimed ones. See `CancellationIndex` for kinds.
+        Returns:
+            out(list[str]): ids of messages cancelled here
+        """
+        column = dict(message_id="message_id", business="business", target="target")[kind]
+        condition = f"state='queued' AND claimed=0 AND {column}=?"
+        params:tuple = (value,)
+        if kind!="message_id":
+            condition += " AND enqueued_at<=?"
+            params += (at,)
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                message_ids = [row[0] for row in self._conn.execute(
+                    f"SELECT message_id FROM queue WHERE {condition}", params).fetchall()]
+                self._conn.execute(
+                    f"UPDATE queue SET state='failed', payload='', failure_reason=?, updated_at=? WHERE {condition}",
+                    (f"cancelled by {kind} {value}", time.time())+params)
+                self._conn.execute(
+                    "INSERT INTO cancellations(kind, value, cancelled_at) VALUES (?,?,?)", (kind, value, at))
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return message_ids
+
+    def cancellations_since(self, seq:int)->List[Tuple[int, str, str, float]]:
+        """
+        Returns:
+            out(list[tuple[int, str, str, float]]): tombstones recorded after `seq`: seq, kind, value, cancelled_at
+        """
+        with self._lock:
+            return self._conn.execute(
+                "SELECT seq, kind, value, cancelled_at FROM cancellations WHERE seq>? ORDER BY seq", (seq,)).fetchall()
+
+    def publish(self, lifecycle:MessageLifecycle):
+        "record lifecycle transition from the UI worker. Earlier timestamps are kept"
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT timestamps FROM queue WHERE message_id=?", (lifecycle.message_id,)).fetchone()
+            if row is None:
+                return
+            timestamps = json.loads(row[0])
+            for state, ts in lifecycle.timestamps.items():
+                timestamps.setdefault(state.value, ts.isoformat())
+            finished = lifecycle.state in MessageStateEnum.finished()
+            self._conn.execute(
+                "UPDATE queue SET state=?, timestamps=?, failure_reason=?, updated_at=?"
+                + (", payload=''" if finished else "") + " WHERE message_id=?",
+                (lifecycle.state.value, json.dumps(timestamps), lifecycle.failure_reason, time.time(), lifecycle.message_id))
+
+    def depth(self)->int:
+        "number of messages not started yet, claimed or not"
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM queue WHERE state='queued'").fetchone()[0]
+
+    def caller_depth(self, caller:str)->int:
+        "number of messages of `caller` not started yet"
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM queue WHERE state='queued' AND caller=?", (caller,)).fetchone()[0]
+
+    def lifecycles(self, message_ids:Iterable[str], service_seconds:float)->List[Optional[MessageLifecycle]]:
+        """
+        lifecycles with queue position && estimated send time, the same as `MessageTracker.get_many`.
+        Args:
+            service_seconds(float): estimated seconds to send one message, published by the UI worker.
+        """
+        message_ids = list(message_ids)
+        now = datetime.now()
+        with self._lock:
+            in_flight = self._conn.execute(
+                "SELECT message_id, timestamps FROM queue WHERE state NOT IN ('queued', 'sent', 'failed')"
+                " ORDER BY updated_at DESC LIMIT 1").fetchone()
+            in_flight_left = 0.0
+            if in_flight:
+                started = json.loads(in_flight[1]).get(MessageStateEnum.preparing.value)
+                started = datetime.fromisoformat(started) if started else now
+                in_flight_left = max(service_seconds - (now-started).total_seconds(), 0.0)
+
+            results = []
+            for message_id in message_ids:
+                row = self._conn.execute(
+                    "SELECT seq, deadline, priority, state, timestamps, failure_reason FROM queue WHERE message_id=?",
+                    (message_id,)).fetchone()
+                if row is None:
+                    results.append(None)
+                    continue
+                seq, deadline, priority, state, timestamps, failure_reason = row
+                lifecycle = MessageLifecycle(
+                    message_id=message_id, state=state,
+                    timestamps=json.loads(timestamps), failure_reason=failure_reason)
+                if lifecycle.state==MessageStateEnum.queued:
+                    position = self._conn.execute(
+                        "SELECT COUNT(*) FROM queue WHERE state='queued' AND"
+                        " (deadline<? OR (deadline=? AND (priority>? OR (priority=? AND seq<?))))",
+                        (deadline, deadline, priority, priority, seq)).fetchone()[0]
+                    lifecycle.queue_position = position
+                    lifecycle.estimated_send_time = now + timedelta(seconds=in_flight_left + (position+1)*service_seconds)
+                elif in_flight and message_id==in_flight[0]:
+                    lifecycle.estimated_send_time = now + timedelta(seconds=in_flight_left)
+                results.append(lifecycle)
+        return results
+
+    def purge_finished(self, older_than:float=86400.0)->int:
+        "delete messages finished && tombstones recorded `older_than` seconds ago. Final results are still in the status DB"
+        with self._lock:
+            self._conn.execute("DELETE FROM cancellations WHERE cancelled_at<?", (time.time()-older_than,))
+            return self._conn.execute(
+                "DELETE FROM queue WHERE state IN ('sent', 'failed') AND updated_at<?",
+                (time.time()-older_than,)).rowcount
+
+    def set_stats(self, name:str, value:dict):
+        "publish stats of a process, e.g. the UI worker's service time"
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO worker_stats(name, value, updated_at) VALUES (?,?,?)",
+                (name, json.dumps(value, ensure_ascii=False, default=str), time.time()))
+
+    def get_stats(self, name:str)->Tuple[dict, Optional[float]]:
+        """
+        Returns:
+            out(tuple[dict, float|None]): stats published by `name` && unix timestamp they were published at.
+                Empty dict && None if never published.
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, updated_at FROM worker_stats WHERE name=?", (name,)).fetchone()
+        if row is None:
+            return dict(), None
+        return json.loads(row[0]), row[1]
@@ -1,145 +1,134 @@
 from typing import *
 import os
-import uuid
+import time
 import asyncio
-import traceback
-import tempfile
+from datetime import datetime
 from contextlib import asynccontextmanager
-from pathlib import Path
-from shutil import rmtree
 
 import uvicorn
-from pydantic import create_model
+from pydantic import create_model, ValidationError
 from dotenv import load_dotenv
-from aiofiles import open as aopen
+from sqlalchemy.exc import OperationalError
 
-from fastapi import FastAPI, Query, Body
+from fastapi import FastAPI, Query, Body, Header, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.openapi.docs import get_redoc_html, get_swagger_ui_html
 
-from chatbots import CmccChatClient
 from logg import logger, LOGGER_DIR, WORK_DIR
-from schemas import SendMessage, HttpMessageStatus, HttpMessageStatusBase
-from tools import async_wrapper,send_stable,b64decode, DB_Client
+from schemas import (
+    SendMessage, HttpMessageStatus, HttpMessageStatusBase, AdmissionRejected,
+    MessageStateEnum, MessageLifecycle, BulkTemplate, BulkRecipient, CancelRequest
+)
+from tools import async_wrapper, DB_Client
+from admission import AdmissionController
+from message_queues import effective_deadline
+from durable_queue import DurableQueue
+from scheduled_delivery import DeliveryTimer
+from bulk_send import BatchStore, check_template, render
+import metrics
+import tracing
+import ui_worker
 
 load_dotenv(dotenv_path=WORK_DIR / ".env", override=True)
-WAIT_BEFORE_REFRESH=os.getenv("WAIT_BEFORE_REFRESH",5)
-print(f"WAIT_BEFORE_REFRESH: {WAIT_BEFORE_REFRESH}")
-WAIT_BEFORE_REFRESH=float(WAIT_BEFORE_REFRESH)
-
-chatbot_client = CmccChatClient(cache_session_map=False, wait_before_refresh=WAIT_BEFORE_REFRESH)
-message_queue = asyncio.Queue()
-message_semaphore = asyncio.Semaphore(1) # UI操作是不可抢占的
-consumer_tasks:List[asyncio.Task] = []
-temp_dir = tempfile.mkdtemp(prefix="desktop-chatbot")
+print(f"WAIT_BEFORE_REFRESH: {ui_worker.WAIT_BEFORE_REFRESH}")
+MAX_QUEUE_DELAY=float(os.getenv("MAX_QUEUE_DELAY", 3600))
+MAX_QUEUE_SIZE=int(os.getenv("MAX_QUEUE_SIZE", 10000))
+PER_CALLER_QUOTA=int(os.getenv("PER_CALLER_QUOTA", 0))
+DEPLOY_MODE=os.getenv("DEPLOY_MODE", "single")
+"single: UI worker runs in this process. split: several API workers, UI worker runs as `python ui_worker.py`"
+HTTP_WORKERS=int(os.getenv("HTTP_WORKERS", 4))
+BULK_INSERT_ROWS=500
+"recipients of a bulk send are stored every this many rows while the body streams in"
+WORKER_STALE_SECONDS=30
+"UI worker is reported down if its stats are older than this"
+
+admission_controller = AdmissionController(
+    ui_worker.service_estimator,
+    max_queue_delay=MAX_QUEUE_DELAY,
+    max_queue_size=MAX_QUEUE_SIZE,
+    per_caller_quota=PER_CALLER_QUOTA,
+)
+background_tasks:List[asyncio.Task] = []
 db_client: DB_Client = None
+durable_queue: DurableQueue = None
+"only set in DEPLOY_MODE=split"
+delivery_timer: DeliveryTimer = None
+batch_store: BatchStore = None
+
+
+def worker_stats()->Tuple[dict, Optional[float]]:
+    """
+    stats of the UI worker && unix timestamp they were published at.
+    In DEPLOY_MODE=split, the estimator of this process follows the one of the UI worker.
+    """
+    if durable_queue is None:
+        return ui_worker.stats(), time.time()
+    stats, published_at = durable_queue.get_stats(ui_worker.WORKER_STATS_NAME)
+    if stats.get("samples"):
+        ui_worker.service_estimator.mean = stats["service_seconds"]
+    return stats, published_at
 
-async def execute_send_message():
-    "consumer function"
-    global db_client
-    while True:
-        message:SendMessage = await message_queue.get()
-        message_id = str(message.id)
-        send_to = message.FromWxid
-        log_content = message.Content
-        async with message_semaphore:
-            #NOTE send text message if exists
-            if message.Content:
-                try:
-                    at_list = []
-                    if message.SenderWxid:
-                        at_list=[ i for i in message.SenderWxid.split("，") if i!=""]
-                        log_content = "".join(["@"+at+" " for at in at_list])+log_content
-                        logger.debug(f"at_list: {at_list} ; content: {message.Content}")
-                    await async_wrapper(
-                        send_stable,
-                        chatbot_client,
-                        chatbot_client.send_message,
-                        session_name=message.FromWxid,
-                        message=message.Content,
-                        from_clipboard=True,
-                        at_list=at_list
-                    )
-                except Exception as exc:
-                    logger.error(traceback.format_exc())
-                    message_status = HttpMessageStatusBase(
-                        message_id=message_id,
-                        send_to=send_to,
-                        content=log_content,
-                        success=False, failure_reason=str(exc))
-                else:
-                    message_status = HttpMessageStatusBase(
-                        message_id=message_id,
-                        send_to=send_to,
-                        content=log_content,
-                        success=True)
-
-                try: #NOTE needs to catch error here, else asyncio task ignores it and keeps go on.
-                    result = await db_client.create(message_status, HttpMessageStatus)
-                    logger.info(f"[text message sent] {message_id}")
-                except Exception as e:
-                    raise Exception(e) from e
-            #NOTE send file if exists
-            if message.File:
-                try:
-                    filename = message.Filename or str(uuid.uuid4())
-                    log_content = "[file] filename: %s" % filename
-                    b64decoded_bytes,mime_type = b64decode(message.File)
-                    temp_filepath=Path(temp_dir) / filename
-                    async with aopen(str(temp_filepath),"wb") as f:
-                        await f.write(b64decoded_bytes)
-                    await async_wrapper(
-                        send_stable,
-                        chatbot_client,
-                        chatbot_client.send_file,
-                        session_name=message.FromWxid,
-                        filepath=temp_filepath
-                    )
-                except Exception as exc:
-                    logger.error(traceback.format_exc())
-                    message_status = HttpMessageStatusBase(
-                        message_id=message_id,
-                        send_to=send_to,
-                        content=log_content,
-                        success=False, failure_reason=str(exc))
-                else:
-                    message_status = HttpMessageStatusBase(
-                        message_id=message_id,
-                        send_to=send_to,
-                        content=log_content,
-                        success=True)
-                try: #NOTE needs to catch error here, else asyncio task ignores it and keeps go on.
-                    result = await db_client.create(message_status, HttpMessageStatus)
-                    logger.info(f"[file message sent] {message_id}")
-                except Exception as e:
-                    raise Exception(e) from e
-
-            #XXX mark task done
-            message_queue.task_done()
-            logger.info(f"[message left] {message_queue.qsize()}")
+
+async def queue_depth()->int:
+    if durable_queue is None:
+        return ui_worker.message_queue.qsize()
+    return await async_wrapper(durable_queue.depth)
+
+
+async def get_lifecycles(message_ids:List[str])->List[Optional[MessageLifecycle]]:
+    if durable_queue is None:
+        lifecycles = ui_worker.message_tracker.get_many(message_ids)
+    else:
+        await async_wrapper(worker_stats) #NOTE follow the service time of the UI worker
+        lifecycles = await async_wrapper(durable_queue.lifecycles, message_ids, ui_worker.service_estimator.mean)
+    #NOTE messages waiting for their SendTime are only in the timer, bulk recipients not expanded yet only in batch store
+    for store in (delivery_timer, batch_store):
+        missing = [message_id for message_id, lifecycle in zip(message_ids, lifecycles) if lifecycle is None]
+        if not missing:
+            break
+        found = await async_wrapper(store.lifecycles, missing)
+        lifecycles = [lifecycle or found.get(message_id) for message_id, lifecycle in zip(message_ids, lifecycles)]
+    return lifecycles
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global consumer_tasks, db_client
+    global background_tasks, db_client, durable_queue, delivery_timer, batch_store
     await async_wrapper(logger.info, "create table")
     db_client = DB_Client()
-    await db_client.migrate()
-
-    #XXX You cannot create 4 consumers, though number of processes is limited to 1 by semaphore.
-    # cuz every consumer get message from only one message_queue, but only you task can send message.
-    for i in range(1):
-        task = asyncio.create_task(execute_send_message())
-        consumer_tasks.append(task)
+    delivery_timer = DeliveryTimer(ui_worker.SCHEDULE_PATH)
+    batch_store = BatchStore(ui_worker.BATCH_PATH)
+    if DEPLOY_MODE=="split":
+        durable_queue = DurableQueue(ui_worker.DURABLE_QUEUE_PATH)
+        if ui_worker.TRACE_PATH:
+            tracing.span_store = tracing.SpanStore(ui_worker.TRACE_PATH)
+        try:
+            await db_client.migrate()
+        except OperationalError:
+            #NOTE another worker is creating tables at the same time
+            await asyncio.sleep(1)
+            await db_client.migrate()
+        metrics.QUEUE_DEPTH.set_function(durable_queue.depth)
+        metrics.MISSED_DEADLINES.set_function(
+            lambda : {(business,): count for business, count in
+                      worker_stats()[0].get("local_queue", dict()).get("missed_deadlines", dict()).items()})
+        metrics.ATTACHMENT_STORE.set_function(
+            lambda : {(counter,): value for counter, value in worker_stats()[0].get("attachments", dict()).items()})
+    else:
+        await db_client.migrate()
+        ui_worker.dequeue_hooks.append(lambda message: admission_controller.release(str(message.id)))
+        background_tasks = await ui_worker.start(db_client)
     yield
     # after shut down app
     # cancel all consumers
-    for t in consumer_tasks:
-        t.cancel()
-    await asyncio.gather(*consumer_tasks, return_exceptions=True)
-    rmtree(temp_dir, ignore_errors=True) #NOTE remove all files in temp dir
+    await ui_worker.stop(background_tasks)
+    await db_client.dispose()
+    if durable_queue:
+        durable_queue.close()
+    delivery_timer.close()
+    batch_store.close()
     await logger.complete() #NOTE complete all logs
     logger.info("[STATUS] successsfully shuting down server")
 
@@ -174,18 +163,89 @@ async def custom_redoc():
 
 @app.get("/health/", response_model=create_model("PlainTextResponse", output=(str, ...)))
 async def health_check():
-    return "health check good."
+    if DEPLOY_MODE=="split":
+        _, published_at = await async_wrapper(worker_stats)
+        if published_at is None or time.time()-published_at > WORKER_STALE_SECONDS:
+            return JSONResponse(status_code=503, content="ui worker is down.")
+    return JSONResponse(content="health check good.")
+
+
+@app.get("/attachments/", response_model=create_model(
+    "AttachmentStoreStats",
+    entries=(int, ...), total_bytes=(int, ...), max_bytes=(int, ...),
+    hits=(int, ...), misses=(int, ...), bytes_saved=(int, ...), evictions=(int, ...)))
+async def attachment_store_stats():
+    "deduplication counters of the attachment store"
+    stats, _ = await async_wrapper(worker_stats)
+    return JSONResponse(content=stats.get("attachments", dict()))
+
+
+@app.get("/queue/", response_model=create_model(
+    "QueueStats", size=(int, ...), scheduled=(int, ...), bulk_pending=(int, ...), missed_deadlines=(Dict[str,int], ...), admission=(dict, ...), idempotency=(dict, ...)))
+async def queue_stats():
+    "queue depth, scheduled messages, bulk recipients not expanded yet, number of messages sent after their deadline by business, admission control && dedup stats"
+    stats, _ = await async_wrapper(worker_stats)
+    local_queue = stats.get("local_queue", dict())
+    return JSONResponse(content=dict(
+        size=await queue_depth(),
+        scheduled=await async_wrapper(delivery_timer.pending),
+        bulk_pending=await async_wrapper(batch_store.pending),
+        missed_deadlines=local_queue.get("missed_deadlines", dict()),
+        admission=admission_controller.stats(),
+        idempotency=stats.get("idempotency", dict())))
+
+
+CheckResponse = create_model(
+    "JSONResponse",
+    message_status=(HttpMessageStatus|None, ...),
+    empty=(bool, ...),
+    lifecycle=(MessageLifecycle|None, ...))
+
+@app.get("/metrics", include_in_schema=False)
+async def prometheus_metrics():
+    "metrics in prometheus text exposition format"
+    return PlainTextResponse(metrics.REGISTRY.render(), media_type=metrics.CONTENT_TYPE)
+
 
+def final_statuses(rows:Iterable[HttpMessageStatus])->Dict[str, HttpMessageStatus]:
+    "status of each message by id. A message with text && file has 2 status rows, the failed one wins"
+    statuses = dict()
+    for row in rows:
+        if row.message_id not in statuses or (statuses[row.message_id].success and not row.success):
+            statuses[row.message_id] = row
+    return statuses
 
-@app.get("/check/", response_model=create_model("JSONResponse", message_status=(HttpMessageStatus|None, ...), empty=(bool, ...)))
+
+@app.get("/check/", response_model=CheckResponse)
 async def check_message_status(
     message_id: str = Query(..., title="message id", description="message id"),):
-    if_empty = True
-    async for result in db_client.get(HttpMessageStatus, message_id=message_id):
-        if_empty=False
-        return JSONResponse(content=dict(message_status=result.model_dump(mode="json"), empty=if_empty))
-    if if_empty:
-        return JSONResponse(content=dict(message_status=None, empty=if_empty))
+    """
+    `message_status` is the final result in DB, `empty` if the message is not finished yet.
+    `lifecycle` covers the current state, timestamps, queue position && estimated send time.
+    """
+    lifecycle = (await get_lifecycles([message_id]))[0]
+    lifecycle = lifecycle.model_dump(mode="json") if lifecycle else None
+    status = final_statuses([result async for result in db_client.get(HttpMessageStatus, message_id=message_id)]).get(message_id)
+    if status:
+        return JSONResponse(content=dict(message_status=status.model_dump(mode="json"), empty=False, lifecycle=lifecycle))
+    else:
+        return JSONResponse(content=dict(message_status=None, empty=True, lifecycle=lifecycle))
+
+
+@app.post("/check/bulk/", response_model=create_model(
+    "BulkCheckResponse", results=(Dict[str, CheckResponse], ...)))
+async def check_message_status_bulk(
+    message_ids: List[str] = Body(..., title="message ids", description="message ids, at most 1000", max_length=1000),):
+    "bulk variant of `/check/`, results are keyed by message id"
+    statuses = final_statuses([result async for result in db_client.get(HttpMessageStatus, message_id=message_ids)])
+    results = dict()
+    for message_id, lifecycle in zip(message_ids, await get_lifecycles(message_ids)):
+        status = statuses.get(message_id)
+        results[message_id] = dict(
+            message_status=status.model_dump(mode="json") if status else None,
+            empty=message_id not in statuses,
+            lifecycle=lifecycle.model_dump(mode="json") if lifecycle else None)
+    return JSONResponse(content=dict(results=results))
 
 
 json_schemas_example={
@@ -200,22 +260,269 @@ json_schemas_example={
     "id": None,
     "CreatedTime": None,
     "IsSent": None,
-    "SendTime": None
+    "SendTime": None,
+    "Priority": None,
+    "Deadline": None,
+    "IdempotencyKey": None
 }
 
 @app.post("/receive_message/",)
-async def receive_message(message:SendMessage=Body(..., example=json_schemas_example)):
+async def receive_message(
+    request: Request,
+    message:SendMessage=Body(..., example=json_schemas_example),
+    caller_id:Optional[str]=Header(None, alias="X-Caller-Id", description="caller identity used by per-caller quota. Defaults to client host"),
+    idempotency_key:Optional[str]=Header(None, alias="Idempotency-Key", description="retries with the same key are sent once")):
     message_id = message.id
-    await message_queue.put(message)
+    #NOTE correlation lasts for this request only, every request runs in its own task
+    with tracing.correlate(str(message_id)), tracing.span("intake"):
+        caller = caller_id or (request.client.host if request.client else "unknown")
+        message.IdempotencyKey = idempotency_key or message.IdempotencyKey
+        message.CreatedTime = message.CreatedTime or datetime.now()
+        if message.IdempotencyKey:
+            if durable_queue is None:
+                original_id = ui_worker.idempotency_index.reserve(message.IdempotencyKey, str(message_id))
+            else:
+                original_id = (
+                    await async_wrapper(durable_queue.find_duplicate, message.IdempotencyKey, ui_worker.IDEMPOTENCY_WINDOW)
+                    or await async_wrapper(delivery_timer.find_duplicate, message.IdempotencyKey))
+            if original_id:
+                logger.info(f"[duplicate received] key: {message.IdempotencyKey} original: {original_id}")
+                return JSONResponse(
+                    content={
+                        "status":200,
+                        "message":"duplicate message, it's received already. You can use message_id to check the original message.",
+                        "message_id":original_id,
+                        "duplicate":True},
+                )
+        if message.SendTime and message.SendTime.timestamp() > time.time():
+            #NOTE accepted without admission. Once due, it's released only as the queue has room by admission
+            # (`ui_worker.queue_room`) && waits in timer meanwhile, instead of being rejected
+            await async_wrapper(delivery_timer.add, message, caller)
+            return JSONResponse(
+                content={
+                    "status":200,
+                    "message":f"message scheduled at {message.SendTime.isoformat()}. You can use message_id to check if your message is sent properly.",
+                    "message_id":str(message_id)},
+            )
+        try:
+            if durable_queue is None:
+                admission_controller.admit(caller, str(message_id), ui_worker.message_queue.qsize())
+            else:
+                await async_wrapper(worker_stats)
+                admission_controller.admit(
+                    caller, str(message_id), await queue_depth(),
+                    caller_depth=await async_wrapper(durable_queue.caller_depth, caller))
+        except AdmissionRejected as exc:
+            logger.warning(f"[message rejected] {message_id} caller: {caller} reason: {exc}")
+            if message.IdempotencyKey and durable_queue is None:
+                ui_worker.idempotency_index.forget(message.IdempotencyKey)
+            metrics.REJECTED.inc(reason=exc.reason)
+            return JSONResponse(
+                status_code=429,
+                headers={"Retry-After": str(exc.retry_after)},
+                content={
+                    "status":429,
+                    "message":f"message rejected: {exc}. Retry after {exc.retry_after} seconds.",
+                    "message_id":str(message_id)},
+            )
+        if durable_queue is None:
+            ui_worker.enqueue(message)
+        else:
+            #NOTE dedup again atomically with insert, another API worker may have taken the key meanwhile
+            original_id = await async_wrapper(
+                durable_queue.put, message,
+                deadline=effective_deadline(message, ui_worker.PRIORITY_SLACK_SECONDS),
+                caller=caller, idempotency_window=ui_worker.IDEMPOTENCY_WINDOW)
+            if original_id:
+                return JSONResponse(
+                    content={
+                        "status":200,
+                        "message":"duplicate message, it's received already. You can use message_id to check the original message.",
+                        "message_id":original_id,
+                        "duplicate":True},
+                )
+        metrics.ENQUEUED.inc()
+        return JSONResponse(
+            content={
+                "status":200,
+                "message":"message received. You can use message_id to check if your message is sent properly.",
+                "message_id":str(message_id)},
+        )
+
+
+async def ndjson_lines(request:Request)->AsyncGenerator[bytes, None]:
+    "non-empty lines of the request body, read as it streams in"
+    buffer = b""
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield line
+    if buffer.strip():
+        yield buffer
+
+
+@app.post("/bulk/", response_model=create_model(
+    "BulkResponse",
+    status=(int, ...), message=(str, ...), batch_id=(str|None, ...),
+    accepted=(int, ...), rejected=(int, ...), errors=(List[dict], ...)),
+    openapi_extra={"requestBody": {"content": {"application/x-ndjson": {"schema": {"type": "string"}}}, "required": True}})
+async def receive_bulk(
+    request: Request,
+    caller_id:Optional[str]=Header(None, alias="X-Caller-Id", description="caller identity recorded with the batch. Defaults to client host")):
+    """
+    template-based bulk send. Body is NDJSON:
+    the first line is a `BulkTemplate`, every following line is a `BulkRecipient`.
+
+    Recipients are stored as the body streams in && expanded into messages lazily as the UI worker has room.
+    Their status is available at `/bulk/{batch_id}/`, or by message id at `/check/`.
+    Invalid recipient lines, && recipients whose `Variables` can't fill the template, are rejected alone,
+    with the first 100 errors returned.
+    """
+    caller = caller_id or (request.client.host if request.client else "unknown")
+    intake_start = time.time()
+    batch_id = None
+    accepted, rejected, errors = 0, 0, []
+    recipients:List[BulkRecipient] = []
+    line_no = 0
+    async for line in ndjson_lines(request):
+        line_no += 1
+        if batch_id is None:
+            try:
+                template = BulkTemplate.model_validate_json(line)
+                check_template(template.Template)
+            except (ValidationError, ValueError) as exc:
+                return JSONResponse(
+                    status_code=400,
+                    content={"status":400, "message":f"invalid template in line 1: {exc}", "batch_id":None,
+                             "accepted":0, "rejected":0, "errors":[]})
+            batch_id = await async_wrapper(batch_store.create, template, caller)
+            continue
+        try:
+            recipient = BulkRecipient.model_validate_json(line)
+            try:
+                render(template.Template, recipient.Variables)
+            except Exception as exc:
+                raise ValueError(f"Variables can't fill the template: {exc!r}")
+            recipients.append(recipient)
+        except (ValidationError, ValueError) as exc:
+            rejected += 1
+            if len(errors) < 100:
+                errors.append(dict(line=line_no, error=str(exc)))
+        if len(recipients) >= BULK_INSERT_ROWS:
+            await async_wrapper(batch_store.add, batch_id, recipients)
+            accepted += len(recipients)
+            recipients = []
+    if batch_id is None:
+        return JSONResponse(
+            status_code=400,
+            content={"status":400, "message":"empty body, the first line must be the template", "batch_id":None,
+                     "accepted":0, "rejected":0, "errors":[]})
+    if recipients:
+        await async_wrapper(batch_store.add, batch_id, recipients)
+        accepted += len(recipients)
+    tracing.bind(batch_id=batch_id)
+    tracing.record_span("intake", intake_start, time.time()-intake_start)
+    logger.info(f"[bulk received] {batch_id} caller: {caller} accepted: {accepted} rejected: {rejected}")
+    metrics.ENQUEUED.inc(accepted)
     return JSONResponse(
         content={
             "status":200,
-            "message":"message received. You can use message_id to check if your message is sent properly.",
-            "message_id":str(message_id)},
+            "message":"bulk send received. You can use batch_id to check status of every recipient.",
+            "batch_id":batch_id,
+            "accepted":accepted,
+            "rejected":rejected,
+            "errors":errors},
     )
 
 
+@app.get("/bulk/{batch_id}/", response_model=create_model(
+    "BulkStatus", summary=(dict, ...), recipients=(List[dict], ...)))
+async def check_bulk_status(
+    batch_id: str,
+    offset: int = Query(0, ge=0, description="index of the first recipient returned"),
+    limit: int = Query(100, ge=1, le=1000, description="number of recipients returned")):
+    "number of recipients by state, && state of recipients in `[offset, offset+limit)`, in the order they were sent in"
+    summary = await async_wrapper(batch_store.summary, batch_id)
+    if summary is None:
+        return JSONResponse(status_code=404, content={"status":404, "message":f"batch {batch_id} not found"})
+    recipients = await async_wrapper(batch_store.recipients, batch_id, offset, limit)
+    return JSONResponse(content=dict(summary=summary, recipients=recipients))
+
+
+@app.get("/timeline/", response_model=create_model(
+    "Timeline",
+    message_id=(str|None, ...), batch_id=(str|None, ...), started_time=(str, ...), total_seconds=(float, ...),
+    stages=(Dict[str, dict], ...), spans=(List[dict], ...)))
+async def get_timeline(
+    message_id: Optional[str] = Query(None, description="message id"),
+    batch_id: Optional[str] = Query(None, description="bulk batch id, ignored if `message_id` is given"),
+    limit: int = Query(1000, ge=1, le=10000, description="number of spans returned at most")):
+    """
+    path of a message, || of every message of a bulk batch, through intake, queue, UI stages && DB writes.
+    `spans` are in the order they started, `offset` is seconds since the first one.
+    `stages` sums durations up by stage: count, seconds && max_seconds.
+    """
+    if tracing.span_store is None:
+        return JSONResponse(status_code=404, content={"status":404, "message":"tracing is disabled, set TRACE_PATH"})
+    if message_id is None and batch_id is None:
+        return JSONResponse(status_code=400, content={"status":400, "message":"either message_id or batch_id is required"})
+    timeline = await async_wrapper(tracing.span_store.timeline, message_id, batch_id, limit)
+    if timeline is None:
+        return JSONResponse(status_code=404, content={"status":404, "message":"no span recorded"})
+    return JSONResponse(content=timeline)
+
+
+@app.post("/cancel/", response_model=create_model(
+    "CancelResponse", status=(int, ...), message=(str, ...), cancelled=(Dict[str,int], ...)))
+async def cancel_messages(request:CancelRequest=Body(...)):
+    """
+    cancel messages not sent yet: by message ids, bulk batch, business || target.
+    Messages in the UI worker's queue are tombstoned && dropped when the consumer gets to them, without UI work.
+    `cancelled` counts messages removed from scheduled, bulk && (split mode) durable queue right away,
+    tombstoned ones are not counted since the queue is never scanned.
+    Cancelled messages end up failed, with the reason in `/check/`.
+    """
+    now = time.time()
+    tombstones:List[Tuple[str,str]] = [("message_id", message_id) for message_id in request.message_ids]
+    if request.business:
+        tombstones.append(("business", request.business.name))
+    if request.target:
+        tombstones.append(("target", request.target))
+
+    cancelled = dict(scheduled=0, bulk=0, queued=0)
+    removed:List[SendMessage] = []
+    for kind, value in tombstones+([("batch_id", request.batch_id)] if request.batch_id else []):
+        if kind!="batch_id":
+            scheduled = await async_wrapper(delivery_timer.cancel, kind, value, now)
+            cancelled["scheduled"] += len(scheduled)
+            removed += scheduled
+        unexpanded_ids, expanded_ids = await async_wrapper(batch_store.cancel, kind, value, now)
+        cancelled["bulk"] += len(unexpanded_ids)
+        #NOTE recipients already expanded are in the UI worker's queue
+        tombstones += [("message_id", message_id) for message_id in expanded_ids]
+
+    for kind, value in tombstones:
+        if durable_queue is None:
+            ui_worker.cancel(kind, value, now)
+        else:
+            cancelled["queued"] += len(await async_wrapper(durable_queue.cancel, kind, value, now))
+
+    #NOTE scheduled messages have no lifecycle anywhere else, record their result
+    for message in removed:
+        await db_client.create(HttpMessageStatusBase(
+            message_id=str(message.id), send_to=message.FromWxid, content=message.Content,
+            success=False, failure_reason="cancelled before its SendTime"), HttpMessageStatus)
+    logger.info(f"[cancel] {request.model_dump(mode='json', exclude_defaults=True)} cancelled: {cancelled}")
+    return JSONResponse(content={"status":200, "message":"cancelled.", "cancelled":cancelled})
+
+
 if __name__ == '__main__':
     HOST = os.getenv("HTTP_HOST", "127.0.0.1")
     PORT = int(os.getenv("HTTP_PORT", "11451"))
-    uvicorn.run(app, host=HOST,port=PORT)
+    if DEPLOY_MODE=="split":
+        #NOTE start `python ui_worker.py` as well, it's the only process operating the desktop client
+        uvicorn.run("http_server:app", host=HOST, port=PORT, workers=HTTP_WORKERS)
+    else:
+        uvicorn.run(app, host=HOST,port=PORT)
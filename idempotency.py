@@ -0,0 +1,87 @@
+import time
+from typing import *
+from collections import OrderedDict
+
+from pydantic import BaseModel
+
+
+class IdempotencyEntry(BaseModel):
+    message_id:str
+    "message id first registered with the key"
+    expires_at:float
+    "unix timestamp the entry expires at"
+    sent:bool=False
+    "whether the message has reached UI send"
+
+
+class IdempotencyIndex:
+    """
+    Time-windowed dedup index of caller-supplied idempotency keys.
+
+    It's checked twice:
+    - `reserve` before enqueueing: a retry within the window gets the original message id back;
+    - `claim_send` right before the UI send: catches duplicates admitted after their key expired
+      while the original was still queued.
+
+    Entries expire `window` seconds after they are last touched, and at most `max_entries` are kept,
+    so memory stays bounded.
+    """
+
+    def __init__(self, window:float=86400.0, max_entries:int=100000):
+        self.window = window
+        self.max_entries = max_entries
+        self._entries:OrderedDict[str, IdempotencyEntry] = OrderedDict() #NOTE expiry order, soonest first
+        self.duplicates = 0
+
+    def reserve(self, key:str, message_id:str)->Optional[str]:
+        """
+        register `key` for `message_id`.
+        Returns:
+            out(str|None): message id registered with `key` before, None if `key` is new.
+        """
+        entry = self._get(key)
+        if entry is not None:
+            self.duplicates += 1
+            return entry.message_id
+        self._touch(key, IdempotencyEntry(message_id=message_id, expires_at=0))
+        return None
+
+    def claim_send(self, key:str, message_id:str)->Optional[str]:
+        """
+        mark `key` as sent by `message_id`.
+        Returns:
+            out(str|None): id of another message already sent with `key`, None if `message_id` may be sent.
+        """
+        entry = self._get(key)
+        if entry is not None and entry.sent and entry.message_id!=message_id:
+            self.duplicates += 1
+            return entry.message_id
+        self._touch(key, IdempotencyEntry(message_id=message_id, expires_at=0, sent=True))
+        return None
+
+    def forget(self, key:str):
+        "drop `key`, e.g. the message reserved it was rejected && never enqueued"
+        self._entries.pop(key, None)
+
+    def stats(self)->dict:
+        self._purge()
+        return dict(entries=len(self._entries), duplicates=self.duplicates, window=self.window)
+
+    def _get(self, key:str)->Optional[IdempotencyEntry]:
+        self._purge()
+        return self._entries.get(key)
+
+    def _touch(self, key:str, entry:IdempotencyEntry):
+        entry.expires_at = time.time() + self.window
+        self._entries.pop(key, None)
+        self._entries[key] = entry
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def _purge(self):
+        now = time.time()
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if entry.expires_at > now:
+                break
+            self._entries.popitem(last=False)
@@ -3,6 +3,8 @@ import sys
 from pathlib import Path
 from loguru import logger
 
+import tracing
+
 if getattr(sys, 'frozen', False):
     WORK_DIR = Path(sys.executable).parent
 else:
@@ -11,13 +13,15 @@ else:
 LOGGER_DIR=WORK_DIR / "logs"
 LOGGER_DIR.mkdir(exist_ok=True)
 logger.remove()
+#NOTE every record carries correlation ids of the message being processed, see `tracing.correlation`
+logger.configure(patcher=lambda record: record["extra"].setdefault("correlation", str(tracing.correlation.get())))
 
 logger.level("API", no=1, color="<cyan>")
 
 logger.add(
     sys.stdout,
     colorize=True,
-    format="[<green>{time:YYYY-MM-DD HH:mm:ss}</green> | <level>{level}</level> | {file}:{function}:{line} ] {message}",
+    format="[<green>{time:YYYY-MM-DD HH:mm:ss}</green> | <level>{level}</level> | {file}:{function}:{line} | {extra[correlation]} ] {message}",
     level="TRACE",
     enqueue=True,
     backtrace=True,
@@ -26,7 +30,7 @@ logger.add(
 logger.add(
     str(LOGGER_DIR / "execution.log"),
     colorize=False,
-    format="[{time:YYYY-MM-DD HH:mm:ss} | {level} | {file}:{function}:{line} ] {message}",
+    format="[{time:YYYY-MM-DD HH:mm:ss} | {level} | {file}:{function}:{line} | {extra[correlation]} ] {message}",
     encoding="utf-8",
     enqueue=True,
     rotation="10mb",
@@ -0,0 +1,104 @@
+import time
+import heapq
+import asyncio
+import itertools
+from typing import *
+from collections import Counter
+
+from schemas import SendMessage
+from schemas.general import MAX_PRIORITY
+
+
+def business_label(message:SendMessage)->str:
+    "label to group statistics by business. Messages without business are labeled `none`"
+    return message.Business.name if message.Business else "none"
+
+
+def effective_deadline(message:SendMessage, slack_per_level:float, enqueued_at:Optional[float]=None)->float:
+    """
+    deadline in unix timestamp messages are ordered by: `Deadline` if given,
+    else enqueued time + `slack_per_level * (MAX_PRIORITY - priority)`
+    """
+    if message.Deadline:
+        return message.Deadline.timestamp()
+    enqueued_at = time.time() if enqueued_at is None else enqueued_at
+    return enqueued_at + slack_per_level * (MAX_PRIORITY - message.priority)
+
+
+class PriorityMessageQueue(asyncio.Queue):
+    """
+    asyncio queue of `SendMessage`, served earliest-deadline-first.
+
+    Every message gets an effective deadline:
+    - `SendMessage.Deadline` if the caller gives one;
+    - else enqueued time + `slack_per_level * (MAX_PRIORITY - priority)`.
+      So urgent messages overtake bulk ones, while bulk ones still age and won't starve.
+
+    Ties are broken by priority, then by arrival order.
+    """
+
+    def __init__(self, maxsize:int=0, slack_per_level:float=600.0):
+        """
+        Args:
+            maxsize(int): same as `asyncio.Queue`.
+            slack_per_level(float): seconds of implicit deadline one priority level is worth.
+        """
+        self.slack_per_level = slack_per_level
+        self._counter = itertools.count()
+        self.missed_deadlines:Counter[str] = Counter()
+        "number of messages sent after their `Deadline`, by business"
+        super().__init__(maxsize)
+
+    def effective_deadline(self, message:SendMessage, enqueued_at:Optional[float]=None)->float:
+        "deadline in unix timestamp the queue orders the message by"
+        return effective_deadline(message, self.slack_per_level, enqueued_at)
+
+    def check_deadline(self, message:SendMessage)->bool:
+        """
+        call this after the message is sent.
+        Returns:
+            out(bool): True if the message missed its explicit `Deadline`, it's counted in `missed_deadlines`
+        """
+        if message.Deadline and time.time() > message.Deadline.timestamp():
+            self.missed_deadlines[business_label(message)] += 1
+            return True
+        return False
+
+    def positions(self)->dict[str,int]:
+        "0-based queue position of every queued message, by message id. O(n log n)"
+        return {str(entry[-1].id): i for i, entry in enumerate(sorted(self._queue))}
+
+    def take(self, predicate:Callable[[SendMessage], bool], limit:int)->List[SendMessage]:
+        """
+        remove && return at most `limit` queued messages `predicate` accepts, in queue order.
+        `predicate` is called in queue order too, so it may keep state. O(n log n)
+        You must call `task_done` for every message taken, the same as `get`.
+        """
+        taken, kept = [], []
+        for entry in sorted(self._queue):
+            if len(taken) < limit and predicate(entry[-1]):
+                taken.append(entry[-1])
+            else:
+                kept.append(entry)
+        if taken:
+            self._queue = kept #NOTE sorted list is a valid heap
+            for _ in taken:
+                self._wakeup_next(self._putters)
+        return taken
+
+    def stats(self)->dict:
+        return dict(
+            size=self.qsize(),
+            missed_deadlines=dict(self.missed_deadlines),
+        )
+
+    # asyncio.Queue hooks, the same way `asyncio.PriorityQueue` does
+    def _init(self, maxsize):
+        self._queue:List[tuple] = []
+
+    def _put(self, message:SendMessage):
+        entry = (self.effective_deadline(message), -message.priority, next(self._counter), message)
+        heapq.heappush(self._queue, entry)
+
+    def _get(self)->SendMessage:
+        return heapq.heappop(self._queue)[-1]
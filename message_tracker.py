@@ -0,0 +1,101 @@
+import threading
+from typing import *
+from datetime import datetime, timedelta
+from collections import OrderedDict
+
+from schemas import MessageStateEnum, MessageLifecycle
+from tools import ServiceRateEstimator
+from message_queues import PriorityMessageQueue
+
+
+class MessageTracker:
+    """
+    Lifecycle of every message http_server received:
+    queued -> preparing -> sending -> confirming -> sent | failed
+
+    Finished lifecycles are kept up to `max_finished`, the oldest dropped first.
+    The final result is still in the status DB after that.
+
+    Thread safe. States are updated by threads running `send_stable`.
+    """
+
+    def __init__(
+            self,
+            message_queue:PriorityMessageQueue,
+            estimator:ServiceRateEstimator,
+            max_finished:int=10000):
+        self.message_queue = message_queue
+        self.estimator = estimator
+        self.max_finished = max_finished
+        self._lifecycles:dict[str, MessageLifecycle] = dict()
+        self._finished:OrderedDict[str, None] = OrderedDict()
+        self._in_flight:Optional[str] = None
+        "message id the consumer is working on"
+        self._lock = threading.Lock()
+        self.listeners:List[Callable[[MessageLifecycle], Any]] = []
+        "called with a copy of the lifecycle after every transition, e.g. to publish it to other processes"
+
+    def transition(self, message_id:str, state:Union[MessageStateEnum,str], failure_reason:Optional[str]=None):
+        "move the message to `state`. Unknown message ids are registered."
+        state = MessageStateEnum(state)
+        now = datetime.now()
+        with self._lock:
+            lifecycle = self._lifecycles.get(message_id)
+            if lifecycle is None:
+                lifecycle = self._lifecycles[message_id] = MessageLifecycle(message_id=message_id)
+            lifecycle.state = state
+            lifecycle.timestamps.setdefault(state, now)
+            if failure_reason:
+                lifecycle.failure_reason = failure_reason
+
+            if state in MessageStateEnum.finished():
+                if self._in_flight==message_id:
+                    self._in_flight = None
+                self._finished[message_id] = None
+                while len(self._finished) > self.max_finished:
+                    dropped, _ = self._finished.popitem(last=False)
+                    self._lifecycles.pop(dropped, None)
+            elif state!=MessageStateEnum.queued:
+                self._in_flight = message_id
+            snapshot = lifecycle.model_copy(deep=True) if self.listeners else None
+
+        for listener in self.listeners:
+            listener(snapshot)
+
+    def stage_callback(self, message_id:str)->Callable[[str], None]:
+        "callback passed to `send_stable` to report sending && confirming"
+        return lambda stage: self.transition(message_id, stage)
+
+    def get(self, message_id:str)->Optional[MessageLifecycle]:
+        return self.get_many([message_id])[0]
+
+    def get_many(self, message_ids:Iterable[str])->List[Optional[MessageLifecycle]]:
+        """
+        lifecycles with live queue position && estimated send time.
+        Positions are computed once for all `message_ids`.
+        """
+        positions = self.message_queue.positions()
+        mean = self.estimator.mean
+        now = datetime.now()
+        with self._lock:
+            #NOTE seconds until the message in flight is done
+            in_flight_left = 0.0
+            if self._in_flight in self._lifecycles:
+                started = self._lifecycles[self._in_flight].timestamps.get(MessageStateEnum.preparing, now)
+                in_flight_left = max(mean - (now-started).total_seconds(), 0.0)
+
+            results = []
+            for message_id in message_ids:
+                lifecycle = self._lifecycles.get(message_id)
+                if lifecycle is None:
+                    results.append(None)
+                    continue
+                lifecycle = lifecycle.model_copy(deep=True)
+                if lifecycle.state==MessageStateEnum.queued and message_id in positions:
+                    position = positions[message_id]
+                    lifecycle.queue_position = position
+                    lifecycle.estimated_send_time = now + timedelta(seconds=in_flight_left + (position+1)*mean)
+                elif message_id==self._in_flight:
+                    lifecycle.estimated_send_time = now + timedelta(seconds=in_flight_left)
+                results.append(lifecycle)
+            return results
@@ -0,0 +1,222 @@
+# Prometheus-compatible metrics, rendered in text exposition format(version 0.0.4).
+# Updating a metric is a dict lookup && an addition under a lock,
+# cheap enough to be done on every message && every UI stage.
+import time
+import bisect
+import threading
+from typing import *
+from contextlib import contextmanager
+
+import psutil
+
+
+LabelValues:TypeAlias = Tuple[str, ...]
+
+
+def _escape(value:str)->str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names:Sequence[str], values:Sequence[str], extra:str="")->str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value:float)->str:
+    if value==float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class MetricBase:
+    type_name:str = None
+
+    def __init__(self, name:str, documentation:str, labelnames:Sequence[str]=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _label_values(self, labels:dict)->LabelValues:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self)->List[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type_name}",
+        ]
+        lines.extend(self._render_samples())
+        return lines
+
+    def _render_samples(self)->List[str]:
+        raise NotImplementedError
+
+
+class Counter(MetricBase):
+    "monotonically increasing value. Use PromQL `rate()` to get per-second rates."
+    type_name = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values:dict[LabelValues, float] = dict()
+
+    def inc(self, amount:float=1, **labels):
+        if amount < 0:
+            raise ValueError(f"counter {self.name} can only increase, got {amount}")
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _render_samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, k)} {_format_value(v)}" for k, v in items]
+
+
+class Gauge(MetricBase):
+    """
+    value that goes up && down.
+    Either `set` it, or give a `function` evaluated on every scrape:
+    it returns a number, or a dict {label values tuple: number} for labeled gauges.
+    """
+    type_name = "gauge"
+
+    def __init__(self, name, documentation, labelnames=(), function:Callable[[], Union[float, dict]]=None):
+        super().__init__(name, documentation, labelnames)
+        self._values:dict[LabelValues, float] = dict()
+        self.function = function
+
+    def set(self, value:float, **labels):
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_function(self, function:Callable[[], Union[float, dict]]):
+        self.function = function
+
+    def _render_samples(self):
+        if self.function is not None:
+            try:
+                result = self.function()
+            except Exception:
+                #NOTE a broken callback must not break the whole scrape
+                return []
+            items = list(result.items()) if isinstance(result, dict) else [((), result)]
+        else:
+            with self._lock:
+                items = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, k)} {_format_value(v)}" for k, v in items]
+
+
+class Histogram(MetricBase):
+    "distribution of observed values, in cumulative buckets"
+    type_name = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets:Sequence[float]=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60)):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._counts:dict[LabelValues, List[int]] = dict()
+        "non-cumulative count per bucket, the last one is +Inf"
+        self._sums:dict[LabelValues, float] = dict()
+
+    def observe(self, value:float, **labels):
+        key = self._label_values(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._counts.get(key)
+            if counts is None:
+                counts = self._counts[key] = [0]*(len(self.buckets)+1)
+                self._sums[key] = 0.0
+            counts[index] += 1
+            self._sums[key] += value
+
+    @contextmanager
+    def time(self, **labels):
+        "observe seconds the block takes"
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter()-start, **labels)
+
+    def _render_samples(self):
+        with self._lock:
+            items = [(k, list(c), self._sums[k]) for k, c in self._counts.items()]
+        lines = []
+        for key, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets+(float("inf"),), counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, f'le="{_format_value(bound)}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics:dict[str, MetricBase] = dict()
+
+    def register(self, metric:MetricBase)->MetricBase:
+        assert metric.name not in self.metrics, f"metric {metric.name} registered twice"
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self)->str:
+        lines = []
+        for metric in self.metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines)+"\n"
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+REGISTRY = MetricsRegistry()
+
+QUEUE_DEPTH:Gauge = REGISTRY.register(Gauge(
+    "desktop_chatbot_queue_depth", "messages waiting in the outbound queue"))
+ENQUEUED:Counter = REGISTRY.register(Counter(
+    "desktop_chatbot_enqueued_total", "messages put into the outbound queue"))
+DEQUEUED:Counter = REGISTRY.register(Counter(
+    "desktop_chatbot_dequeued_total", "messages taken from the outbound queue by the UI worker"))
+REJECTED:Counter = REGISTRY.register(Counter(
+    "desktop_chatbot_rejected_total", "messages rejected by admission control", ("reason",)))
+MISSED_DEADLINES:Gauge = REGISTRY.register(Gauge(
+    "desktop_chatbot_missed_deadlines", "messages sent after their deadline", ("business",)))
+UI_STAGE_SECONDS:Histogram = REGISTRY.register(Histogram(
+    "desktop_chatbot_ui_stage_seconds", "latency of each UI stage", ("stage",),
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)))
+SEND_RETRIES:Counter = REGISTRY.register(Counter(
+    "desktop_chatbot_send_retries_total", "resends done by `send_stable` after a send failure"))
+SEND_FAILURES:Counter = REGISTRY.register(Counter(
+    "desktop_chatbot_send_failures_total", "sends failed, by exception type", ("error",)))
+DB_WRITE_SECONDS:Histogram = REGISTRY.register(Histogram(
+    "desktop_chatbot_db_write_seconds", "latency of writing message status to DB",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)))
+ATTACHMENT_STORE:Gauge = REGISTRY.register(Gauge(
+    "desktop_chatbot_attachment_store", "attachment store counters", ("counter",)))
+PROCESS_RSS:Gauge = REGISTRY.register(Gauge(
+    "process_resident_memory_bytes", "resident memory size in bytes",
+    function=lambda : psutil.Process().memory_info().rss))
+
+STAGE_OBSERVERS:List[Callable[[str, float], Any]] = []
+"extra callbacks invoked with (stage, seconds) after every UI stage"
+
+
+@contextmanager
+def stage_timing(stage:str):
+    """
+    time a UI stage(switch, search, refresh, paste, confirm) into `UI_STAGE_SECONDS`.
+    Works as a decorator too.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter()-start
+        UI_STAGE_SECONDS.observe(seconds, stage=stage)
+        for observer in STAGE_OBSERVERS:
+            observer(stage, seconds)
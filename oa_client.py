@@ -0,0 +1,421 @@
+# functions conclusion:
+# asyncio client of the 4a server, && the UI actor consuming what it receives.
+# The server can't reach the computer running 移动办公, so the client keeps asking it for messages:
+# - sse: POST get-messages streams `data: {message}\n\n` events till `data: [DONE]`;
+# - poll: POST get-messages returns one message as json, || `{"msg": ...}` when there's nothing left.
+#   Asked with `{"limit": n}`, a server that supports it returns a list of up to n messages, `[]` when there's nothing left.
+# Delivered messages are acknowledged by POST update-msg-status.
+import json
+import math
+import time
+import random
+import asyncio
+import traceback
+from typing import *
+from collections import deque
+
+import aiohttp
+
+from schemas import SendMessage
+from logg import logger
+from tools import ServiceRateEstimator
+from ack_outbox import bulk_acked
+
+
+class Backoff:
+    """
+    exponential backoff with full jitter: the n-th retry in a row waits uniform(0, min(cap, base*factor**n)) seconds,
+    so clients failing together don't retry together.
+    """
+
+    def __init__(self, base:float=0.5, factor:float=2.0, cap:float=30.0, jitter:bool=True):
+        self.base = base
+        self.factor = factor
+        self.cap = cap
+        self.jitter = jitter
+
+    def delay(self, attempt:int)->float:
+        delay = min(self.cap, self.base*self.factor**attempt)
+        return random.uniform(0, delay) if self.jitter else delay
+
+
+class Credit:
+    """
+    how many messages a poll keeps buffered && in flight: enough to cover one round trip to the server
+    at the rate the UI sends, so the UI never waits on the network, && no more, so the buffer doesn't pile up.
+
+    `ceil(round_trip/service_seconds) + 1`, within `[min_credit, max_credit]`. Both are measured as it goes:
+    round trips by the poll, service time by the UI (`UIActor.service_estimator`).
+    """
+
+    def __init__(self, min_credit:int=1, max_credit:int=16, service:Optional[ServiceRateEstimator]=None, alpha:float=0.2):
+        self.min_credit = min_credit
+        self.max_credit = max(max_credit, min_credit)
+        self.service = service
+        self.alpha = alpha
+        self.round_trip:Optional[float] = None
+        "moving average of seconds per poll request"
+
+    def observe_round_trip(self, seconds:float):
+        self.round_trip = seconds if self.round_trip is None else self.alpha*seconds + (1-self.alpha)*self.round_trip
+
+    @property
+    def value(self)->int:
+        if self.service is None or self.round_trip is None or self.service.mean <= 0:
+            return self.min_credit
+        credit = math.ceil(self.round_trip/self.service.mean) + 1
+        return min(max(credit, self.min_credit), self.max_credit)
+
+
+class ServerError(Exception):
+    "the server answered with an error the client doesn't retry"
+
+
+class OAClient:
+    """
+    asyncio client of the 4a server over one pooled keep-alive session.
+    Requests failed by network || 5xx are retried with `backoff`, so are broken streams.
+    Messages received twice (a stream reconnected, a poll retried) are dropped by uid.
+
+    Use it as an async context manager.
+    """
+
+    def __init__(
+            self,
+            base_url:str,
+            protocol:Literal["sse","poll"]="sse",
+            backoff:Optional[Backoff]=None,
+            max_retries:int=10,
+            pool_size:int=4,
+            timeout:float=10.0,
+            ack_batch_size:int=50,
+            min_credit:int=1,
+            max_credit:int=16):
+        """
+        Args:
+            base_url(str): server address, e.g. `http://10.248.230.35:12030`.
+            protocol(str): how messages are fetched, sse || poll.
+            backoff(Backoff): delays between retries. Defaults to `Backoff()`.
+            max_retries(int): retries in a row before giving up.
+            pool_size(int): keep-alive connections kept at most.
+            timeout(float): seconds to connect, && to wait for a response that's not a stream.
+            ack_batch_size(int): uids acknowledged in one request at most.
+            min_credit(int): poll: messages kept buffered && in flight at least, see `Credit`.
+            max_credit(int): poll: messages kept buffered && in flight at most. 1 polls one message at a time.
+                A server without batches is polled by `pool_size-1` concurrent requests at most.
+        """
+        self.base_url = base_url.rstrip("/")+"/"
+        self.protocol = protocol
+        self.backoff = backoff or Backoff()
+        self.max_retries = max_retries
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.ack_batch_size = ack_batch_size
+        self.min_credit = min_credit
+        self.max_credit = max_credit
+        self.batch_poll:Optional[bool] = None
+        "whether the server answers `limit` with a list, known after the first poll"
+        self.bulk_ack = True
+        "whether the server accepts `{\"uids\": [...]}`, turned off at the first rejection"
+        self.session:aiohttp.ClientSession = None
+        self._seen:set[str] = set()
+        self._acks:asyncio.Queue[str] = None
+        self._ack_task:asyncio.Task = None
+        self.received = 0
+        self.duplicates = 0
+        self.retries = 0
+        self.acked = 0
+        self.polls = 0
+        self.credit:Optional[Credit] = None
+        "credit of the last poll, for stats"
+
+    async def __aenter__(self)->"OAClient":
+        self.session = aiohttp.ClientSession(
+            base_url=self.base_url,
+            connector=aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60),
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=self.timeout, sock_read=self.timeout))
+        self._acks = asyncio.Queue()
+        self._ack_task = asyncio.create_task(self._send_acks())
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self, ack_timeout:float=30.0):
+        "acknowledge what's left within `ack_timeout` seconds, then close the session"
+        if self._ack_task:
+            try:
+                await asyncio.wait_for(self._acks.join(), ack_timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"[4a client] {self._acks.qsize()} acknowledgements not sent")
+            self._ack_task.cancel()
+            await asyncio.gather(self._ack_task, return_exceptions=True)
+            self._ack_task = None
+        if self.session:
+            await self.session.close()
+
+    def stats(self)->dict:
+        return dict(
+            received=self.received, duplicates=self.duplicates, retries=self.retries,
+            acked=self.acked, ack_pending=self._acks.qsize() if self._acks else 0,
+            polls=self.polls, batch_poll=self.batch_poll,
+            credit=self.credit.value if self.credit else None,
+            round_trip=round(self.credit.round_trip, 4) if self.credit and self.credit.round_trip else None)
+
+    async def _retry(self, attempt:int, exc:BaseException):
+        if attempt >= self.max_retries:
+            raise exc
+        self.retries += 1
+        delay = self.backoff.delay(attempt)
+        logger.warning(f"[4a client] {exc!r}, retry in {delay:.1f}s")
+        await asyncio.sleep(delay)
+
+    async def request_json(self, method:str, url:str, **kwargs)->Any:
+        "request && parse the json response, retrying network errors && 5xx"
+        attempt = 0
+        while True:
+            try:
+                async with self.session.request(method, url, **kwargs) as resp:
+                    if resp.status >= 500:
+                        raise aiohttp.ClientResponseError(resp.request_info, resp.history, status=resp.status, message=await resp.text())
+                    if resp.status != 200:
+                        raise ServerError(f"{method} {url}: {resp.status} {await resp.text()}")
+                    return await resp.json(content_type=None)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+                await self._retry(attempt, exc)
+                attempt += 1
+
+    async def businesses(self)->List[str]:
+        return (await self.request_json("GET", "businesses-available")).get("data", [])
+
+    def _fresh(self, message:SendMessage)->bool:
+        uid = str(message.id)
+        if uid in self._seen:
+            self.duplicates += 1
+            return False
+        self._seen.add(uid)
+        self.received += 1
+        return True
+
+    async def messages(self, business:str, service:Optional[ServiceRateEstimator]=None)->AsyncIterator[SendMessage]:
+        """
+        messages of the business till the server has no more.
+        Args:
+            business(str): business to fetch.
+            service(ServiceRateEstimator): service time of the UI consuming the messages, to size poll credit by.
+        """
+        fetch = self._stream(business) if self.protocol=="sse" else self._poll(business, service)
+        async for message in fetch:
+            if self._fresh(message):
+                yield message
+
+    async def _stream(self, business:str)->AsyncIterator[SendMessage]:
+        attempt = 0
+        while True:
+            try:
+                #NOTE the server may be silent for long between events, no read timeout on the stream
+                async with self.session.post(
+                        "get-messages", json={"business":business},
+                        timeout=aiohttp.ClientTimeout(total=None, sock_connect=self.timeout, sock_read=None)) as resp:
+                    if resp.status >= 500:
+                        raise aiohttp.ClientResponseError(resp.request_info, resp.history, status=resp.status, message=await resp.text())
+                    if resp.status != 200:
+                        raise ServerError(f"get-messages: {resp.status} {await resp.text()}")
+                    buffer = b""
+                    async for chunk in resp.content.iter_any():
+                        buffer += chunk
+                        *events, buffer = buffer.split(b"\n\n")
+                        for event in events:
+                            event = event.decode("utf8").strip()
+                            if not event.startswith("data: "):
+                                continue
+                            data = event.removeprefix("data: ")
+                            if data=="[DONE]":
+                                return
+                            attempt = 0
+                            yield SendMessage.model_validate_json(data)
+                raise aiohttp.ClientPayloadError("stream ended without [DONE]")
+            except (aiohttp.ClientError, asyncio.TimeoutError) as exc:
+                await self._retry(attempt, exc)
+                attempt += 1
+
+    async def _pull(self, business:str, limit:int)->Tuple[List[SendMessage], bool]:
+        """
+        one poll request for up to `limit` messages.
+        Returns:
+            out(tuple[list[SendMessage], bool]): messages, && whether the server may have more
+        """
+        start = time.perf_counter()
+        data = await self.request_json("POST", "get-messages", json={"business":business, "limit":limit})
+        self.polls += 1
+        self.credit.observe_round_trip(time.perf_counter()-start)
+        if isinstance(data, list):
+            self.batch_poll = True
+            return [SendMessage(**item) for item in data], bool(data)
+        #NOTE a server without batches ignores `limit` && answers one message
+        self.batch_poll = False
+        if "msg" in data:
+            logger.info(f"[4a client] {data['msg']}")
+            return [], False
+        return [SendMessage(**data)], True
+
+    async def _poll(self, business:str, service:Optional[ServiceRateEstimator]=None)->AsyncIterator[SendMessage]:
+        """
+        keeps `Credit` messages buffered && in flight: one request for the missing ones if the server answers
+        batches, as many concurrent requests over the pool otherwise. Refilled as the consumer takes messages,
+        in batches of half the credit at least.
+        Messages are yielded in the order the requests were sent.
+        """
+        self.credit = credit = Credit(self.min_credit, self.max_credit, service)
+        buffer:deque[SendMessage] = deque()
+        requests:deque[Tuple[asyncio.Task, int]] = deque()
+        "requests in flight with their limit, oldest first"
+        in_flight = 0
+        exhausted = False
+        try:
+            while True:
+                #NOTE collect requests done meanwhile, in order
+                while requests and requests[0][0].done():
+                    task, limit = requests.popleft()
+                    in_flight -= limit
+                    messages, more = task.result()
+                    buffer.extend(messages)
+                    exhausted = exhausted or not more
+                while not exhausted and len(buffer)+in_flight < credit.value:
+                    limit = credit.value-len(buffer)-in_flight if self.batch_poll else 1
+                    if self.batch_poll and requests and limit < (credit.value+1)//2:
+                        #NOTE refill batches once half the credit is used, not a message at a time
+                        break
+                    if not self.batch_poll and len(requests) >= max(self.pool_size-1, 1):
+                        #NOTE a connection of the pool is left to acknowledgements
+                        break
+                    requests.append((asyncio.create_task(self._pull(business, limit)), limit))
+                    in_flight += limit
+                    if self.batch_poll is None:
+                        #NOTE the first answer tells whether the server batches
+                        break
+                if buffer:
+                    yield buffer.popleft()
+                    continue
+                if not requests:
+                    return
+                await asyncio.wait([requests[0][0]])
+        finally:
+            for task, _ in requests:
+                task.cancel()
+            await asyncio.gather(*(task for task, _ in requests), return_exceptions=True)
+
+    def ack_soon(self, uid:str):
+        "acknowledge the message in background, batched with others"
+        self._acks.put_nowait(uid)
+
+    async def ack(self, uids:List[str]):
+        """
+        acknowledge messages now. Bulk first, one by one if the server doesn't support bulk.
+        Only uids the bulk answer confirms are done (see `bulk_acked`), the rest are acknowledged one by one.
+        Raises if any isn't acknowledged.
+        """
+        if self.bulk_ack:
+            try:
+                body = await self.request_json("POST", "update-msg-status", json={"uids":uids})
+            except ServerError as exc:
+                logger.info(f"[4a client] bulk acknowledgement not supported({exc}), acknowledging one by one")
+                self.bulk_ack = False
+            else:
+                acked = bulk_acked(uids, body)
+                if not acked:
+                    logger.info(f"[4a client] bulk acknowledgement confirms no uid: {str(body)[:200]}, acknowledging one by one")
+                    self.bulk_ack = False
+                else:
+                    acked = set(acked)
+                    uids = [uid for uid in uids if uid not in acked]
+                    if not uids:
+                        return
+        #NOTE concurrently over the pool, so acknowledging one by one keeps up with pulling on credit
+        results = await asyncio.gather(
+            *(self.request_json("POST", "update-msg-status", json={"uid":uid}) for uid in uids), return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
+    async def _send_acks(self):
+        while True:
+            uids = [await self._acks.get()]
+            while len(uids) < self.ack_batch_size and not self._acks.empty():
+                uids.append(self._acks.get_nowait())
+            try:
+                await self.ack(uids)
+                self.acked += len(uids)
+            except Exception:
+                logger.error(f"[4a client] acknowledging {len(uids)} messages failed: {traceback.format_exc()}")
+            finally:
+                for _ in uids:
+                    self._acks.task_done()
+
+
+class UIActor:
+    """
+    the only consumer of messages received from the 4a server, && the only user of the desktop client.
+    One task takes messages from a bounded buffer && runs `handler` on them in a worker thread, one at a time.
+    `put` waits while the buffer is full, which holds back whoever is fetching messages.
+
+    Use it as an async context manager: leaving waits till every message put is handled.
+    """
+
+    def __init__(
+            self,
+            handler:Callable[[SendMessage], bool],
+            buffer_size:int=1,
+            on_result:Optional[Callable[[SendMessage, bool], Any]]=None):
+        """
+        Args:
+            handler(Callable[[SendMessage], bool]): sends the message through UI, returns whether it succeeded.
+                Runs in a worker thread.
+            buffer_size(int): messages waiting for the UI at most.
+            on_result(Callable[[SendMessage, bool], Any]): called in the event loop after every message.
+        """
+        self.handler = handler
+        self.on_result = on_result or (lambda message, succeeded: None)
+        self.buffer:asyncio.Queue[SendMessage] = asyncio.Queue(maxsize=buffer_size)
+        self.service_estimator = ServiceRateEstimator()
+        self._task:asyncio.Task = None
+        self.succeeded = 0
+        self.failed = 0
+
+    async def __aenter__(self)->"UIActor":
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            await self.buffer.join()
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+
+    async def put(self, message:SendMessage):
+        await self.buffer.put(message)
+
+    def stats(self)->dict:
+        return dict(
+            succeeded=self.succeeded, failed=self.failed, buffered=self.buffer.qsize(),
+            service_seconds=round(self.service_estimator.mean, 3))
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            message = await self.buffer.get()
+            start = loop.time()
+            try:
+                succeeded = await asyncio.to_thread(self.handler, message)
+            except Exception:
+                logger.error(f"[ui actor] {message.id} {traceback.format_exc()}")
+                succeeded = False
+            self.service_estimator.observe(loop.time()-start)
+            if succeeded:
+                self.succeeded += 1
+            else:
+                self.failed += 1
+            try:
+                self.on_result(message, succeeded)
+            finally:
+                self.buffer.task_done()
@@ -0,0 +1,244 @@
+# functions conclusion:
+# local stand-in of the 4a server, to load test && debug the 4a scripts without the production `SERVER_API`:
+# - POST /get-messages: sse streams `data: {message}\n\n` events of the unacknowledged messages till `data: [DONE]`;
+#   poll returns the next message as json, || `{"msg": ...}` when there's nothing left,
+#   || a list of up to `limit` messages if batch polls are enabled;
+# - POST /update-msg-status: `{"uid": ...}`, && `{"uids": [...]}` answered `{"acked": [...]}` if bulk acknowledgement is enabled;
+# - GET /businesses-available;
+# - GET /stub-stats: what the stub served && when, for the load generator.
+# Messages are synthetic: recipients drawn from a zipf distribution, a share of them carry attachments,
+# && faults are injected on purpose: 503s, streams cut midway, messages sent twice, latency.
+#
+# usage: python oa_stub.py [--port 12030] [--protocol sse] [--messages 1000] [--attachment-ratio 0.1] ...
+import time
+import json
+import random
+import base64
+import asyncio
+import argparse
+import uuid
+from typing import *
+
+from aiohttp import web
+from pydantic import BaseModel, Field
+
+from schemas.general import BusinessesEnum
+
+
+class StubConfig(BaseModel):
+    """synthetic workload && faults of `OAStub`"""
+
+    businesses:List[str] = Field(default=[BusinessesEnum.outage.value], description="businesses served, values of `BusinessesEnum`")
+    protocol:Literal["sse","poll"] = Field(default="sse", description="how /get-messages answers")
+    messages:int = Field(default=1000, description="messages per business")
+    recipients:int = Field(default=200, description="distinct recipients per business")
+    recipient_skew:float = Field(default=1.0, description="zipf exponent of how often a recipient is picked, 0 for uniform. The larger, the more messages share recipients")
+    content_chars:int = Field(default=200, description="length of message content")
+    attachment_ratio:float = Field(default=0.1, description="share of messages carrying an attachment")
+    attachment_kb:int = Field(default=256, description="size of an attachment")
+    distinct_attachments:int = Field(default=5, description="distinct attachment contents, the rest repeat them like a notice sent to many")
+    batch_poll:bool = Field(default=False, description="answer polls with `limit` by a list of up to that many messages. The production server answers one")
+    bulk_ack:bool = Field(default=False, description="accept `{\"uids\": [...]}`. The production server doesn't, it's answered 422")
+    error_rate:float = Field(default=0.0, description="share of requests answered 503")
+    disconnect_rate:float = Field(default=0.0, description="share of sse events after which the stream is cut without `[DONE]`")
+    duplicate_rate:float = Field(default=0.0, description="share of messages sent twice")
+    latency_ms:float = Field(default=0.0, description="delay before every response && sse event")
+    seed:int = Field(default=0, description="random seed of the workload && faults")
+
+
+class OAStub:
+    """
+    The 4a server, in memory. Messages of a business are generated upfront.
+    A message is pending till acknowledged: sse streams every pending message on each connection,
+    so a reconnect sends the unacknowledged ones again, as the production server does.
+    Poll hands each message out once (twice when duplicated on purpose).
+    """
+
+    def __init__(self, config:StubConfig):
+        self.config = config
+        self.random = random.Random(config.seed)
+        for business in config.businesses:
+            BusinessesEnum(business) #NOTE the 4a scripts need a valid `Business`
+        self.attachments = [
+            "data:application/pdf;base64," + base64.b64encode(self.random.randbytes(config.attachment_kb*1024)).decode()
+            for _ in range(max(config.distinct_attachments, 1))]
+        self.messages:dict[str, List[dict]] = {business: self._generate(business) for business in config.businesses}
+        self.cursor:dict[str, int] = {business: 0 for business in config.businesses}
+        self.emitted_at:dict[str, float] = dict()
+        "when a message was first sent to the client, by uid"
+        self.acked_at:dict[str, float] = dict()
+        self.uid_of_content:dict[str, str] = {
+            message["Content"]: message["id"] for messages in self.messages.values() for message in messages}
+        self.requests = 0
+        self.errors_injected = 0
+        self.disconnects_injected = 0
+        self.duplicates_injected = 0
+        self.connections = 0
+        self.acks = 0
+        self.bulk_rejected = 0
+
+    def _generate(self, business:str)->List[dict]:
+        config = self.config
+        weights = [1/(rank+1)**config.recipient_skew for rank in range(config.recipients)]
+        picks = self.random.choices(range(config.recipients), weights=weights, k=config.messages)
+        messages = []
+        for seq, recipient in enumerate(picks):
+            #NOTE content starts with a unique tag, so deliveries can be matched to messages by content
+            tag = f"[{business}#{seq}]"
+            message = dict(
+                id=str(uuid.UUID(int=self.random.getrandbits(128))),
+                Business=business,
+                Content=tag + "测"*max(config.content_chars-len(tag), 0),
+                FromWxid=f"139{recipient:08d}",
+                ActualName=f"用户{recipient}",
+                Role="客户经理",
+            )
+            if self.random.random() < config.attachment_ratio:
+                message["File"] = self.attachments[self.random.randrange(len(self.attachments))]
+                message["Filename"] = f"{business}-{seq}.pdf"
+            messages.append(message)
+        return messages
+
+    def app(self)->web.Application:
+        app = web.Application(client_max_size=16*1024*1024)
+        app.router.add_post("/get-messages", self.get_messages)
+        app.router.add_post("/update-msg-status", self.update_msg_status)
+        app.router.add_get("/businesses-available", self.businesses_available)
+        app.router.add_get("/stub-stats", self.stub_stats)
+        return app
+
+    async def _delay(self):
+        if self.config.latency_ms:
+            await asyncio.sleep(self.config.latency_ms/1000)
+
+    def _fail(self)->bool:
+        self.requests += 1
+        if self.random.random() < self.config.error_rate:
+            self.errors_injected += 1
+            return True
+        return False
+
+    def _emit(self, message:dict):
+        self.emitted_at.setdefault(message["id"], time.monotonic())
+
+    async def get_messages(self, request:web.Request)->web.StreamResponse:
+        await self._delay()
+        if self._fail():
+            return web.Response(status=503, text="injected error")
+        body = await request.json()
+        business = body.get("business")
+        if business not in self.messages:
+            return web.json_response({"msg": f"unknown business {business}"}, status=400)
+        if self.config.protocol=="poll":
+            if self.config.batch_poll and body.get("limit"):
+                return web.json_response([message for message in (self._next(business) for _ in range(int(body["limit"]))) if message])
+            message = self._next(business)
+            return web.json_response(message or {"msg": "没有待发送的消息"})
+        return await self._stream(request, business)
+
+    def _next(self, business:str)->Optional[dict]:
+        "next message to hand out by poll, None if there's nothing left"
+        messages = self.messages[business]
+        cursor = self.cursor[business]
+        if cursor >= len(messages):
+            return None
+        message = messages[cursor]
+        if self.random.random() < self.config.duplicate_rate:
+            #NOTE cursor not moved, the same message is handed out again
+            self.duplicates_injected += 1
+        else:
+            self.cursor[business] += 1
+        self._emit(message)
+        return message
+
+    async def _stream(self, request:web.Request, business:str)->web.StreamResponse:
+        self.connections += 1
+        resp = web.StreamResponse(headers={"Content-Type": "text/event-stream; charset=utf-8"})
+        await resp.prepare(request)
+        for message in [message for message in self.messages[business] if message["id"] not in self.acked_at]:
+            await self._delay()
+            event = f"data: {json.dumps(message, ensure_ascii=False)}\n\n".encode("utf8")
+            self._emit(message)
+            await resp.write(event)
+            if self.random.random() < self.config.duplicate_rate:
+                self.duplicates_injected += 1
+                await resp.write(event)
+            if self.random.random() < self.config.disconnect_rate:
+                self.disconnects_injected += 1
+                #NOTE cut without [DONE], the client reconnects
+                request.transport.close()
+                return resp
+        await resp.write(b"data: [DONE]\n\n")
+        await resp.write_eof()
+        return resp
+
+    async def update_msg_status(self, request:web.Request)->web.Response:
+        await self._delay()
+        if self._fail():
+            return web.Response(status=503, text="injected error")
+        body = await request.json()
+        if "uids" in body:
+            if not self.config.bulk_ack:
+                self.bulk_rejected += 1
+                return web.json_response({"msg": "uid is required"}, status=422)
+            uids = body["uids"]
+        else:
+            uids = [body["uid"]]
+        now = time.monotonic()
+        for uid in uids:
+            self.acks += 1
+            self.acked_at.setdefault(uid, now)
+        if "uids" in body:
+            #NOTE bulk answers confirm every uid, see `ack_outbox.bulk_acked`
+            return web.json_response({"msg": "ok", "acked": uids})
+        return web.json_response({"msg": "ok"})
+
+    async def businesses_available(self, request:web.Request)->web.Response:
+        await self._delay()
+        return web.json_response({"data": self.config.businesses})
+
+    async def stub_stats(self, request:web.Request)->web.Response:
+        return web.json_response(self.stats())
+
+    def stats(self)->dict:
+        total = sum(len(messages) for messages in self.messages.values())
+        return dict(
+            messages=total,
+            emitted=len(self.emitted_at),
+            acked=len(self.acked_at),
+            requests=self.requests,
+            connections=self.connections,
+            acks=self.acks,
+            bulk_rejected=self.bulk_rejected,
+            errors_injected=self.errors_injected,
+            disconnects_injected=self.disconnects_injected,
+            duplicates_injected=self.duplicates_injected,
+        )
+
+
+def add_arguments(parser:argparse.ArgumentParser):
+    "`StubConfig` fields as command line options, shared with `bench-4a.py`"
+    for name, field in StubConfig.model_fields.items():
+        if name=="businesses":
+            parser.add_argument("--businesses", nargs="+", default=field.default, help=field.description)
+        elif field.annotation is bool:
+            parser.add_argument(f"--{name.replace('_','-')}", action="store_true", help=field.description)
+        elif name=="protocol":
+            parser.add_argument("--protocol", choices=["sse","poll"], default=field.default, help=field.description)
+        else:
+            parser.add_argument(f"--{name.replace('_','-')}", type=field.annotation, default=field.default, help=field.description)
+
+
+def config_from_args(args:argparse.Namespace)->StubConfig:
+    return StubConfig(**{name: getattr(args, name) for name in StubConfig.model_fields})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="local stand-in of the 4a server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=12030)
+    add_arguments(parser)
+    args = parser.parse_args()
+    stub = OAStub(config_from_args(args))
+    print(f"[oa stub] {stub.stats()['messages']} messages of {args.businesses}, serving {args.protocol} on {args.host}:{args.port}")
+    web.run_app(stub.app(), host=args.host, port=args.port)
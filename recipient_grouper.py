@@ -0,0 +1,147 @@
+import threading
+from typing import *
+from collections import deque
+
+from schemas import SendMessage
+
+
+def recipient_of(message:SendMessage)->Tuple[str, Optional[str]]:
+    "the session a message is sent to, as `execute_send_message` switches to it"
+    return message.FromWxid, message.ActualName
+
+
+class RecipientGrouper:
+    """
+    Lookahead reordering of a message stream by recipient.
+
+    A feeder thread reads up to `window` messages ahead of the consumer. The consumer gets the next message
+    of the recipient it got the last one for, while there's one held, so messages to the same recipient
+    scattered through the stream are sent back to back, && the session is switched to once for them.
+    Otherwise it gets the oldest message held. Messages to one recipient keep their order.
+
+    Nothing waits for the window to fill: only messages already received are reordered, so a slow stream
+    is passed through as it comes. A recipient gets `max_run` messages in a row at most before the oldest
+    message of another recipient goes, so one recipient can't hold the others back for long.
+    """
+
+    def __init__(self, window:int=16, max_run:Optional[int]=None, key:Callable[[SendMessage], Hashable]=recipient_of):
+        """
+        Args:
+            window(int): messages held ahead of the consumer at most. 0 || 1 passes the stream through.
+            max_run(int): messages to one recipient in a row at most while others wait. Defaults to `window`.
+            key(Callable[[SendMessage], Hashable]): recipient of a message.
+        """
+        self.window = max(window, 1)
+        self.max_run = max_run or self.window
+        self.key = key
+        self._cond = threading.Condition()
+        self._pending:dict[Hashable, deque[Tuple[int, SendMessage]]] = dict()
+        "held messages by recipient, with their arrival number"
+        self._held = 0
+        self._exhausted = False
+        self._error:Optional[BaseException] = None
+        self._stopped = threading.Event()
+        self._current:Optional[Hashable] = None
+        self._run = 0
+        self._last_received:Optional[Hashable] = None
+        self.received = 0
+        self.emitted = 0
+        self.stream_switches = 0
+        "session switches if messages were sent in the order received"
+        self.switches = 0
+        "session switches in the order messages were handed out"
+        self.reordered = 0
+        "messages handed out ahead of an older one"
+
+    def iterate(self, messages:Iterable[SendMessage])->Iterator[SendMessage]:
+        """
+        yield the messages grouped by recipient.
+        Errors of `messages` are raised from the iteration, after the messages received before them.
+        """
+        if self.window <= 1:
+            #NOTE nothing to reorder, no thread needed
+            for message in messages:
+                self._count_received(message)
+                self._count_emitted(self.key(message), False)
+                yield message
+            return
+        feeder = threading.Thread(target=self._feed, args=(messages,), name="recipient-grouper-feeder", daemon=True)
+        feeder.start()
+        try:
+            while True:
+                with self._cond:
+                    while self._held==0 and not self._exhausted:
+                        self._cond.wait()
+                    if self._held==0:
+                        if self._error is not None:
+                            raise self._error
+                        return
+                    message = self._take()
+                    self._cond.notify_all()
+                yield message
+        finally:
+            self._stopped.set()
+            with self._cond:
+                self._cond.notify_all()
+
+    def _count_received(self, message:SendMessage):
+        key = self.key(message)
+        if self._last_received is not None and key != self._last_received:
+            self.stream_switches += 1
+        self._last_received = key
+        self.received += 1
+
+    def _count_emitted(self, key:Hashable, overtook:bool):
+        if self._current is not None and key != self._current:
+            self.switches += 1
+            self._run = 0
+        self._current = key
+        self._run += 1
+        self.emitted += 1
+        if overtook:
+            self.reordered += 1
+
+    def _feed(self, messages:Iterable[SendMessage]):
+        try:
+            for message in messages:
+                with self._cond:
+                    while self._held >= self.window and not self._stopped.is_set():
+                        self._cond.wait(0.5)
+                    if self._stopped.is_set():
+                        return
+                    self._count_received(message)
+                    self._pending.setdefault(self.key(message), deque()).append((self.received, message))
+                    self._held += 1
+                    self._cond.notify_all()
+        except BaseException as exc:
+            with self._cond:
+                self._error = exc
+        finally:
+            with self._cond:
+                self._exhausted = True
+                self._cond.notify_all()
+
+    def _take(self)->SendMessage:
+        "next message to hand out. Condition must be held, && a message too"
+        if self._current in self._pending and (self._run < self.max_run or len(self._pending) == 1):
+            key = self._current
+        else:
+            #NOTE oldest message of the other recipients
+            key = min(
+                (other for other in self._pending if other != self._current),
+                key=lambda other: self._pending[other][0][0])
+        queue = self._pending[key]
+        seq, message = queue.popleft()
+        if not queue:
+            del self._pending[key]
+        self._held -= 1
+        overtook = any(pending[0][0] < seq for pending in self._pending.values())
+        self._count_emitted(key, overtook)
+        return message
+
+    def stats(self)->dict:
+        with self._cond:
+            return dict(
+                received=self.received, emitted=self.emitted, held=self._held,
+                reordered=self.reordered, stream_switches=self.stream_switches, switches=self.switches,
+                switches_avoided=max(self.stream_switches-self.switches, 0))
@@ -0,0 +1,123 @@
+import gzip
+import json
+import asyncio
+import traceback
+from typing import *
+from pathlib import Path
+from collections import Counter, defaultdict
+from datetime import datetime, date, timedelta
+
+import shortuuid
+from sqlmodel import select, delete
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from logg import logger
+from schemas import HttpMessageStatus, HttpMessageStatusDaily
+from tools import DB_Client
+
+
+class RetentionJob:
+    """
+    Background retention of `http_message_status`.
+
+    Rows older than `retain_days` are, batch by batch:
+    1. exported to date-partitioned, compressed files: `{archive_dir}/day={YYYY-MM-DD}/part-*.jsonl.gz`
+       (or `.parquet`, which needs pandas && pyarrow);
+    2. rolled up into daily per-target && per-outcome counts in `http_message_status_daily`;
+    3. deleted from the hot table.
+    Rollup && delete are committed together, while the export happens before the commit.
+    So a crash in between may archive a batch twice, but never loses one.
+
+    Batches are small && separated by `batch_pause` seconds,
+    so the consumer writing statuses never waits long for the write lock.
+    """
+
+    def __init__(
+            self,
+            db_client:DB_Client,
+            archive_dir:Union[str,Path],
+            retain_days:int=30,
+            batch_size:int=500,
+            batch_pause:float=0.2,
+            file_format:Literal["jsonl","parquet"]="jsonl"):
+        self.db_client = db_client
+        self.archive_dir = Path(archive_dir)
+        self.retain_days = retain_days
+        self.batch_size = batch_size
+        self.batch_pause = batch_pause
+        self.file_format = file_format
+        self.archived_total = 0
+
+    async def run_forever(self, interval:float=3600.0):
+        "run `run_once` every `interval` seconds. Errors are logged, the job keeps going."
+        while True:
+            try:
+                await self.run_once()
+            except Exception:
+                logger.error(f"[retention] failed: {traceback.format_exc()}")
+            await asyncio.sleep(interval)
+
+    async def run_once(self, now:Optional[datetime]=None)->int:
+        """
+        archive every row older than retention.
+        Returns:
+            out(int): number of rows archived
+        """
+        self.db_client.detect_migrated()
+        cutoff = (now or datetime.now()) - timedelta(days=self.retain_days)
+        archived = 0
+        while True:
+            batch = await self._archive_batch(cutoff)
+            if batch==0:
+                break
+            archived += batch
+            await asyncio.sleep(self.batch_pause)
+        if archived:
+            self.archived_total += archived
+            logger.info(f"[retention] archived {archived} rows created before {cutoff.isoformat(timespec='seconds')}")
+        return archived
+
+    async def _archive_batch(self, cutoff:datetime)->int:
+        statement = (select(HttpMessageStatus)
+                     .where(HttpMessageStatus.created_time < cutoff)
+                     .order_by(HttpMessageStatus.created_time)
+                     .limit(self.batch_size))
+        #NOTE read && export without holding the writer connection, the consumer shares it
+        async with AsyncSession(self.db_client.reader_engine) as asess:
+            rows = (await asess.scalars(statement)).all()
+        if not rows:
+            return 0
+
+        by_day:dict[date, List[dict]] = defaultdict(list)
+        counts:Counter[tuple] = Counter()
+        for row in rows:
+            day = row.created_time.date()
+            by_day[day].append(row.model_dump(mode="json"))
+            counts[(day, row.send_to, row.success)] += 1
+
+        await asyncio.to_thread(self._export, by_day)
+
+        async with AsyncSession(self.db_client.adb_engine) as asess:
+            for (day, send_to, success), count in counts.items():
+                rollup = await asess.get(HttpMessageStatusDaily, (day, send_to, success))
+                if rollup is None:
+                    asess.add(HttpMessageStatusDaily(day=day, send_to=send_to, success=success, count=count))
+                else:
+                    rollup.count += count
+            await asess.execute(
+                delete(HttpMessageStatus).where(HttpMessageStatus.id.in_([row.id for row in rows])))
+            await asess.commit()
+        return len(rows)
+
+    def _export(self, by_day:dict[date, List[dict]]):
+        for day, records in by_day.items():
+            partition = self.archive_dir / f"day={day.isoformat()}"
+            partition.mkdir(parents=True, exist_ok=True)
+            part_name = f"part-{shortuuid.uuid()}"
+            if self.file_format=="parquet":
+                import pandas as pd #NOTE imported lazily, parquet needs pyarrow as well
+                pd.DataFrame(records).to_parquet(partition / f"{part_name}.parquet", index=False)
+            else:
+                with gzip.open(partition / f"{part_name}.jsonl.gz", "wt", encoding="utf8") as f:
+                    for record in records:
+                        f.write(json.dumps(record, ensure_ascii=False)+"\n")
@@ -0,0 +1,126 @@
+import time
+import sqlite3
+import threading
+from typing import *
+from pathlib import Path
+from datetime import datetime
+
+
+class RunCheckpoint:
+    """
+    Progress of 4a runs, one sqlite file shared by every business.
+
+    A run of a business lasts till the server sends `[DONE]`. Until then, delivered && failed uids are recorded
+    along with the position in the stream (events received so far), so a run restarted after a crash || reboot
+    resumes: uids delivered already are skipped locally, without UI work || a request to the server.
+    Failed uids are sent again when the server sends them again, their attempts are counted.
+
+    Thread safe.
+    """
+
+    def __init__(self, path:Union[str,Path], busy_timeout:float=5.0):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._delivered:dict[int, set[str]] = dict()
+        "delivered uids of unfinished runs, by run id. Checked for every message, so kept in memory"
+        self._conn = sqlite3.connect(
+            str(self.path), timeout=busy_timeout,
+            isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS runs(
+                run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                business TEXT NOT NULL,
+                started_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                position INTEGER NOT NULL DEFAULT 0,
+                restarts INTEGER NOT NULL DEFAULT 0,
+                finished_at REAL
+            );
+            CREATE INDEX IF NOT EXISTS runs_unfinished ON runs(business) WHERE finished_at IS NULL;
+            CREATE TABLE IF NOT EXISTS uids(
+                run_id INTEGER NOT NULL,
+                uid TEXT NOT NULL,
+                state TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 1,
+                failure_reason TEXT,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY(run_id, uid)
+            );
+        """)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def begin(self, business:str)->Tuple[int, bool]:
+        """
+        resume the unfinished run of the business, || start a new one.
+        Returns:
+            out(tuple[int, bool]): run id, && whether it's resumed
+        """
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT run_id FROM runs WHERE business=? AND finished_at IS NULL ORDER BY run_id DESC LIMIT 1",
+                (business,)).fetchone()
+            if row is None:
+                run_id = self._conn.execute(
+                    "INSERT INTO runs(business, started_at, updated_at) VALUES (?,?,?)", (business, now, now)).lastrowid
+                self._delivered[run_id] = set()
+                return run_id, False
+            run_id = row[0]
+            self._conn.execute("UPDATE runs SET restarts=restarts+1, updated_at=? WHERE run_id=?", (now, run_id))
+            self._delivered[run_id] = {
+                uid for (uid,) in self._conn.execute(
+                    "SELECT uid FROM uids WHERE run_id=? AND state='delivered'", (run_id,))}
+            return run_id, True
+
+    def is_delivered(self, run_id:int, uid:str)->bool:
+        with self._lock:
+            return uid in self._delivered.get(run_id, ())
+
+    def record(self, run_id:int, uid:str, position:int, failure_reason:Optional[str]=None):
+        "record the result of a uid, && the position in the stream it was received at"
+        now = time.time()
+        state = "failed" if failure_reason else "delivered"
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    "INSERT INTO uids(run_id, uid, state, failure_reason, updated_at) VALUES (?,?,?,?,?)"
+                    " ON CONFLICT(run_id, uid) DO UPDATE SET state=excluded.state, attempts=attempts+1,"
+                    " failure_reason=excluded.failure_reason, updated_at=excluded.updated_at",
+                    (run_id, uid, state, failure_reason, now))
+                self._conn.execute(
+                    "UPDATE runs SET position=MAX(position, ?), updated_at=? WHERE run_id=?", (position, now, run_id))
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            if state=="delivered":
+                self._delivered.setdefault(run_id, set()).add(uid)
+
+    def finish(self, run_id:int):
+        "the server sent `[DONE]`. The next run of the business starts over"
+        with self._lock:
+            self._conn.execute("UPDATE runs SET finished_at=?, updated_at=? WHERE run_id=?", (time.time(), time.time(), run_id))
+            self._delivered.pop(run_id, None)
+
+    def summary(self, run_id:int)->dict:
+        with self._lock:
+            business, started_at, position, restarts, finished_at = self._conn.execute(
+                "SELECT business, started_at, position, restarts, finished_at FROM runs WHERE run_id=?", (run_id,)).fetchone()
+            counts = dict(self._conn.execute(
+                "SELECT state, COUNT(*) FROM uids WHERE run_id=? GROUP BY state", (run_id,)).fetchall())
+        return dict(
+            run_id=run_id,
+            business=business,
+            started_time=datetime.fromtimestamp(started_at).isoformat(timespec="seconds"),
+            position=position,
+            restarts=restarts,
+            delivered=counts.get("delivered", 0),
+            failed=counts.get("failed", 0),
+            finished=finished_at is not None,
+        )
@@ -0,0 +1,150 @@
+import csv
+from typing import *
+from pathlib import Path
+from datetime import datetime
+from collections import Counter
+
+from logg import logger
+
+
+REPORT_COLUMNS = ["发送时间", "角色", "姓名", "联系电话", "发送结果", "报错原因（若报错）"]
+INDEX_COLUMNS = ["run_id", "业务", "开始时间", "结束时间", "是否完成", "总数", "成功", "失败", "报告文件"]
+
+
+class RunReportWriter:
+    """
+    Report of one 4a run, written as the run goes, so exporting takes time proportional to this run only.
+
+    Rows are appended to `{report_dir}/{business}-{run_id}.csv` && flushed one by one, so they survive a crash,
+    && a resumed run (same run id) appends to the same file. Success && failure counts are rolled up meanwhile.
+    On `close`:
+    - with `file_format="xlsx"`, the csv is converted by a write-only workbook into a `.xlsx` with a detail sheet
+      && a rollup sheet. The csv is removed once the run is finished, till then a resumed run appends to it.
+      Needs openpyxl, falls back to keeping the csv without it;
+    - the run is upserted into `{report_dir}/index.csv`, one row per run with its rollup.
+    """
+
+    def __init__(
+            self,
+            report_dir:Union[str,Path],
+            run_id:int,
+            business:str,
+            file_format:Literal["xlsx","csv"]="xlsx",
+            started_time:Optional[str]=None):
+        """
+        Args:
+            report_dir(str|Path): directory of reports && the index. Created if not exists.
+            run_id(int): id of the run, `RunCheckpoint` run id. The same id resumes the report.
+            business(str): business of the run.
+            file_format(str): xlsx || csv.
+            started_time(str): when the run started, defaults to now.
+        """
+        self.report_dir = Path(report_dir)
+        self.report_dir.mkdir(parents=True, exist_ok=True)
+        self.run_id = run_id
+        self.business = business
+        self.file_format = file_format
+        self.started_time = started_time or datetime.now().isoformat(timespec="seconds")
+        self.csv_path = self.report_dir / f"{business}-{run_id}.csv"
+        self.results:Counter[str] = Counter()
+        self.failure_reasons:Counter[str] = Counter()
+        if self.csv_path.exists():
+            #NOTE resumed run, restore rollups of the rows written before
+            with self.csv_path.open("r", encoding="utf-8-sig", newline="") as f:
+                for row in csv.DictReader(f):
+                    self._roll_up(row)
+            self._file = self.csv_path.open("a", encoding="utf-8", newline="")
+            self._writer = csv.DictWriter(self._file, fieldnames=REPORT_COLUMNS)
+        else:
+            #NOTE utf-8-sig so Excel opens the csv right
+            self._file = self.csv_path.open("w", encoding="utf-8-sig", newline="")
+            self._writer = csv.DictWriter(self._file, fieldnames=REPORT_COLUMNS)
+            self._writer.writeheader()
+
+    def _roll_up(self, row:dict):
+        self.results[row["发送结果"]] += 1
+        if row.get("报错原因（若报错）"):
+            self.failure_reasons[row["报错原因（若报错）"]] += 1
+
+    def write(self, row:dict):
+        "append one result, keyed by `REPORT_COLUMNS`"
+        self._writer.writerow({column: row.get(column) for column in REPORT_COLUMNS})
+        self._file.flush()
+        self._roll_up(row)
+
+    def rollup(self)->dict:
+        return dict(
+            total=sum(self.results.values()),
+            succeeded=self.results.get("成功", 0),
+            failed=self.results.get("失败", 0),
+            failure_reasons=dict(self.failure_reasons.most_common(20)),
+        )
+
+    def close(self, finished:bool)->Path:
+        """
+        write the report file && update the index.
+        Returns:
+            out(Path): report file
+        """
+        self._file.close()
+        report_path = self.csv_path
+        if self.file_format=="xlsx":
+            try:
+                report_path = self._to_xlsx()
+            except ImportError:
+                logger.warning("openpyxl is not installed, report is kept as csv")
+            else:
+                if finished:
+                    self.csv_path.unlink()
+        self._update_index(report_path, finished)
+        return report_path
+
+    def _to_xlsx(self)->Path:
+        from openpyxl import Workbook #NOTE imported lazily, only needed for xlsx reports
+
+        xlsx_path = self.csv_path.with_suffix(".xlsx")
+        workbook = Workbook(write_only=True)
+        detail = workbook.create_sheet("明细")
+        with self.csv_path.open("r", encoding="utf-8-sig", newline="") as f:
+            for row in csv.reader(f):
+                detail.append(row)
+        rollup = self.rollup()
+        summary = workbook.create_sheet("汇总")
+        for row in (
+                ["业务", self.business],
+                ["开始时间", self.started_time],
+                ["总数", rollup["total"]],
+                ["成功", rollup["succeeded"]],
+                ["失败", rollup["failed"]],
+                [],
+                ["报错原因", "次数"],
+                *[[reason, count] for reason, count in rollup["failure_reasons"].items()]):
+            summary.append(row)
+        workbook.save(xlsx_path)
+        return xlsx_path
+
+    def _update_index(self, report_path:Path, finished:bool):
+        "the index has one row per run, rewritten whole: it's small"
+        index_path = self.report_dir / "index.csv"
+        rows = []
+        if index_path.exists():
+            with index_path.open("r", encoding="utf-8-sig", newline="") as f:
+                rows = [row for row in csv.DictReader(f) if row["run_id"]!=str(self.run_id) or row["业务"]!=self.business]
+        rollup = self.rollup()
+        rows.append({
+            "run_id": self.run_id,
+            "业务": self.business,
+            "开始时间": self.started_time,
+            "结束时间": datetime.now().isoformat(timespec="seconds"),
+            "是否完成": "是" if finished else "否",
+            "总数": rollup["total"],
+            "成功": rollup["succeeded"],
+            "失败": rollup["failed"],
+            "报告文件": report_path.name,
+        })
+        temp_path = index_path.with_suffix(".tmp")
+        with temp_path.open("w", encoding="utf-8-sig", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=INDEX_COLUMNS)
+            writer.writeheader()
+            writer.writerows(rows)
+        temp_path.replace(index_path)
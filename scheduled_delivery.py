@@ -0,0 +1,192 @@
+import time
+import sqlite3
+import threading
+from typing import *
+from pathlib import Path
+from datetime import datetime
+
+from pydantic import BaseModel, Field
+
+from schemas import SendMessage, MessageStateEnum, MessageLifecycle
+from message_queues import business_label
+
+
+class PreStaged(BaseModel):
+    """work done ahead for a scheduled message, so only UI work is left when it's due"""
+    message_id:str
+    session_name:str
+    "session name with invisible characters stripped, the same way `CmccChatClient.search` does"
+    at_list:List[str]=Field(default_factory=list)
+    "names to @, parsed from `SenderWxid`"
+    filepath:Optional[Path]=None
+    "decoded attachment, referenced in `AttachmentStore`. Must be released after sending"
+    message:SendMessage
+    "the message without its file, to match cancellations"
+
+
+def parse_at_list(message:SendMessage)->List[str]:
+    "names to @ in `SenderWxid`, divided by 中文逗号"
+    if not message.SenderWxid:
+        return []
+    return [i for i in message.SenderWxid.split("，") if i!=""]
+
+
+def clean_session_name(session_name:str)->str:
+    "strip invisible characters(\\ufeff, \\xa0, \\u3000) callers copy along with session names"
+    return session_name.replace('\u3000','').replace("\xa0","").replace("\ufeff","")
+
+
+class DeliveryTimer:
+    """
+    Persistent timer of messages whose `SendTime` is in the future.
+
+    Messages are kept in a sqlite file until due, so they survive restarts,
+    && the file can be shared by API workers adding messages && the UI worker releasing them.
+    The UI worker looks ahead with `upcoming` to pre-stage near-due messages,
+    && `remove`s them once they're released into the outbound queue.
+
+    Thread safe. Every process opens its own instance.
+    """
+
+    def __init__(self, path:Union[str,Path], busy_timeout:float=5.0):
+        """
+        Args:
+            path(str|Path): sqlite file. Created if not exists.
+            busy_timeout(float): seconds to wait for the write lock held by other processes.
+        """
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            str(self.path), timeout=busy_timeout,
+            isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS scheduled(
+                message_id TEXT PRIMARY KEY,
+                payload TEXT NOT NULL,
+                caller TEXT NOT NULL DEFAULT '',
+                idempotency_key TEXT,
+                target TEXT NOT NULL DEFAULT '',
+                business TEXT NOT NULL DEFAULT 'none',
+                created_at REAL NOT NULL DEFAULT 0,
+                send_time REAL NOT NULL,
+                scheduled_at REAL NOT NULL
+            );
+        """)
+        self._add_missing_columns()
+        self._conn.executescript("""
+            CREATE INDEX IF NOT EXISTS scheduled_send_time ON scheduled(send_time);
+            CREATE INDEX IF NOT EXISTS scheduled_idempotency ON scheduled(idempotency_key) WHERE idempotency_key IS NOT NULL;
+            CREATE INDEX IF NOT EXISTS scheduled_target ON scheduled(target);
+            CREATE INDEX IF NOT EXISTS scheduled_business ON scheduled(business);
+        """)
+
+    def _add_missing_columns(self):
+        "timers created before `target`, `business` && `created_at` were columns get them, filled from payloads once"
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(scheduled)")}
+        if "created_at" in columns:
+            return
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            self._conn.execute("ALTER TABLE scheduled ADD COLUMN target TEXT NOT NULL DEFAULT ''")
+            self._conn.execute("ALTER TABLE scheduled ADD COLUMN business TEXT NOT NULL DEFAULT 'none'")
+            self._conn.execute("ALTER TABLE scheduled ADD COLUMN created_at REAL NOT NULL DEFAULT 0")
+            self._conn.executemany(
+                "UPDATE scheduled SET target=?, business=?, created_at=? WHERE message_id=?",
+                [self._match_columns(SendMessage.model_validate_json(payload)) + (message_id,)
+                 for message_id, payload in self._conn.execute("SELECT message_id, payload FROM scheduled").fetchall()])
+            self._conn.execute("COMMIT")
+        except BaseException:
+            self._conn.execute("ROLLBACK")
+            raise
+
+    @staticmethod
+    def _match_columns(message:SendMessage)->Tuple[str, str, float]:
+        "target, business && created time cancellations match by, the same as `tombstone_matches`"
+        created = message.CreatedTime.timestamp() if message.CreatedTime else 0.0
+        return message.FromWxid, business_label(message), created
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def add(self, message:SendMessage, caller:str=""):
+        "hold `message` until its `SendTime`"
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO scheduled(message_id, payload, caller, idempotency_key, target, business, created_at,"
+                " send_time, scheduled_at) VALUES (?,?,?,?,?,?,?,?,?)",
+                (str(message.id), message.model_dump_json(), caller, message.IdempotencyKey,
+                 *self._match_columns(message), message.SendTime.timestamp(), time.time()))
+
+    def find_duplicate(self, idempotency_key:str)->Optional[str]:
+        "id of the scheduled message with `idempotency_key`, if any"
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT message_id FROM scheduled WHERE idempotency_key=? LIMIT 1", (idempotency_key,)).fetchone()
+        return row[0] if row else None
+
+    def upcoming(self, until:float, limit:int=1000)->List[Tuple[SendMessage, str]]:
+        """
+        messages due before `until` in unix timestamp, soonest first. They stay in the timer until `remove`.
+        Returns:
+            out(list[tuple[SendMessage, str]]): messages && their callers
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT payload, caller FROM scheduled WHERE send_time<=? ORDER BY send_time LIMIT ?",
+                (until, limit)).fetchall()
+        return [(SendMessage.model_validate_json(payload), caller) for payload, caller in rows]
+
+    def remove(self, message_ids:Iterable[str])->int:
+        with self._lock:
+            return self._conn.executemany(
+                "DELETE FROM scheduled WHERE message_id=?", [(i,) for i in message_ids]).rowcount
+
+    def cancel(self, kind:str, value:str, at:float)->List[SendMessage]:
+        """
+        remove scheduled messages the tombstone matches. See `CancellationIndex` for kinds.
+        Returns:
+            out(list[SendMessage]): messages removed
+        """
+        column = dict(message_id="message_id", business="business", target="target")[kind]
+        condition, params = f"{column}=?", (value,)
+        if kind!="message_id":
+            condition += " AND created_at<=?"
+            params += (at,)
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._conn.execute(f"SELECT payload FROM scheduled WHERE {condition}", params).fetchall()
+                self._conn.execute(f"DELETE FROM scheduled WHERE {condition}", params)
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+        return [SendMessage.model_validate_json(payload) for (payload,) in rows]
+
+    def next_due(self)->Optional[float]:
+        "unix timestamp the soonest message is due at, None if nothing is scheduled"
+        with self._lock:
+            return self._conn.execute("SELECT MIN(send_time) FROM scheduled").fetchone()[0]
+
+    def pending(self)->int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM scheduled").fetchone()[0]
+
+    def lifecycles(self, message_ids:Iterable[str])->dict[str, MessageLifecycle]:
+        "lifecycles of the messages still waiting for their `SendTime`, by message id"
+        message_ids = list(message_ids)
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT message_id, send_time, scheduled_at FROM scheduled WHERE message_id IN ({','.join('?'*len(message_ids))})",
+                message_ids).fetchall() if message_ids else []
+        return {
+            message_id: MessageLifecycle(
+                message_id=message_id,
+                state=MessageStateEnum.scheduled,
+                timestamps={MessageStateEnum.scheduled: datetime.fromtimestamp(scheduled_at)},
+                estimated_send_time=datetime.fromtimestamp(send_time))
+            for message_id, send_time, scheduled_at in rows
+        }
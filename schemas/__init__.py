@@ -1,14 +1,24 @@
-from .desktop_controls import (
-    TopLevelControl,
-    Session,
-    EditBlock,
-    ChatInterface,
-    HistoryMessage,
-    WindowsChooseFileBlock,
-)
+import sys
+if sys.platform=="win32":
+    #NOTE desktop controls need uiautomation, windows only.
+    # The rest is importable anywhere, e.g. by the 4a load test (`bench-4a.py`) on linux
+    from .desktop_controls import (
+        TopLevelControl,
+        Session,
+        EditBlock,
+        ChatInterface,
+        HistoryMessage,
+        WindowsChooseFileBlock,
+    )
 from .exceptions import *
 from .general import (
     SendMessage,
     HttpMessageStatusBase,
-    HttpMessageStatus
+    HttpMessageStatus,
+    HttpMessageStatusDaily,
+    MessageStateEnum,
+    MessageLifecycle,
+    BulkTemplate,
+    BulkRecipient,
+    CancelRequest,
 )
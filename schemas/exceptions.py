@@ -5,4 +5,13 @@ class ChatInterfaceNotEnabled(Exception):...
 
 class AtListNotFound(Exception):...
 
-class FileTransferError(Exception):...
\ No newline at end of file
+class FileTransferError(Exception):...
+
+class AdmissionRejected(Exception):
+    """message is rejected by admission control.
+    `reason` is one of queue_full, queue_delay, caller_quota;
+    `retry_after` is the estimated seconds after which the caller may retry."""
+    def __init__(self, message:str, reason:str, retry_after:float):
+        super().__init__(message)
+        self.reason = reason
+        self.retry_after = retry_after
\ No newline at end of file
@@ -4,9 +4,9 @@ from typing import *
 from pathlib import Path
 
 from pytz import timezone
-from datetime import datetime
+from datetime import datetime, date
 from pydantic import BaseModel, field_validator, Field
-from sqlmodel import SQLModel, Field, Column, Text, Boolean, Uuid, DateTime
+from sqlmodel import SQLModel, Field, Column, Text, Boolean, Uuid, DateTime, Date, Integer
 
 
 class BusinessesEnum(enum.Enum):
@@ -41,6 +41,24 @@ class BusinessesEnum(enum.Enum):
                 optional_list.append(f"{value}（可选，已完成开发）")
         return "\n".join(optional_list)
 
+    @property
+    def priority(self)->int:
+        "default priority of the business. The larger, the more urgent"
+        return BUSINESS_PRIORITIES.get(self.name, DEFAULT_PRIORITY)
+
+
+MAX_PRIORITY=9
+DEFAULT_PRIORITY=5
+"priority of messages without `Business`"
+BUSINESS_PRIORITIES:dict[str,int]={
+    BusinessesEnum.outage.name: 9, # 停机影响客户使用，最紧急
+    BusinessesEnum.arrears.name: 7,
+    BusinessesEnum.low_quality.name: 5,
+    BusinessesEnum.cmoit.name: 5,
+    BusinessesEnum.flexible.name: 3,
+    BusinessesEnum.invoice.name: 1,
+}
+
 
 class SendMessage(BaseModel):
     """Message to send to chatbot client."""
@@ -86,12 +104,43 @@ class SendMessage(BaseModel):
     Whether the message is successfully sent to client and receive its 200 returns.
     `200 returns` means the client has successfully send the message to UI chatbot.
     """
-    SendTime: Optional[datetime] = None
+    SendTime: Optional[datetime] = Field(
+        default=None,
+        description="[http_server] datetime the message is scheduled to be sent at. Messages with a future SendTime are held until due")
     """
-    datetime this entry is successfully sent to client and receive its 200 returns.
-    `200 returns` means the client has successfully send the message to UI chatbot.
+    datetime the message is scheduled to be sent at.
+    Messages with a future SendTime are held in a persistent timer && released into queue when due.
+    """
+    Priority: Optional[int] = Field(
+        default=None, ge=0, le=MAX_PRIORITY,
+        description="[only used in http_server] 0~9, the larger the more urgent. Defaults to the priority of `Business`")
+    """
+    0~9, the larger the more urgent. Defaults to the priority of `Business`.
+    """
+    Deadline: Optional[datetime] = Field(
+        default=None,
+        description="[only used in http_server] datetime the message should be sent before. Messages are served earliest-deadline-first")
+    """
+    datetime the message should be sent before.
+    Messages without deadline get an implicit one from their priority.
+    """
+
+    IdempotencyKey: Optional[str] = Field(
+        default=None, max_length=256,
+        description="[only used in http_server] retries with the same key within the dedup window are sent once. Header `Idempotency-Key` takes precedence")
+    """
+    caller-supplied key. Retries with the same key within the dedup window are sent once.
     """
 
+    @property
+    def priority(self)->int:
+        "priority of the message, falls back to the priority of its business"
+        if self.Priority is not None:
+            return self.Priority
+        if self.Business:
+            return self.Business.priority
+        return DEFAULT_PRIORITY
+
     @field_validator("File")
     @classmethod
     def validate_file(cls, var):
@@ -102,11 +151,89 @@ class SendMessage(BaseModel):
         return var
 
 
+class MessageStateEnum(str, enum.Enum):
+    scheduled="scheduled"
+    "waiting for its `SendTime`"
+    queued="queued"
+    "waiting in queue"
+    preparing="preparing"
+    "taken by the consumer, preparing attachments"
+    sending="sending"
+    "UI is typing/pasting the message"
+    confirming="confirming"
+    "waiting for the UI to show the message is sent"
+    sent="sent"
+    failed="failed"
+
+    @classmethod
+    def finished(cls):
+        return [cls.sent, cls.failed]
+
+
+class MessageLifecycle(BaseModel):
+    """lifecycle of a message in http_server, kept in memory"""
+    message_id:str
+    "unique message id"
+    state:MessageStateEnum=MessageStateEnum.queued
+    "current state"
+    timestamps:Dict[MessageStateEnum, datetime]=Field(default_factory=dict)
+    "datetime the message first entered each state"
+    queue_position:Optional[int]=None
+    "0-based position in queue. Only available when state==queued"
+    estimated_send_time:Optional[datetime]=None
+    "estimated datetime the message is sent, from moving average of recent UI durations. Unavailable once finished"
+    failure_reason:Optional[str]=None
+
+
+class BulkTemplate(BaseModel):
+    """the first line of a bulk send: one template shared by every recipient of the batch"""
+    Template:str
+    """
+    message text. `{name}` is substituted by the recipient's variable `name`. Literal braces are written as `{{` && `}}`
+    """
+    Business:Optional[BusinessesEnum]=None
+    File:Optional[str]=None
+    "file in base64, sent to every recipient"
+    Filename:Optional[str]=None
+    Priority:Optional[int]=Field(default=None, ge=0, le=MAX_PRIORITY)
+    Deadline:Optional[datetime]=None
+
+    @field_validator("File")
+    @classmethod
+    def validate_file(cls, var):
+        if var:
+            assert "base64" in var, "File in string only supports base64 encode!"
+        return var
+
+
+class CancelRequest(BaseModel):
+    """messages to cancel. Every condition given is applied, each on its own"""
+    message_ids:List[str]=Field(default_factory=list, max_length=1000)
+    "cancel these messages"
+    batch_id:Optional[str]=None
+    "cancel recipients of the bulk send not sent yet"
+    business:Optional[BusinessesEnum]=None
+    "cancel messages of the business received before now"
+    target:Optional[str]=None
+    "cancel messages to the session name(`FromWxid`) received before now"
+
+
+class BulkRecipient(BaseModel):
+    """every line after the template of a bulk send: one recipient"""
+    FromWxid:str
+    "session name to send to"
+    ActualName:Optional[str]=""
+    SenderWxid:Optional[str]=""
+    "member names to @ in a group session, divided by 中文逗号"
+    Variables:Dict[str,Any]=Field(default_factory=dict)
+    "values substituted into `BulkTemplate.Template`"
+
+
 class HttpMessageStatusBase(SQLModel):
     message_id: str = Field(
         title="message id",
         description="unique message id",
-        sa_column=Column("message_id", Text(), nullable=False))
+        sa_column=Column("message_id", Text(), nullable=False, index=True))
     "unique message id"
 
     send_to: str = Field(
@@ -154,11 +281,44 @@ class HttpMessageStatus(HttpMessageStatusBase, table=True):
         default_factory=lambda : datetime.now(),
         title="created time",
         description="entry created time",
-        sa_column=Column("created_time", DateTime(timezone=False), nullable=False)
+        sa_column=Column("created_time", DateTime(timezone=False), nullable=False, index=True)
     )
     "entry created time"
 
 
+class HttpMessageStatusDaily(SQLModel, table=True):
+    """
+    daily rollup of `http_message_status`.
+    Rows older than retention are counted here before being archived && deleted.
+    """
+    __tablename__ = "http_message_status_daily"
+
+    day: date = Field(
+        title="day",
+        description="day the messages were created",
+        sa_column=Column("day", Date(), primary_key=True))
+    "day the messages were created"
+
+    send_to: str = Field(
+        title="send to",
+        description="session name messages sent to",
+        sa_column=Column("send_to", Text(), primary_key=True))
+    "session name messages sent to"
+
+    success: bool = Field(
+        title="success signal",
+        description="outcome of the messages",
+        sa_column=Column("success", Boolean(), primary_key=True))
+    "outcome of the messages"
+
+    count: int = Field(
+        title="count",
+        description="number of messages",
+        default=0,
+        sa_column=Column("count", Integer(), nullable=False, default=0))
+    "number of messages"
+
+
 if __name__ == '__main__':
     from rich import print
     message_status = HttpMessageStatus.model_validate(
@@ -0,0 +1,142 @@
+import time
+import random
+import threading
+from typing import *
+from pathlib import Path
+
+from pydantic import BaseModel
+
+
+class SimulatedHistoryMessage(BaseModel):
+    "a message of a session, as much of `HistoryMessage` as `send_stable` && `DeliveryVerifier` read"
+    message_type:Optional[Literal["text","file"]] = None
+    message:Optional[str] = None
+    filename:Optional[str] = None
+    send_failure:bool = False
+    read_already:Optional[str] = None
+
+
+class Delivery(NamedTuple):
+    session_name:str
+    kind:Literal["text","file"]
+    content:str
+    "text sent, || name of the file sent"
+    delivered_at:float
+    "`time.monotonic()` when the send finished"
+
+
+class SimulatedChatClient:
+    """
+    Stands in for `CmccChatClient` where there's no desktop, e.g. load testing the 4a scripts on linux.
+
+    Every operation sleeps its configured time in the calling thread, as UI work holds it, && sends are recorded
+    in `deliveries`. A share of sends (`failure_rate`) show as failed in the session history, so `send_stable`
+    sends them again, && only the sends that showed as sent are delivered.
+    Like `CmccChatClient`, a send switches to its session first, unless `assume_current` is passed && the
+    session is open already.
+    Each session keeps its history, a send shows as still sending for `confirm_polls` reads of it.
+    """
+    description = "simulated desktop chatbot"
+
+    def __init__(
+            self,
+            switch_seconds:float=0.05,
+            send_seconds:float=0.05,
+            file_seconds_per_mb:float=0.2,
+            read_seconds:float=0.05,
+            confirm_polls:int=1,
+            failure_rate:float=0.0,
+            seed:int=0,
+            **kwargs):
+        """
+        Args:
+            switch_seconds(float): seconds to switch to a session.
+            send_seconds(float): seconds to paste && send a text.
+            file_seconds_per_mb(float): seconds to choose && send a file, per MB, at least `send_seconds`.
+            read_seconds(float): seconds to refresh && read the history of the session.
+            confirm_polls(int): history reads a send shows as still sending for, before it's sent || failed.
+            failure_rate(float): share of sends that fail.
+            seed(int): random seed of failures.
+            kwargs: arguments of `CmccChatClient`, e.g. `wait_before_refresh`. Ignored.
+        """
+        self.switch_seconds = switch_seconds
+        self.send_seconds = send_seconds
+        self.file_seconds_per_mb = file_seconds_per_mb
+        self.read_seconds = read_seconds
+        self.confirm_polls = max(confirm_polls, 1)
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._current_session:Optional[str] = None
+        self._history:dict[str, List[list]] = dict()
+        "sends by session: `[kind, content, failed, history reads left before it shows]`"
+        self.deliveries:List[Delivery] = []
+        self.switches = 0
+        self.switches_skipped = 0
+        "sends with `assume_current` that found their session open"
+        self.sends = 0
+        self.failures = 0
+        self.history_reads = 0
+        self.ui_seconds = 0.0
+
+    def _busy(self, seconds:float):
+        time.sleep(seconds)
+        self.ui_seconds += seconds
+
+    def switch_session(self, session_name:str, **kwargs):
+        self._busy(self.switch_seconds)
+        with self._lock:
+            self._current_session = session_name
+            self.switches += 1
+
+    def _send(self, session_name:str, kind:str, content:str, seconds:float, assume_current:bool=False):
+        if assume_current and session_name == self._current_session:
+            with self._lock:
+                self.switches_skipped += 1
+        else:
+            self.switch_session(session_name)
+        self._busy(seconds)
+        failed = self.random.random() < self.failure_rate
+        with self._lock:
+            self.sends += 1
+            self._history.setdefault(session_name, []).append([kind, content, failed, self.confirm_polls-1])
+            if failed:
+                self.failures += 1
+            else:
+                self.deliveries.append(Delivery(session_name, kind, content, time.monotonic()))
+
+    def send_message(self, session_name:str, message:str, from_clipboard:bool=True, at_list:List[str]=None, **kwargs):
+        self._send(session_name, "text", message, self.send_seconds, kwargs.get("assume_current", False))
+
+    def send_file(self, session_name:str, filepath:Union[Path,str], **kwargs):
+        size_mb = Path(filepath).stat().st_size/1024/1024
+        self._send(
+            session_name, "file", Path(filepath).name, max(self.send_seconds, self.file_seconds_per_mb*size_mb),
+            kwargs.get("assume_current", False))
+
+    def get_session_history_msgs(self, only_last_msg:bool=True)->List[SimulatedHistoryMessage]:
+        self._busy(self.read_seconds)
+        with self._lock:
+            self.history_reads += 1
+            sends = self._history.get(self._current_session, [])
+            if not sends:
+                return [SimulatedHistoryMessage(read_already="未读")]
+            history = []
+            for send in sends[-1:] if only_last_msg else sends:
+                kind, content, failed, polls_left = send
+                shown = SimulatedHistoryMessage(
+                    message_type=kind, message=content if kind=="text" else None, filename=content if kind=="file" else None)
+                if polls_left > 0:
+                    send[3] -= 1
+                elif failed:
+                    shown.send_failure = True
+                else:
+                    shown.read_already = "未读"
+                history.append(shown)
+            return history
+
+    def stats(self)->dict:
+        with self._lock:
+            return dict(
+                switches=self.switches, switches_skipped=self.switches_skipped, sends=self.sends, failures=self.failures, history_reads=self.history_reads,
+                deliveries=len(self.deliveries), ui_seconds=round(self.ui_seconds, 3))
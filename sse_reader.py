@@ -0,0 +1,165 @@
+import time
+import queue
+import threading
+from typing import *
+
+import requests
+
+from logg import logger
+from schemas import SendMessage
+
+
+class _Done:
+    "sentinel put into the buffer when the server sends `[DONE]`"
+
+
+class SSEReader:
+    """
+    Reads `data: ` events of a server-sent event stream in a background thread into a bounded buffer,
+    so network reads overlap UI work of the consumer iterating it.
+
+    - backpressure: when the buffer is full the reader stops reading, so TCP holds the rest on the server side;
+    - reconnect: if the stream breaks || ends without `[DONE]`, the reader connects again with exponential backoff.
+      Messages the server sends again after reconnecting are skipped by their uid.
+
+    Iterate it to get messages, the iteration stops at `[DONE]`.
+    Errors the reader gives up on (http 4xx, too many reconnects) are raised from the iteration.
+    """
+
+    def __init__(
+            self,
+            session:requests.Session,
+            url:str,
+            payload:dict,
+            buffer_size:int=32,
+            max_reconnects:int=10,
+            reconnect_delay:float=1.0,
+            max_reconnect_delay:float=30.0):
+        """
+        Args:
+            session(requests.Session): session to post with. Requests of other threads may share it.
+            url(str): stream url, requested by POST with `payload` as json.
+            buffer_size(int): messages read ahead of the consumer at most.
+            max_reconnects(int): reconnects in a row without receiving anything before giving up.
+            reconnect_delay(float): seconds before the first reconnect, doubled every failure in a row.
+            max_reconnect_delay(float): cap of the reconnect delay.
+        """
+        self.session = session
+        self.url = url
+        self.payload = payload
+        self.max_reconnects = max_reconnects
+        self.reconnect_delay = reconnect_delay
+        self.max_reconnect_delay = max_reconnect_delay
+        self.buffer:queue.Queue = queue.Queue(maxsize=buffer_size)
+        self._seen:set[str] = set()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="sse-reader", daemon=True)
+        self.received = 0
+        self.duplicates = 0
+        self.reconnects = 0
+        self.blocked_seconds = 0.0
+        "seconds the reader waited on a full buffer"
+
+    def start(self)->"SSEReader":
+        self._thread.start()
+        return self
+
+    def stop(self, timeout:float=5.0):
+        "stop reading. The stream is closed when the reader notices, at most one event later"
+        self._stopped.set()
+        self._thread.join(timeout)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def __iter__(self)->Iterator[SendMessage]:
+        while True:
+            item = self.buffer.get()
+            if item is _Done:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+
+    def stats(self)->dict:
+        return dict(
+            received=self.received,
+            duplicates=self.duplicates,
+            reconnects=self.reconnects,
+            buffered=self.buffer.qsize(),
+            blocked_seconds=round(self.blocked_seconds, 3),
+        )
+
+    def _put(self, item)->bool:
+        "put into buffer, waiting while it's full. False if stopped meanwhile"
+        start = time.perf_counter()
+        while not self._stopped.is_set():
+            try:
+                self.buffer.put(item, timeout=0.5)
+            except queue.Full:
+                continue
+            self.blocked_seconds += time.perf_counter()-start
+            return True
+        return False
+
+    def _run(self):
+        failures = 0
+        while not self._stopped.is_set():
+            received = self.received
+            try:
+                if self._read_stream():
+                    return
+                #NOTE server closed the stream without [DONE]
+                logger.warning(f"[sse] stream of {self.url} ended without [DONE], reconnecting")
+            except requests.HTTPError as exc:
+                if exc.response is not None and exc.response.status_code < 500:
+                    self._put(exc)
+                    return
+                logger.warning(f"[sse] {exc}, reconnecting")
+            except (requests.RequestException, OSError) as exc:
+                logger.warning(f"[sse] stream broken: {exc!r}, reconnecting")
+            except Exception as exc:
+                #NOTE invalid event, the consumer decides what to do
+                self._put(exc)
+                return
+            #NOTE only failures in a row without receiving anything count toward `max_reconnects`
+            failures = 1 if self.received > received else failures+1
+            if failures > self.max_reconnects:
+                self._put(ConnectionError(f"stream of {self.url} failed {failures} times in a row"))
+                return
+            self.reconnects += 1
+            self._stopped.wait(min(self.reconnect_delay*2**(failures-1), self.max_reconnect_delay))
+
+    def _read_stream(self)->bool:
+        """
+        read one connection till it ends.
+        Returns:
+            out(bool): True if the reader is done: `[DONE]` received || stopped
+        """
+        with self.session.post(url=self.url, json=self.payload, stream=True) as resp:
+            if resp.status_code!=200:
+                raise requests.HTTPError(f"{resp.status_code} {resp.text}", response=resp)
+            logger.debug(f"[sse] connected to {self.url}")
+            resp.encoding = "utf-8" #NOTE event streams are always utf-8, whatever the content type says
+            for chunk in resp.iter_lines(delimiter="\n\n", decode_unicode=True):
+                if self._stopped.is_set():
+                    return True
+                if not chunk.startswith("data: "):
+                    continue
+                chunk = chunk.removeprefix("data: ")
+                if chunk=="[DONE]":
+                    self._put(_Done)
+                    return True
+                message = SendMessage.model_validate_json(chunk)
+                uid = str(message.id)
+                if uid in self._seen:
+                    self.duplicates += 1
+                    continue
+                self._seen.add(uid)
+                self.received += 1
+                if not self._put(message):
+                    return True
+        return self._stopped.is_set()
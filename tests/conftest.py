@@ -0,0 +1,15 @@
+import sys
+import types
+from pathlib import Path
+
+#NOTE modules live at the repository root, next to the scripts that import them
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+#NOTE the real `chatbots` needs windows && the desktop client. ui_worker && http_server import it,
+# the parts under test never touch the client, so a stand-in is enough, as bench-4a.py does
+try:
+    import chatbots
+except ImportError:
+    chatbots = types.ModuleType("chatbots")
+    chatbots.CmccChatClient = object
+    sys.modules["chatbots"] = chatbots
@@ -0,0 +1,116 @@
+import threading
+
+import pytest
+import requests
+
+from ack_outbox import AckOutbox, bulk_acked
+
+
+class FakeResponse:
+    def __init__(self, status_code:int, body):
+        self.status_code = status_code
+        self.body = body
+        self.text = str(body)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def json(self):
+        return self.body
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code}", response=self)
+
+
+class FakeServer:
+    """
+    answers bulk posts by `bulk(uids)` -> (status, body), single posts 200.
+    Records every uid it was asked to acknowledge && the timeout of every post.
+    """
+    def __init__(self, bulk):
+        self.bulk = bulk
+        self.bulk_posts:list = []
+        self.single_posts:list = []
+        self.timeouts:set = set()
+        self._lock = threading.Lock()
+
+    def post(self, url, json, timeout=None):
+        with self._lock:
+            self.timeouts.add(timeout)
+            if "uids" in json:
+                self.bulk_posts.append(json["uids"])
+                return FakeResponse(*self.bulk(json["uids"]))
+            self.single_posts.append(json["uid"])
+            return FakeResponse(200, {"msg": "ok"})
+
+
+def outbox(tmp_path, server:FakeServer)->AckOutbox:
+    return AckOutbox(tmp_path/"outbox.jsonl", server, "http://oa/update-msg-status", linger=0.01, max_backoff=0.05, timeout=3)
+
+
+def acknowledge(tmp_path, server:FakeServer, uids:list)->AckOutbox:
+    ack_outbox = outbox(tmp_path, server).start()
+    for uid in uids:
+        ack_outbox.add(uid)
+    assert ack_outbox.wait_empty(5)
+    ack_outbox.close()
+    return ack_outbox
+
+
+def test_bulk_acked_reads_per_uid_results_or_flag():
+    assert bulk_acked(["a", "b"], {"acked": ["b", "x"]}) == ["b"]
+    assert bulk_acked(["a", "b"], {"success": True}) == ["a", "b"]
+    assert bulk_acked(["a", "b"], {"success": False}) == []
+    assert bulk_acked(["a", "b"], {"msg": "ok"}) is None
+    assert bulk_acked(["a", "b"], ["a"]) is None
+
+
+def test_bulk_confirmed_uids_only(tmp_path):
+    server = FakeServer(lambda uids: (200, {"acked": uids}))
+    ack_outbox = acknowledge(tmp_path, server, ["a", "b", "c"])
+    assert sorted(uid for post in server.bulk_posts for uid in post) == ["a", "b", "c"]
+    assert server.single_posts == []
+    assert (ack_outbox.acked, ack_outbox.bulk) == (3, True)
+    assert server.timeouts == {3}
+
+
+def test_partial_bulk_answer_retries_the_rest(tmp_path):
+    answers = iter([["a"], ["b"]])
+    server = FakeServer(lambda uids: (200, {"acked": next(answers, uids)}))
+    ack_outbox = acknowledge(tmp_path, server, ["a", "b"])
+    assert ack_outbox.failures >= 1
+    assert server.bulk_posts[-1] == ["b"]
+
+
+@pytest.mark.parametrize("answer", [
+    (200, {"msg": "ok"}), (200, "not json"), (422, {"msg": "uid is required"}),
+    (200, {"success": False}), (200, {"acked": []})])
+def test_falls_back_to_one_by_one(tmp_path, answer):
+    server = FakeServer(lambda uids: answer)
+    ack_outbox = acknowledge(tmp_path, server, ["a", "b"])
+    assert not ack_outbox.bulk
+    assert sorted(server.single_posts) == ["a", "b"]
+    assert len(server.bulk_posts) == 1
+
+
+def test_pending_uids_are_replayed_when_reopened(tmp_path):
+    down = FakeServer(lambda uids: (503, {}))
+    ack_outbox = outbox(tmp_path, down).start()
+    ack_outbox.add("a")
+    ack_outbox.add("b")
+    ack_outbox.close(timeout=0.1)
+
+    server = FakeServer(lambda uids: (200, {"acked": uids}))
+    reopened = outbox(tmp_path, server)
+    assert reopened.replayed == 2
+    assert "a" in reopened
+    reopened.start()
+    assert reopened.wait_empty(5)
+    reopened.close()
+    leftover = outbox(tmp_path, server)
+    assert leftover.replayed == 0
+    leftover.close()
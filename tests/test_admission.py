@@ -0,0 +1,70 @@
+import pytest
+
+from admission import AdmissionController
+from schemas import AdmissionRejected
+from tools import ServiceRateEstimator
+
+
+def controller(service_seconds:float=2.0, **kwargs)->AdmissionController:
+    return AdmissionController(ServiceRateEstimator(initial=service_seconds), **kwargs)
+
+
+def rejection(admission:AdmissionController, *args, **kwargs)->AdmissionRejected:
+    with pytest.raises(AdmissionRejected) as info:
+        admission.admit(*args, **kwargs)
+    return info.value
+
+
+def test_admits_within_bounds():
+    admission = controller(max_queue_delay=60, max_queue_size=100)
+    admission.admit("a", "m1", 10)
+    assert admission.outstanding["a"] == 1
+
+
+def test_full_queue_is_rejected():
+    exc = rejection(controller(max_queue_size=5), "a", "m1", 5)
+    assert exc.reason == "queue_full"
+    assert exc.retry_after >= 1
+
+
+def test_long_delay_is_rejected_with_retry_after():
+    admission = controller(service_seconds=2.0, max_queue_delay=10)
+    admission.admit("a", "m1", 5)
+    exc = rejection(admission, "a", "m2", 8)
+    assert exc.reason == "queue_delay"
+    assert exc.retry_after == 6
+    assert admission.rejected["queue_delay"] == 1
+
+
+def test_caller_quota_until_release():
+    admission = controller(per_caller_quota=2)
+    admission.admit("a", "m1", 0)
+    admission.admit("a", "m2", 1)
+    assert rejection(admission, "a", "m3", 2).reason == "caller_quota"
+    admission.admit("b", "m4", 2)
+    admission.release("m1")
+    admission.admit("a", "m3", 2)
+
+
+def test_caller_depth_counted_elsewhere_holds_nothing():
+    admission = controller(per_caller_quota=2)
+    admission.admit("a", "m1", 0, caller_depth=1)
+    assert not admission.outstanding
+    assert rejection(admission, "a", "m2", 0, caller_depth=2).reason == "caller_quota"
+
+
+def test_room_matches_admit():
+    admission = controller(service_seconds=2.0, max_queue_delay=10, max_queue_size=100)
+    for depth in range(10):
+        room = admission.room(depth)
+        for admitted in range(room):
+            admission.admit("a", f"{depth}-{admitted}", depth+admitted)
+        with pytest.raises(AdmissionRejected):
+            admission.admit("a", f"{depth}-over", depth+room)
+
+
+def test_room_bounded_by_size_and_never_negative():
+    admission = controller(service_seconds=0.0, max_queue_size=5)
+    assert admission.room(2) == 3
+    assert admission.room(9) == 0
+    assert controller(service_seconds=5.0, max_queue_delay=10).room(50) == 0
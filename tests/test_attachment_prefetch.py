@@ -0,0 +1,98 @@
+import time
+import base64
+
+import pytest
+
+from schemas import SendMessage
+from attachment_store import AttachmentStore
+from attachment_prefetch import AttachmentPrefetcher
+
+
+def with_file(data:bytes, filename:str="a.txt")->SendMessage:
+    return SendMessage(
+        Content="x", Filename=filename,
+        File="data:text/plain;base64,"+base64.b64encode(data).decode())
+
+
+@pytest.fixture
+def store(tmp_path):
+    return AttachmentStore(tmp_path/"attachments")
+
+
+def test_files_are_ready_when_the_ui_reaches_them(store):
+    prefetcher = AttachmentPrefetcher(store, lookahead=2)
+    messages = [with_file(f"file {i}".encode(), f"{i}.txt") for i in range(3)]+[SendMessage(Content="no file")]
+    seen = []
+    for message in prefetcher.iterate(messages):
+        seen.append(message.Content)
+        if message.File:
+            with prefetcher.checkout(message) as path:
+                assert path.read_bytes() == base64.b64decode(message.File.split(",", 1)[1])
+    prefetcher.close()
+    assert seen == ["x", "x", "x", "no file"]
+    stats = prefetcher.stats()
+    assert (stats["prefetched"], stats["hits"], stats["misses"], stats["prepared_bytes"]) == (3, 3, 0, 0)
+    assert store.stats()["entries"] == 3
+
+
+def test_skipped_and_failed_jobs_are_decoded_by_the_ui(store, monkeypatch):
+    prefetcher = AttachmentPrefetcher(store)
+    prepare = prefetcher._prepare
+
+    def flaky_prepare(string, filename):
+        if filename == "broken.txt":
+            raise IOError("disk full")
+        return prepare(string, filename)
+
+    monkeypatch.setattr(prefetcher, "_prepare", flaky_prepare)
+    skipped, broken, good = with_file(b"skipped"), with_file(b"broken", "broken.txt"), with_file(b"good", "good.txt")
+    for message in prefetcher.iterate([skipped, broken, good], skip=lambda message: message is skipped):
+        with prefetcher.checkout(message) as path:
+            assert path.read_bytes() == base64.b64decode(message.File.split(",", 1)[1])
+    prefetcher.close()
+    stats = prefetcher.stats()
+    assert (stats["prefetched"], stats["hits"], stats["misses"], stats["prepared_bytes"]) == (2, 1, 2, 0)
+
+
+def test_discarded_and_unsent_files_are_released(store):
+    prefetcher = AttachmentPrefetcher(store, lookahead=4)
+    messages = [with_file(f"file {i}".encode(), f"{i}.txt") for i in range(3)]
+    iterator = prefetcher.iterate(messages)
+    prefetcher.discard(next(iterator))
+    time.sleep(0.2)
+    prefetcher.close()
+    assert prefetcher.stats()["prepared_bytes"] == 0
+    #NOTE released files stay cached, but nothing holds them any more
+    assert all(entry.refs == 0 for entry in store._entries.values())
+
+
+def test_budget_holds_back_decoding(store):
+    prefetcher = AttachmentPrefetcher(store, lookahead=4, max_bytes=10)
+    messages = [with_file(bytes(8), f"{i}.bin") for i in range(3)]
+    iterator = prefetcher.iterate(messages)
+    first = next(iterator)
+    time.sleep(0.2)
+    #NOTE one file is always allowed, the second waits till the first is released
+    assert prefetcher.stats()["prefetched"] == 1
+    with prefetcher.checkout(first):
+        pass
+    for message in iterator:
+        with prefetcher.checkout(message):
+            pass
+    prefetcher.close()
+    assert prefetcher.stats()["prefetched"] == 3
+    assert prefetcher.stats()["prepared_bytes"] == 0
+
+
+def test_source_errors_come_after_messages_received(store):
+    def source():
+        yield SendMessage(Content="a")
+        raise ConnectionError("stream broken")
+
+    prefetcher = AttachmentPrefetcher(store)
+    received = []
+    with pytest.raises(ConnectionError):
+        for message in prefetcher.iterate(source()):
+            received.append(message.Content)
+    prefetcher.close()
+    assert received == ["a"]
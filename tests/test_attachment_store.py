@@ -0,0 +1,65 @@
+import pytest
+
+from attachment_store import AttachmentStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    return AttachmentStore(tmp_path / "attachments", max_bytes=10)
+
+
+def test_same_content_is_stored_once(store):
+    first = store.acquire(b"12345", "a.txt")
+    second = store.acquire(b"12345", "b.txt")
+    assert first.parent == second.parent
+    assert first.read_bytes() == second.read_bytes() == b"12345"
+    stats = store.stats()
+    assert (stats["entries"], stats["hits"], stats["misses"], stats["bytes_saved"]) == (1, 1, 1, 5)
+
+
+def test_referenced_entries_are_not_evicted(store):
+    kept = store.acquire(b"123456", "kept.txt")
+    evictable = store.acquire(b"abcdef", "evictable.txt")
+    store.release(evictable)
+    assert store.stats()["evictions"] == 1
+    assert not evictable.exists()
+    assert kept.exists()
+    store.release(kept)
+    assert kept.exists(), "under max_bytes once the other one is evicted"
+
+
+def test_least_recently_used_is_evicted_first(tmp_path):
+    store = AttachmentStore(tmp_path, max_bytes=8)
+    old = store.acquire(b"1111", "old.txt")
+    recent = store.acquire(b"2222", "recent.txt")
+    store.release(old)
+    store.release(recent)
+    store.release(store.acquire(b"1111", "old.txt"))
+    store.release(store.acquire(b"3333", "new.txt"))
+    assert old.exists()
+    assert not recent.exists()
+
+
+def test_missing_file_is_written_again(store):
+    path = store.acquire(b"12345", "a.txt")
+    store.release(path)
+    path.unlink()
+    again = store.acquire(b"12345", "a.txt")
+    assert again.read_bytes() == b"12345"
+
+
+@pytest.mark.parametrize("filename", ["..", ".", "", None, "...", " . ", "../..", "dir/..", "dir\\.."])
+def test_filename_never_leaves_the_digest_directory(store, filename):
+    path = store.acquire(b"12345", filename, mime_type="text/plain")
+    assert path.parent.parent == store.root_dir.absolute()
+    assert path.is_file()
+    assert path.name not in ("", ".", "..")
+
+
+@pytest.mark.parametrize("filename, expected", [
+    ("../../etc/passwd", "passwd"),
+    ("C:\\Users\\me\\report.pdf", "report.pdf"),
+    ("报表.xlsx", "报表.xlsx"),
+])
+def test_filename_keeps_the_basename(store, filename, expected):
+    assert store.acquire(b"12345", filename).name == expected
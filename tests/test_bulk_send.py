@@ -0,0 +1,103 @@
+import time
+import sqlite3
+
+import pytest
+
+from schemas import BulkTemplate, BulkRecipient, MessageStateEnum, MessageLifecycle
+from schemas.general import BusinessesEnum
+from bulk_send import BatchStore, check_template, render
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = BatchStore(tmp_path/"batches.db")
+    yield store
+    store.close()
+
+
+def batch(store:BatchStore, template:str, variables:list, **kwargs)->tuple:
+    batch_id = store.create(BulkTemplate(Template=template, **kwargs), caller="caller")
+    message_ids = store.add(batch_id, [BulkRecipient(FromWxid=f"r{i}", Variables=v) for i, v in enumerate(variables)])
+    return batch_id, message_ids
+
+
+def test_claim_expands_higher_priority_batches_first(store):
+    low, _ = batch(store, "low {n}", [dict(n=1), dict(n=2)], Priority=1)
+    high, high_ids = batch(store, "high {n}", [dict(n=1)], Priority=5)
+    claimed = store.claim(2)
+    assert [(batch_id, message.Content) for batch_id, message in claimed] == [(high, "high 1"), (low, "low 1")]
+    assert str(claimed[0][1].id) == high_ids[0]
+    assert [message.Content for _, message in store.claim(5)] == ["low 2"]
+    assert store.claim(5) == []
+
+
+@pytest.mark.parametrize("template, variables", [
+    ("{missing}", dict(name="x")),
+    ("{name.nope}", dict(name="x")),
+    ("{name[0]}", dict(name=1)),
+    ("{name:d}", dict(name="x")),
+    ("{name:%Y}", dict(name=[1])),
+])
+def test_bad_variables_fail_only_their_recipient(store, template, variables):
+    bad_id, [bad_message_id] = batch(store, template, [variables])
+    good_id, _ = batch(store, "{ok}", [dict(ok="fine")])
+    claimed = store.claim(5)
+    assert [(batch_id, message.Content) for batch_id, message in claimed] == [(good_id, "fine")]
+    lifecycle = store.lifecycles([bad_message_id])[bad_message_id]
+    assert lifecycle.state == MessageStateEnum.failed
+    assert "template can't be filled" in lifecycle.failure_reason
+    assert store.pending() == 0
+
+
+def test_render_and_check_template():
+    assert render("hi {name}, {{literal}}", dict(name="x")) == "hi x, {literal}"
+    check_template("{a} {b.c} {d[0]}")
+    for template in ["{}", "{0}", "{a", "a}"]:
+        with pytest.raises(ValueError):
+            check_template(template)
+
+
+def test_recover_and_cancel(store):
+    batch_id, message_ids = batch(store, "{n}", [dict(n=i) for i in range(3)])
+    store.claim(2)
+    store.publish(MessageLifecycle(message_id=message_ids[0], state=MessageStateEnum.sending))
+    assert store.recover() == (1, 1)
+    not_expanded, expanded = store.cancel("batch_id", batch_id, time.time())
+    assert sorted(not_expanded) == sorted(message_ids[1:])
+    assert expanded == []
+    assert store.summary(batch_id)["states"] == {"failed": 3}
+
+
+def test_cancel_by_target_and_business(store):
+    outage, outage_ids = batch(store, "{n}", [dict(n=1), dict(n=2)], Business=BusinessesEnum.outage)
+    invoice, invoice_ids = batch(store, "{n}", [dict(n=1)], Business=BusinessesEnum.invoice)
+    expanded = store.claim(1)[0][1]
+    not_expanded, claimed = store.cancel("target", "r0", time.time())
+    assert (sorted(not_expanded), claimed) == ([invoice_ids[0]], [str(expanded.id)])
+    not_expanded, _ = store.cancel("business", BusinessesEnum.outage.name, time.time())
+    assert not_expanded == [outage_ids[1]]
+    assert store.pending() == 0
+    assert [recipient["send_to"] for recipient in store.recipients(outage)] == ["r0", "r1"]
+
+
+def test_old_store_gets_business_and_target_columns(tmp_path):
+    conn = sqlite3.connect(tmp_path/"old.db")
+    conn.executescript("""
+        CREATE TABLE batches(batch_id TEXT PRIMARY KEY, template TEXT NOT NULL, caller TEXT NOT NULL DEFAULT '',
+            priority INTEGER NOT NULL, created_at REAL NOT NULL);
+        CREATE TABLE recipients(seq INTEGER PRIMARY KEY AUTOINCREMENT, batch_id TEXT NOT NULL, message_id TEXT NOT NULL UNIQUE,
+            recipient TEXT NOT NULL, claimed INTEGER NOT NULL DEFAULT 0, state TEXT NOT NULL, failure_reason TEXT,
+            updated_at REAL NOT NULL);
+    """)
+    conn.execute("INSERT INTO batches VALUES ('b', ?, '', 5, 0)",
+                 (BulkTemplate(Template="{n}", Business=BusinessesEnum.outage).model_dump_json(),))
+    conn.execute("INSERT INTO recipients(batch_id, message_id, recipient, state, updated_at) VALUES ('b', 'm', ?, 'queued', 0)",
+                 (BulkRecipient(FromWxid="ops", Variables=dict(n=1)).model_dump_json(),))
+    conn.commit()
+    conn.close()
+    store = BatchStore(tmp_path/"old.db")
+    try:
+        assert store.cancel("business", BusinessesEnum.outage.name, time.time()) == (["m"], [])
+        assert store.recipients("b")[0]["send_to"] == "ops"
+    finally:
+        store.close()
@@ -0,0 +1,63 @@
+import asyncio
+
+import pytest
+
+from schemas import SendMessage
+from tools import ServiceRateEstimator
+from business_mux import BusinessMux, parse_weights
+
+
+class FakeClient:
+    "`count` messages per business, || an error after `fail_after` of them"
+    def __init__(self, count:int, fail_after:dict=dict()):
+        self.count = count
+        self.fail_after = fail_after
+
+    async def messages(self, business:str, service=None):
+        for i in range(self.count):
+            if i==self.fail_after.get(business):
+                raise ConnectionError("stream broken")
+            yield SendMessage(Content=f"{business}-{i}")
+
+
+class FakeActor:
+    "records the business of every message handed to the UI, && reports it sent"
+    def __init__(self):
+        self.service_estimator = ServiceRateEstimator()
+        self.sent:list = []
+        self.mux:BusinessMux = None
+
+    async def put(self, message:SendMessage):
+        await asyncio.sleep(0.001)
+        self.sent.append(message.Content.rsplit("-", 1)[0])
+        self.mux.on_result(message, True)
+
+
+def run(weights:dict, client:FakeClient)->tuple:
+    async def scenario():
+        actor = FakeActor()
+        mux = actor.mux = BusinessMux(client, actor, weights, prefetch=2, report_interval=0)
+        await asyncio.wait_for(mux.run(), 10)
+        return actor.sent, {row["business"]: row for row in mux.report()}
+    return asyncio.run(scenario())
+
+
+def test_parse_weights():
+    assert parse_weights("信控停机预警:3，低质专线预警:1,") == {"信控停机预警": 3.0, "低质专线预警": 1.0}
+    for spec in ["a", "a:0", ":1"]:
+        with pytest.raises(ValueError):
+            parse_weights(spec)
+
+
+def test_busy_businesses_share_ui_by_weight():
+    sent, report = run({"a": 3, "b": 1}, FakeClient(100))
+    assert 27 <= sent[:40].count("a") <= 33
+    assert report["a"]["succeeded"] == report["b"]["succeeded"] == 100
+    assert report["a"]["finished"] and report["b"]["finished"]
+
+
+def test_failing_stream_ends_its_business_only():
+    sent, report = run({"a": 1, "b": 1}, FakeClient(20, fail_after=dict(a=5)))
+    assert sent.count("a") == 5 and sent.count("b") == 20
+    assert "stream broken" in report["a"]["error"]
+    assert report["b"]["error"] is None
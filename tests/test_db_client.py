@@ -0,0 +1,94 @@
+import asyncio
+import sqlite3
+
+import pytest
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+from schemas import HttpMessageStatus, HttpMessageStatusBase
+from tools import DB_Client, StorageProfile
+
+
+def url(tmp_path)->str:
+    return f"sqlite+aiosqlite:///{tmp_path/'store.db'}"
+
+
+async def pragmas(engine)->dict:
+    names = ["journal_mode", "synchronous", "mmap_size", "cache_size", "busy_timeout", "query_only"]
+    async with engine.connect() as conn:
+        return {name: (await conn.execute(text(f"PRAGMA {name}"))).scalar() for name in names}
+
+
+def test_profile_pragmas_are_applied(tmp_path):
+    profile = StorageProfile(mmap_size=1024*1024, cache_size=-2048, busy_timeout=1234, reader_pool_size=3)
+
+    async def scenario():
+        db_client = DB_Client(url(tmp_path), profile=profile)
+        try:
+            await db_client.migrate()
+            return await pragmas(db_client.adb_engine), await pragmas(db_client.reader_engine), db_client
+        finally:
+            await db_client.dispose()
+
+    writer, reader, db_client = asyncio.run(scenario())
+    expected = dict(journal_mode="wal", synchronous=1, mmap_size=1024*1024, cache_size=-2048, busy_timeout=1234)
+    assert writer == dict(expected, query_only=0)
+    assert reader == dict(expected, query_only=1)
+    #NOTE one writer connection, a pool of readers
+    assert db_client.adb_engine.pool.size() == 1
+    assert db_client.reader_engine.pool.size() == 3
+
+
+def test_readers_reject_writes(tmp_path):
+    async def scenario():
+        db_client = DB_Client(url(tmp_path))
+        try:
+            await db_client.migrate()
+            async with db_client.reader_engine.begin() as conn:
+                await conn.execute(text("DELETE FROM http_message_status"))
+        finally:
+            await db_client.dispose()
+
+    with pytest.raises(OperationalError, match="readonly"):
+        asyncio.run(scenario())
+
+
+def test_get_matches_any_item_of_a_list(tmp_path):
+    async def scenario():
+        db_client = DB_Client(url(tmp_path))
+        try:
+            await db_client.migrate()
+            for message_id in ["a", "b", "c"]:
+                await db_client.create(
+                    HttpMessageStatusBase(message_id=message_id, send_to="x", content=message_id, success=True),
+                    HttpMessageStatus)
+            listed = [row.message_id async for row in db_client.get(HttpMessageStatus, message_id=["a", "c", "z"])]
+            single = [row.message_id async for row in db_client.get(HttpMessageStatus, message_id="b")]
+            return sorted(listed), single
+        finally:
+            await db_client.dispose()
+
+    assert asyncio.run(scenario()) == (["a", "c"], ["b"])
+
+
+def test_migrate_adds_indexes_missing_from_an_existing_db(tmp_path):
+    async def migrate():
+        db_client = DB_Client(url(tmp_path))
+        try:
+            await db_client.migrate()
+        finally:
+            await db_client.dispose()
+
+    def indexes()->set:
+        with sqlite3.connect(tmp_path/"store.db") as conn:
+            return {row[0] for row in conn.execute(
+                "SELECT name FROM sqlite_master WHERE type='index' AND tbl_name='http_message_status'")}
+
+    asyncio.run(migrate())
+    index = "ix_http_message_status_created_time"
+    assert index in indexes()
+    with sqlite3.connect(tmp_path/"store.db") as conn:
+        conn.execute(f"DROP INDEX {index}")
+    assert index not in indexes()
+    asyncio.run(migrate())
+    assert index in indexes()
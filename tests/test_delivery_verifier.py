@@ -0,0 +1,158 @@
+from schemas import SendMessage
+from simulated_chat import SimulatedHistoryMessage
+from delivery_verifier import DeliveryVerifier, Baseline
+
+
+def sent(text:str)->SimulatedHistoryMessage:
+    return SimulatedHistoryMessage(message_type="text", message=text, read_already="未读")
+
+
+def failed(text:str)->SimulatedHistoryMessage:
+    return SimulatedHistoryMessage(message_type="text", message=text, send_failure=True)
+
+
+class FakeClient:
+    "shows `history[session]` as the history of the session switched to"
+    def __init__(self):
+        self.history:dict = dict()
+        self.current = None
+        self.reads = 0
+
+    def switch_session(self, session_name:str, **kwargs):
+        self.current = session_name
+
+    def get_session_history_msgs(self, only_last_msg:bool=True)->list:
+        self.reads += 1
+        return list(self.history.get(self.current, []))
+
+
+def verifier(client:FakeClient, **kwargs)->DeliveryVerifier:
+    return DeliveryVerifier(client, min_age=0, **kwargs)
+
+
+def test_one_history_read_per_session_confirms_all_parts():
+    client = FakeClient()
+    client.history["a"] = [
+        sent("hello"),
+        SimulatedHistoryMessage(message_type="file", filename="report.xlsx", read_already="未读"),
+        sent("@张三 second")]
+    first, second = SendMessage(Content="hello"), SendMessage(Content="second")
+    deliveries = verifier(client, batch_sessions=1)
+    deliveries.record(first, "text", "hello", "a")
+    deliveries.record(first, "file", "report.xlsx", "a")
+    deliveries.record(second, "text", "second", "a")
+    assert deliveries.due() and deliveries.pending() == 2
+    done, resend = deliveries.verify()
+    assert done == [(second, None), (first, None)] and resend == []
+    assert client.reads == 1 and deliveries.pending() == 0
+
+
+def test_parts_shown_failed_are_resent_then_failed():
+    client = FakeClient()
+    client.history["a"] = [failed("hello")]
+    message = SendMessage(Content="hello")
+    deliveries = verifier(client, max_resends=1)
+    deliveries.record(message, "text", "hello", "a")
+    done, resend = deliveries.verify()
+    assert done == [] and [part.message for part in resend] == [message]
+    deliveries.resent_part(resend[0])
+    client.history["a"].append(failed("hello"))
+    done, resend = deliveries.verify()
+    assert done == [(message, "发送失败，已重发1次")] and resend == []
+    assert deliveries.stats()["failed"] == 1
+
+
+def test_resent_part_confirmed_delivers_the_message():
+    client = FakeClient()
+    client.history["a"] = [failed("hello")]
+    message = SendMessage(Content="hello")
+    deliveries = verifier(client)
+    deliveries.record(message, "text", "hello", "a")
+    _, resend = deliveries.verify()
+    deliveries.resent_part(resend[0])
+    client.history["a"].append(sent("hello"))
+    done, _ = deliveries.verify()
+    assert done == [(message, None)]
+    assert deliveries.stats()["resent"] == 1
+
+
+def test_given_up_part_fails_its_message_once_all_parts_are_done():
+    client = FakeClient()
+    client.history["a"] = [failed("text"), sent("more")]
+    message = SendMessage(Content="text")
+    deliveries = verifier(client)
+    deliveries.record(message, "text", "text", "a")
+    deliveries.record(message, "text", "more", "a")
+    done, resend = deliveries.verify()
+    assert done == [] and len(resend) == 1
+    assert deliveries.give_up(resend[0], "会话切换失败") == (message, "会话切换失败")
+    assert str(message.id) not in deliveries and deliveries.pending() == 0
+
+
+def test_unshown_parts_are_unconfirmed_after_max_checks():
+    client = FakeClient()
+    message = SendMessage(Content="lost")
+    deliveries = verifier(client, max_checks=2)
+    deliveries.record(message, "text", "lost", "a")
+    assert deliveries.verify() == ([], [])
+    assert deliveries.pending() == 1
+    done, resend = deliveries.verify()
+    assert done == [(message, "发送状态未确认")] and resend == []
+    assert deliveries.stats()["unconfirmed"] == 1
+
+
+def test_entries_shown_before_the_send_dont_confirm_it():
+    client = FakeClient()
+    client.history["a"] = [sent("same alert")]
+    message = SendMessage(Content="same alert")
+    deliveries = verifier(client, max_checks=1)
+    deliveries.watch("a", client.history["a"])
+    deliveries.record(message, "text", "same alert", "a")
+    #NOTE the send never showed, only yesterday's alert of the same text is there
+    done, _ = deliveries.verify()
+    assert done == [(message, "发送状态未确认")]
+
+
+def test_verified_history_bounds_later_sends():
+    client = FakeClient()
+    first, second = SendMessage(Content="same alert"), SendMessage(Content="same alert")
+    deliveries = verifier(client, max_checks=1)
+    deliveries.watch("a", [])
+    deliveries.record(first, "text", "same alert", "a")
+    client.history["a"] = [sent("same alert")]
+    assert deliveries.verify()[0] == [(first, None)]
+    assert deliveries.knows("a")
+    deliveries.record(second, "text", "same alert", "a")
+    assert deliveries.verify()[0] == [(second, "发送状态未确认")]
+    client.history["a"].append(sent("same alert"))
+    deliveries.record(second, "text", "same alert", "a")
+    assert deliveries.verify()[0] == [(second, None)]
+
+
+def test_baseline_found_after_history_scrolled():
+    history = [sent("1"), sent("2"), sent("3")]
+    baseline = Baseline.of(history)
+    assert baseline.start(history+[sent("new")]) == 3
+    #NOTE the oldest entries went out of sight
+    assert baseline.start(history[1:]+[sent("new")]) == 2
+    assert baseline.start([sent("new")]) == 0
+    assert Baseline.of([]).start([sent("new")]) == 0
+
+
+def test_failed_history_reads_dont_count_as_checks():
+    client = FakeClient()
+    reads = client.get_session_history_msgs
+
+    def broken_read(only_last_msg=True):
+        raise LookupError("chat interface gone")
+
+    client.get_session_history_msgs = broken_read
+    message = SendMessage(Content="hello")
+    deliveries = verifier(client, max_checks=1)
+    deliveries.record(message, "text", "hello", "a")
+    for _ in range(3):
+        assert deliveries.verify() == ([], [])
+    assert deliveries.pending() == 1 and deliveries.stats()["unconfirmed"] == 0
+    client.get_session_history_msgs = reads
+    client.history["a"] = [sent("hello")]
+    assert deliveries.verify()[0] == [(message, None)]
@@ -0,0 +1,41 @@
+from datetime import datetime, timedelta
+
+from schemas import SendMessage
+from schemas.general import BusinessesEnum
+from digest import DigestSelector, render_digest, digest_key
+
+
+def alert(content:str, to:str="ops", seconds:float=0, **kwargs)->SendMessage:
+    return SendMessage(
+        Content=content, FromWxid=to, Business=BusinessesEnum.outage,
+        CreatedTime=datetime.now()+timedelta(seconds=seconds), **kwargs)
+
+
+def test_merges_same_target_within_window():
+    primary = alert("a")
+    selector = DigestSelector(primary, window=60)
+    assert selector.accepts(alert("b", seconds=30))
+    assert not selector.accepts(alert("c", to="dev"))
+    assert not selector.accepts(alert("d", seconds=120))
+    assert not selector.accepts(alert("e", SenderWxid="张三"))
+    assert [message.Content for message in selector.accepted] == ["a", "b"]
+
+
+def test_caps_messages_and_chars():
+    selector = DigestSelector(alert("a"), window=60, max_messages=3)
+    assert [selector.accepts(alert(str(i))) for i in range(3)] == [True, True, False]
+    assert selector.full
+    selector = DigestSelector(alert("a"), window=60, max_chars=40)
+    assert not selector.accepts(alert("x"*40))
+
+
+def test_files_are_never_merged():
+    assert digest_key(alert("a", File="data:text/plain;base64,YQ==")) is None
+    assert DigestSelector(alert("a", File="data:text/plain;base64,YQ=="), window=60).key is None
+
+
+def test_render_numbers_under_business_header():
+    assert render_digest([alert("only")]) == "only"
+    rendered = render_digest([alert("a"), alert("b")])
+    assert rendered.splitlines()[1:] == ["1. a", "2. b"]
+    assert "共2条" in rendered.splitlines()[0]
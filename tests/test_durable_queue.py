@@ -0,0 +1,117 @@
+import time
+import sqlite3
+
+import pytest
+
+from schemas import SendMessage, MessageStateEnum, MessageLifecycle
+from durable_queue import DurableQueue
+
+
+@pytest.fixture
+def queue(tmp_path):
+    queue = DurableQueue(tmp_path/"queue.db")
+    yield queue
+    queue.close()
+
+
+def put(queue:DurableQueue, content:str, deadline:float, **kwargs)->SendMessage:
+    message = SendMessage(Content=content, Priority=3, **kwargs)
+    assert queue.put(message, deadline) is None
+    return message
+
+
+def test_claim_earliest_deadline_first_and_once(queue):
+    now = time.time()
+    put(queue, "late", now+60)
+    put(queue, "early", now+10)
+    put(queue, "middle", now+30)
+    assert [message.Content for message in queue.claim(2)] == ["early", "middle"]
+    assert [message.Content for message in queue.claim(2)] == ["late"]
+    assert queue.claim(1) == []
+    assert queue.depth() == 3
+
+
+def test_shared_by_instances(tmp_path, queue):
+    put(queue, "a", time.time())
+    other = DurableQueue(tmp_path/"queue.db")
+    try:
+        assert [message.Content for message in other.claim(1)] == ["a"]
+        assert queue.claim(1) == []
+    finally:
+        other.close()
+
+
+def test_recover_requeues_claimed_and_fails_in_flight(queue):
+    now = time.time()
+    claimed = put(queue, "claimed", now)
+    sending = put(queue, "sending", now+1)
+    queue.claim(2)
+    queue.publish(MessageLifecycle(message_id=str(sending.id), state=MessageStateEnum.sending))
+    assert queue.recover() == (1, 1)
+    assert [message.id for message in queue.claim(5)] == [claimed.id]
+    lifecycle = queue.lifecycles([str(sending.id)], 1.0)[0]
+    assert lifecycle.state == MessageStateEnum.failed
+    assert "restarted" in lifecycle.failure_reason
+
+
+def test_idempotency_key_within_window(queue):
+    put(queue, "a", time.time(), IdempotencyKey="k")
+    original = queue.find_duplicate("k", 60)
+    assert original is not None
+    assert queue.put(SendMessage(Content="b", IdempotencyKey="k"), time.time(), idempotency_window=60) == original
+    assert queue.depth() == 1
+
+
+def test_cancel_skips_claimed_and_records_tombstone(queue):
+    now = time.time()
+    claimed = put(queue, "claimed", now, FromWxid="alice")
+    waiting = put(queue, "waiting", now+1, FromWxid="alice")
+    put(queue, "other", now+2, FromWxid="bob")
+    queue.claim(1)
+    assert queue.cancel("target", "alice", time.time()) == [str(waiting.id)]
+    assert [row[1:3] for row in queue.cancellations_since(0)] == [("target", "alice")]
+    assert queue.depth() == 2
+    assert str(claimed.id) not in queue.cancel("message_id", str(claimed.id), time.time())
+
+
+def test_queue_position_from_lifecycles(queue):
+    now = time.time()
+    messages = [put(queue, str(i), now+i) for i in range(3)]
+    lifecycles = queue.lifecycles([str(message.id) for message in messages]+["missing"], 2.0)
+    assert [lifecycle.queue_position for lifecycle in lifecycles[:3]] == [0, 1, 2]
+    assert lifecycles[3] is None
+
+
+def test_claim_matching_looks_up_target_by_index(queue):
+    now = time.time()
+    put(queue, "a1", now, FromWxid="a")
+    put(queue, "b1", now+1, FromWxid="b")
+    put(queue, "a2", now+2, FromWxid="a")
+    put(queue, "a3", now+3, FromWxid="a")
+    claimed = queue.claim_matching(lambda message: message.Content != "a2", "a", limit=5)
+    assert [message.Content for message in claimed] == ["a1", "a3"]
+    assert [message.Content for message in queue.claim(5)] == ["b1", "a2"]
+    plan = " ".join(row[-1] for row in queue._conn.execute(
+        "EXPLAIN QUERY PLAN SELECT seq, payload FROM queue WHERE state='queued' AND claimed=0"
+        " AND target=? ORDER BY deadline, priority DESC, seq LIMIT ?", ("a", 5)))
+    assert "queue_target" in plan
+
+
+def test_queue_without_target_and_business_columns_is_migrated(tmp_path):
+    message = SendMessage(Content="old", FromWxid="a")
+    with sqlite3.connect(tmp_path/"queue.db") as conn:
+        conn.execute("""
+            CREATE TABLE queue(
+                seq INTEGER PRIMARY KEY AUTOINCREMENT, message_id TEXT NOT NULL UNIQUE, payload TEXT NOT NULL,
+                caller TEXT NOT NULL DEFAULT '', idempotency_key TEXT, deadline REAL NOT NULL, priority INTEGER NOT NULL,
+                enqueued_at REAL NOT NULL, claimed INTEGER NOT NULL DEFAULT 0, state TEXT NOT NULL,
+                timestamps TEXT NOT NULL DEFAULT '{}', failure_reason TEXT, updated_at REAL NOT NULL)""")
+        conn.execute(
+            "INSERT INTO queue(message_id, payload, deadline, priority, enqueued_at, state, updated_at)"
+            " VALUES (?,?,?,?,?,?,?)",
+            (str(message.id), message.model_dump_json(), time.time(), 3, time.time(), "queued", time.time()))
+    queue = DurableQueue(tmp_path/"queue.db")
+    try:
+        assert [m.Content for m in queue.claim_matching(lambda m: True, "a", limit=5)] == ["old"]
+    finally:
+        queue.close()
@@ -0,0 +1,72 @@
+import json
+import asyncio
+import importlib
+from pathlib import Path
+
+import pytest
+from fastapi.testclient import TestClient
+
+from bulk_send import BatchStore
+from schemas import HttpMessageStatus, HttpMessageStatusBase
+from tools import DB_Client
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    #NOTE static files are mounted relative to the repository root. Lifespan isn't run, stores are set here
+    monkeypatch.chdir(Path(__file__).resolve().parent.parent)
+    http_server = importlib.import_module("http_server")
+    store = BatchStore(tmp_path/"batches.db")
+    monkeypatch.setattr(http_server, "batch_store", store)
+    yield http_server
+    store.close()
+
+
+def post_bulk(server, lines:list):
+    body = "\n".join(json.dumps(line, ensure_ascii=False) for line in lines)
+    return TestClient(server.app).post("/bulk/", content=body, headers={"Content-Type":"application/x-ndjson"})
+
+
+def test_bulk_rejects_recipients_whose_variables_cant_fill_template(server):
+    response = post_bulk(server, [
+        dict(Template="hi {name.title}, {n:d}"),
+        dict(FromWxid="a", Variables=dict(name="alice", n=1)),
+        dict(FromWxid="b", Variables=dict(name="bob")),
+        dict(FromWxid="c", Variables=dict(name="carol", n="one")),
+    ])
+    result = response.json()
+    assert response.status_code == 200
+    assert (result["accepted"], result["rejected"]) == (1, 2)
+    assert [error["line"] for error in result["errors"]] == [3, 4]
+    assert server.batch_store.pending() == 1
+
+
+def test_bulk_rejects_positional_template(server):
+    response = post_bulk(server, [dict(Template="hi {}"), dict(FromWxid="a")])
+    assert response.status_code == 400
+    assert response.json()["batch_id"] is None
+
+
+def test_check_endpoints_agree_on_the_failed_row(server, tmp_path, monkeypatch):
+    #NOTE text && file of one message are 2 status rows, the file failed
+    db_client = DB_Client(f"sqlite+aiosqlite:///{tmp_path/'store.db'}")
+
+    async def store():
+        await db_client.migrate()
+        for content, success in [("hello", True), ("report.xlsx", False)]:
+            await db_client.create(
+                HttpMessageStatusBase(message_id="m", send_to="a", content=content, success=success), HttpMessageStatus)
+
+    async def no_lifecycles(message_ids):
+        return [None]*len(message_ids)
+
+    asyncio.run(store())
+    monkeypatch.setattr(server, "db_client", db_client)
+    monkeypatch.setattr(server, "get_lifecycles", no_lifecycles)
+    client = TestClient(server.app)
+    single = client.get("/check/", params=dict(message_id="m")).json()
+    bulk = client.post("/check/bulk/", json=["m", "n"]).json()["results"]
+    asyncio.run(db_client.dispose())
+    assert single["message_status"]["content"] == "report.xlsx" and not single["message_status"]["success"]
+    assert bulk["m"] == single
+    assert bulk["n"]["empty"]
@@ -0,0 +1,41 @@
+import time
+
+from idempotency import IdempotencyIndex
+
+
+def test_retry_within_window_gets_original_id():
+    index = IdempotencyIndex(window=60)
+    assert index.reserve("k", "m1") is None
+    assert index.reserve("k", "m2") == "m1"
+    assert index.stats()["duplicates"] == 1
+
+
+def test_key_expires_after_window():
+    index = IdempotencyIndex(window=0.05)
+    index.reserve("k", "m1")
+    time.sleep(0.1)
+    assert index.reserve("k", "m2") is None
+
+
+def test_claim_send_catches_duplicate_admitted_after_expiry():
+    index = IdempotencyIndex(window=60)
+    assert index.claim_send("k", "m1") is None
+    assert index.claim_send("k", "m1") is None
+    assert index.claim_send("k", "m2") == "m1"
+
+
+def test_reserved_but_unsent_original_does_not_block_send():
+    index = IdempotencyIndex(window=60)
+    index.reserve("k", "m1")
+    assert index.claim_send("k", "m2") is None
+
+
+def test_forget_and_max_entries():
+    index = IdempotencyIndex(window=60, max_entries=2)
+    index.reserve("a", "m1")
+    index.forget("a")
+    assert index.reserve("a", "m2") is None
+    index.reserve("b", "m3")
+    index.reserve("c", "m4")
+    assert index.stats()["entries"] == 2
+    assert index.reserve("a", "m5") is None
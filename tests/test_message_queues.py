@@ -0,0 +1,88 @@
+import asyncio
+from datetime import datetime, timedelta
+
+from schemas import SendMessage
+from schemas.general import BusinessesEnum, MAX_PRIORITY
+from message_queues import PriorityMessageQueue, effective_deadline
+
+
+def drain(queue:PriorityMessageQueue)->list:
+    return [queue.get_nowait().Content for _ in range(queue.qsize())]
+
+
+def test_urgent_business_overtakes_bulk():
+    queue = PriorityMessageQueue()
+    queue.put_nowait(SendMessage(Content="invoice", Business=BusinessesEnum.invoice))
+    queue.put_nowait(SendMessage(Content="outage", Business=BusinessesEnum.outage))
+    queue.put_nowait(SendMessage(Content="low_quality", Business=BusinessesEnum.low_quality))
+    assert drain(queue) == ["outage", "low_quality", "invoice"]
+
+
+def test_explicit_deadline_comes_first():
+    queue = PriorityMessageQueue()
+    queue.put_nowait(SendMessage(Content="urgent", Priority=7))
+    queue.put_nowait(SendMessage(Content="due soon", Priority=0, Deadline=datetime.now()+timedelta(seconds=5)))
+    assert drain(queue) == ["due soon", "urgent"]
+
+
+def test_ties_keep_arrival_order():
+    queue = PriorityMessageQueue()
+    for i in range(5):
+        queue.put_nowait(SendMessage(Content=str(i), Priority=3))
+    assert drain(queue) == ["0", "1", "2", "3", "4"]
+
+
+def test_same_deadline_broken_by_priority():
+    deadline = datetime.now()+timedelta(minutes=1)
+    queue = PriorityMessageQueue()
+    queue.put_nowait(SendMessage(Content="low", Priority=1, Deadline=deadline))
+    queue.put_nowait(SendMessage(Content="high", Priority=8, Deadline=deadline))
+    assert drain(queue) == ["high", "low"]
+
+
+def test_bulk_ages_past_newer_urgent():
+    low = SendMessage(Priority=0)
+    high = SendMessage(Priority=MAX_PRIORITY)
+    #NOTE enqueued a full slack of priority levels earlier, the bulk message is due first
+    assert effective_deadline(low, 10.0, enqueued_at=0.0) < effective_deadline(high, 10.0, enqueued_at=MAX_PRIORITY*10.0+1)
+
+
+def test_positions_follow_service_order():
+    queue = PriorityMessageQueue()
+    low = SendMessage(Priority=0)
+    high = SendMessage(Priority=MAX_PRIORITY)
+    queue.put_nowait(low)
+    queue.put_nowait(high)
+    assert queue.positions() == {str(high.id): 0, str(low.id): 1}
+
+
+def test_take_removes_matching_messages_in_queue_order():
+    queue = PriorityMessageQueue()
+    for i, target in enumerate(["a", "b", "a", "a"]):
+        queue.put_nowait(SendMessage(Content=str(i), FromWxid=target, Priority=5))
+    taken = queue.take(lambda message: message.FromWxid=="a", limit=2)
+    assert [message.Content for message in taken] == ["0", "2"]
+    assert drain(queue) == ["1", "3"]
+
+
+def test_take_frees_room_for_waiting_putters():
+    async def scenario():
+        queue = PriorityMessageQueue(maxsize=1)
+        queue.put_nowait(SendMessage(Content="first"))
+        putter = asyncio.create_task(queue.put(SendMessage(Content="second")))
+        await asyncio.sleep(0)
+        assert not putter.done()
+        queue.take(lambda message: True, limit=1)
+        queue.task_done()
+        await asyncio.wait_for(putter, 1.0)
+        return drain(queue)
+    assert asyncio.run(scenario()) == ["second"]
+
+
+def test_missed_deadline_is_counted_by_business():
+    queue = PriorityMessageQueue()
+    late = SendMessage(Business=BusinessesEnum.outage, Deadline=datetime.now()-timedelta(seconds=1))
+    on_time = SendMessage(Business=BusinessesEnum.outage, Deadline=datetime.now()+timedelta(minutes=1))
+    assert queue.check_deadline(late)
+    assert not queue.check_deadline(on_time)
+    assert queue.stats()["missed_deadlines"] == {"outage": 1}
@@ -0,0 +1,59 @@
+from datetime import datetime
+
+from schemas import SendMessage, MessageStateEnum
+from tools import ServiceRateEstimator
+from message_queues import PriorityMessageQueue
+from message_tracker import MessageTracker
+
+
+def queued(tracker:MessageTracker, queue:PriorityMessageQueue, count:int)->list:
+    messages = [SendMessage(Content=str(i), Priority=3) for i in range(count)]
+    for message in messages:
+        queue.put_nowait(message)
+        tracker.transition(str(message.id), MessageStateEnum.queued)
+    return messages
+
+
+def test_queue_position_and_eta():
+    queue = PriorityMessageQueue()
+    tracker = MessageTracker(queue, ServiceRateEstimator(initial=10.0))
+    messages = queued(tracker, queue, 3)
+    before = datetime.now()
+    lifecycles = tracker.get_many([str(message.id) for message in messages])
+    assert [lifecycle.queue_position for lifecycle in lifecycles] == [0, 1, 2]
+    eta = (lifecycles[2].estimated_send_time-before).total_seconds()
+    assert 29 < eta < 31
+
+
+def test_in_flight_message_counts_toward_eta():
+    queue = PriorityMessageQueue()
+    tracker = MessageTracker(queue, ServiceRateEstimator(initial=10.0))
+    first, second = queued(tracker, queue, 2)
+    queue.get_nowait()
+    tracker.transition(str(first.id), MessageStateEnum.preparing)
+    lifecycle = tracker.get(str(second.id))
+    assert lifecycle.queue_position == 0
+    assert (lifecycle.estimated_send_time-datetime.now()).total_seconds() > 19
+    assert tracker.get(str(first.id)).queue_position is None
+
+
+def test_finished_keeps_first_timestamps_and_reason():
+    tracker = MessageTracker(PriorityMessageQueue(), ServiceRateEstimator())
+    tracker.transition("m", MessageStateEnum.queued)
+    tracker.transition("m", MessageStateEnum.failed, "boom")
+    lifecycle = tracker.get("m")
+    assert lifecycle.state == MessageStateEnum.failed
+    assert lifecycle.failure_reason == "boom"
+    assert set(lifecycle.timestamps) == {MessageStateEnum.queued, MessageStateEnum.failed}
+    assert lifecycle.estimated_send_time is None
+
+
+def test_oldest_finished_dropped_and_listeners_called():
+    tracker = MessageTracker(PriorityMessageQueue(), ServiceRateEstimator(), max_finished=2)
+    published = []
+    tracker.listeners.append(published.append)
+    for message_id in "abc":
+        tracker.transition(message_id, MessageStateEnum.sent)
+    assert tracker.get("a") is None
+    assert tracker.get("c").state == MessageStateEnum.sent
+    assert [lifecycle.message_id for lifecycle in published] == ["a", "b", "c"]
@@ -0,0 +1,86 @@
+import importlib
+from pathlib import Path
+
+import pytest
+from fastapi.testclient import TestClient
+
+import metrics
+from metrics import Counter, Gauge, Histogram, MetricsRegistry, stage_timing
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = Histogram("latency_seconds", "latency", ("stage",), buckets=(1, 0.5))
+    for value in (0.2, 0.5, 0.7, 3):
+        histogram.observe(value, stage="send")
+    assert histogram.render() == [
+        "# HELP latency_seconds latency",
+        "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{stage="send",le="0.5"} 2',
+        'latency_seconds_bucket{stage="send",le="1"} 3',
+        'latency_seconds_bucket{stage="send",le="+Inf"} 4',
+        'latency_seconds_sum{stage="send"} 4.4',
+        'latency_seconds_count{stage="send"} 4',
+    ]
+
+
+def test_label_values_are_escaped():
+    counter = Counter("errors_total", "errors", ("error",))
+    counter.inc(error='say "hi"\\\nbye')
+    assert counter.render()[-1] == 'errors_total{error="say \\"hi\\"\\\\\\nbye"} 1'
+
+
+def test_counter_rejects_negative_increments():
+    counter = Counter("sends_total", "sends")
+    counter.inc(2)
+    with pytest.raises(ValueError):
+        counter.inc(-1)
+    assert counter.render()[-1] == "sends_total 2"
+
+
+def test_gauge_function_is_evaluated_on_every_render():
+    depth = [3]
+    gauge = Gauge("depth", "queue depth", function=lambda: depth[0])
+    assert gauge.render()[-1] == "depth 3"
+    depth[0] = 5
+    assert gauge.render()[-1] == "depth 5"
+    labeled = Gauge("store", "store counters", ("counter",), function=lambda: {("hits",): 2, ("misses",): 1})
+    assert labeled.render()[2:] == ['store{counter="hits"} 2', 'store{counter="misses"} 1']
+
+
+def test_broken_gauge_function_renders_no_samples():
+    registry = MetricsRegistry()
+    registry.register(Gauge("broken", "raises", function=lambda: 1/0))
+    registry.register(Counter("ok_total", "still rendered")).inc()
+    assert registry.render() == (
+        "# HELP broken raises\n# TYPE broken gauge\n"
+        "# HELP ok_total still rendered\n# TYPE ok_total counter\nok_total 1\n")
+
+
+def test_stage_timing_as_block_and_decorator(monkeypatch):
+    histogram = Histogram("stage_seconds", "stages", ("stage",))
+    observed = []
+    monkeypatch.setattr(metrics, "UI_STAGE_SECONDS", histogram)
+    monkeypatch.setattr(metrics, "STAGE_OBSERVERS", [lambda stage, seconds: observed.append(stage)])
+
+    @stage_timing("switch")
+    def switch():
+        pass
+
+    switch()
+    with pytest.raises(RuntimeError):
+        with stage_timing("paste"):
+            raise RuntimeError("failed stages are timed too")
+    assert observed == ["switch", "paste"]
+    counts = [line for line in histogram.render() if line.startswith("stage_seconds_count")]
+    assert counts == ['stage_seconds_count{stage="switch"} 1', 'stage_seconds_count{stage="paste"} 1']
+
+
+def test_metrics_endpoint(monkeypatch):
+    monkeypatch.chdir(Path(__file__).resolve().parent.parent)
+    http_server = importlib.import_module("http_server")
+    metrics.ENQUEUED.inc()
+    response = TestClient(http_server.app).get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    assert "# TYPE desktop_chatbot_enqueued_total counter" in response.text
+    assert "desktop_chatbot_queue_depth" in response.text
@@ -0,0 +1,115 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+import pytest
+from aiohttp import web
+
+from tools import ServiceRateEstimator
+from oa_client import Backoff, Credit, OAClient
+
+
+def test_backoff_grows_to_cap_with_full_jitter():
+    backoff = Backoff(base=0.5, factor=2.0, cap=3.0, jitter=False)
+    assert [backoff.delay(attempt) for attempt in range(4)] == [0.5, 1.0, 2.0, 3.0]
+    jittered = Backoff(base=0.5, factor=2.0, cap=3.0)
+    assert all(0 <= jittered.delay(5) <= 3.0 for _ in range(100))
+
+
+def test_credit_covers_one_round_trip_of_ui_work():
+    service = ServiceRateEstimator(initial=0.5)
+    credit = Credit(min_credit=2, max_credit=8, service=service)
+    assert credit.value == 2
+    credit.observe_round_trip(1.2)
+    assert credit.value == 4
+    credit.observe_round_trip(100.0)
+    assert credit.value == 8
+    assert Credit(min_credit=1, max_credit=8).value == 1
+
+
+@asynccontextmanager
+async def serving(app:web.Application):
+    "run `app` on a free local port, yield its address"
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    try:
+        yield f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+    finally:
+        await runner.cleanup()
+
+
+async def poll_against(count:int, batches:bool, max_credit:int)->tuple:
+    "poll a server holding `count` messages, answering `limit` with a list if `batches` -> (contents, limits asked)"
+    pending = [dict(Content=str(i), uid=f"uid-{i}") for i in range(count)]
+    limits = []
+
+    async def get_messages(request:web.Request)->web.Response:
+        limit = (await request.json()).get("limit", 1)
+        limits.append(limit)
+        if batches:
+            answer = pending[:limit]
+            del pending[:limit]
+            return web.json_response(answer)
+        return web.json_response(pending.pop(0) if pending else {"msg": "no more messages"})
+
+    async def update_msg_status(request:web.Request)->web.Response:
+        return web.json_response({"msg": "ok", "acked": (await request.json()).get("uids", [])})
+
+    app = web.Application()
+    app.router.add_post("/get-messages", get_messages)
+    app.router.add_post("/update-msg-status", update_msg_status)
+    async with serving(app) as url:
+        async with OAClient(url, protocol="poll", max_credit=max_credit, backoff=Backoff(jitter=False, base=0.01)) as client:
+            contents = [message.Content async for message in client.messages("alarm")]
+            return contents, limits, client.batch_poll
+
+
+def test_poll_pulls_batches_within_credit():
+    contents, limits, batch_poll = asyncio.run(poll_against(10, batches=True, max_credit=4))
+    assert contents == [str(i) for i in range(10)]
+    assert batch_poll and max(limits) <= 4
+
+
+def test_poll_falls_back_to_one_message_per_request():
+    contents, limits, batch_poll = asyncio.run(poll_against(5, batches=False, max_credit=4))
+    assert contents == [str(i) for i in range(5)]
+    assert batch_poll is False and limits[-1] == 1
+
+
+async def ack_against(answer, uids:list)->tuple:
+    "acknowledge `uids` against a server answering bulk posts by `answer(uids)` -> (status, body)"
+    bulk_posts, single_posts = [], []
+
+    async def update_msg_status(request:web.Request)->web.Response:
+        body = await request.json()
+        if "uids" in body:
+            bulk_posts.append(body["uids"])
+            status, answer_body = answer(body["uids"])
+            return web.json_response(answer_body, status=status)
+        single_posts.append(body["uid"])
+        return web.json_response({"msg": "ok"})
+
+    app = web.Application()
+    app.router.add_post("/update-msg-status", update_msg_status)
+    async with serving(app) as url:
+        async with OAClient(url, backoff=Backoff(jitter=False, base=0.01)) as client:
+            await client.ack(uids)
+            return client.bulk_ack, bulk_posts, sorted(single_posts)
+
+
+def test_bulk_ack_confirmed_by_body():
+    bulk_ack, bulk_posts, single_posts = asyncio.run(ack_against(lambda uids: (200, {"acked": uids}), ["a", "b"]))
+    assert (bulk_ack, bulk_posts, single_posts) == (True, [["a", "b"]], [])
+
+
+def test_unconfirmed_uids_acked_one_by_one():
+    bulk_ack, _, single_posts = asyncio.run(ack_against(lambda uids: (200, {"acked": ["a"]}), ["a", "b", "c"]))
+    assert (bulk_ack, single_posts) == (True, ["b", "c"])
+
+
+@pytest.mark.parametrize("answer", [
+    (200, {"msg": "ok"}), (422, {"msg": "uid is required"}), (200, {"success": False}), (200, {"acked": []})])
+def test_falls_back_when_bulk_confirms_nothing(answer):
+    bulk_ack, _, single_posts = asyncio.run(ack_against(lambda uids: answer, ["a", "b"]))
+    assert (bulk_ack, single_posts) == (False, ["a", "b"])
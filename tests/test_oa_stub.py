@@ -0,0 +1,49 @@
+import asyncio
+
+from aiohttp import web
+
+from oa_client import Backoff, OAClient
+from oa_stub import OAStub, StubConfig
+
+
+async def drain(stub:OAStub, **kwargs)->list:
+    "fetch && acknowledge every message of the stub through `OAClient` -> contents received"
+    runner = web.AppRunner(stub.app())
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    url = f"http://127.0.0.1:{site._server.sockets[0].getsockname()[1]}"
+    try:
+        async with OAClient(url, protocol=stub.config.protocol, backoff=Backoff(jitter=False, base=0.01), **kwargs) as client:
+            contents = []
+            for business in stub.config.businesses:
+                async for message in client.messages(business):
+                    contents.append(message.Content)
+                    await client.ack([str(message.id)])
+            return contents
+    finally:
+        await runner.cleanup()
+
+
+def test_workload_is_reproducible_by_seed():
+    config = StubConfig(messages=20, attachment_ratio=0.5, attachment_kb=1)
+    first, second = OAStub(config), OAStub(config)
+    assert first.messages == second.messages
+    assert any("File" in message for message in first.messages[config.businesses[0]])
+
+
+def test_client_gets_every_message_once_through_injected_faults():
+    stub = OAStub(StubConfig(messages=30, attachment_ratio=0, disconnect_rate=0.1, duplicate_rate=0.2, error_rate=0.1))
+    contents = asyncio.run(drain(stub))
+    assert sorted(contents) == sorted(message["Content"] for message in stub.messages[stub.config.businesses[0]])
+    stats = stub.stats()
+    assert stats["acked"] == stats["messages"] == 30
+    assert stats["disconnects_injected"] and stats["duplicates_injected"] and stats["errors_injected"]
+
+
+def test_poll_without_bulk_ack_is_acknowledged_one_by_one():
+    stub = OAStub(StubConfig(protocol="poll", messages=10, attachment_ratio=0))
+    contents = asyncio.run(drain(stub, max_credit=4))
+    assert len(contents) == 10
+    stats = stub.stats()
+    assert stats["acked"] == 10 and stats["bulk_rejected"] >= 1
@@ -0,0 +1,62 @@
+import time
+
+import pytest
+
+from schemas import SendMessage
+from recipient_grouper import RecipientGrouper
+from simulated_chat import SimulatedChatClient
+
+
+def to(recipient:str, seq:int)->SendMessage:
+    return SendMessage(Content=f"{recipient}{seq}", FromWxid=recipient, ActualName=recipient)
+
+
+def grouped(messages:list, **kwargs)->tuple:
+    grouper = RecipientGrouper(**kwargs)
+    iterator = grouper.iterate(messages)
+    #NOTE let the feeder fill the window before the first message is taken
+    first = next(iterator)
+    time.sleep(0.1)
+    return [first.Content]+[message.Content for message in iterator], grouper.stats()
+
+
+def test_messages_to_one_recipient_go_back_to_back_in_order():
+    stream = [to("a", 1), to("b", 1), to("a", 2), to("c", 1), to("a", 3), to("b", 2)]
+    order, stats = grouped(stream, window=8)
+    assert order == ["a1", "a2", "a3", "b1", "b2", "c1"]
+    assert (stats["stream_switches"], stats["switches"], stats["switches_avoided"]) == (5, 2, 3)
+    assert stats["received"] == stats["emitted"] == 6
+
+
+def test_max_run_lets_waiting_recipients_through():
+    stream = [to("a", i) for i in range(4)]+[to("b", 0)]
+    order, _ = grouped(stream, window=8, max_run=2)
+    assert order == ["a0", "a1", "b0", "a2", "a3"]
+
+
+def test_window_of_one_passes_the_stream_through():
+    stream = [to("a", 1), to("b", 1), to("a", 2)]
+    order, stats = grouped(stream, window=1)
+    assert order == ["a1", "b1", "a2"]
+    assert stats["switches_avoided"] == 0
+
+
+def test_source_errors_come_after_messages_received():
+    def source():
+        yield to("a", 1)
+        raise ConnectionError("stream broken")
+
+    received = []
+    with pytest.raises(ConnectionError):
+        for message in RecipientGrouper(window=4).iterate(source()):
+            received.append(message.Content)
+    assert received == ["a1"]
+
+
+def test_sends_switch_unless_session_assumed_open():
+    client = SimulatedChatClient(switch_seconds=0, send_seconds=0, read_seconds=0)
+    client.send_message("a", "1")
+    client.send_message("a", "2")
+    client.send_message("a", "3", assume_current=True)
+    client.send_message("b", "1", assume_current=True)
+    assert (client.switches, client.switches_skipped) == (3, 1)
@@ -0,0 +1,51 @@
+import gzip
+import json
+import asyncio
+from datetime import datetime, timedelta
+
+from sqlmodel import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from schemas import HttpMessageStatus, HttpMessageStatusBase, HttpMessageStatusDaily
+from tools import DB_Client
+from retention import RetentionJob
+
+
+async def archive(tmp_path, ages_days:list, retain_days:int=30):
+    db_client = DB_Client(f"sqlite+aiosqlite:///{tmp_path/'store.db'}", profile=None)
+    await db_client.migrate()
+    now = datetime.now()
+    try:
+        async with AsyncSession(db_client.adb_engine) as asess:
+            for i, age in enumerate(ages_days):
+                status = HttpMessageStatus.model_validate(HttpMessageStatusBase(
+                    message_id=str(i), send_to="alice" if i%2 else "bob", content=str(i), success=bool(i%2)))
+                status.created_time = now-timedelta(days=age)
+                asess.add(status)
+            await asess.commit()
+        job = RetentionJob(db_client, tmp_path/"archive", retain_days=retain_days, batch_size=2, batch_pause=0)
+        archived = await job.run_once(now)
+        async with AsyncSession(db_client.adb_engine) as asess:
+            kept = sorted(row.message_id for row in (await asess.scalars(select(HttpMessageStatus))).all())
+            daily = (await asess.scalars(select(HttpMessageStatusDaily))).all()
+        return archived, kept, daily
+    finally:
+        await db_client.dispose()
+
+
+def test_only_rows_older_than_retention_are_archived(tmp_path):
+    archived, kept, daily = asyncio.run(archive(tmp_path, [1, 40, 40, 40, 2, 50]))
+    assert archived == 4
+    assert kept == ["0", "4"]
+    assert sum(rollup.count for rollup in daily) == 4
+    records = [
+        json.loads(line)
+        for part in (tmp_path/"archive").glob("day=*/part-*.jsonl.gz")
+        for line in gzip.open(part, "rt", encoding="utf8")]
+    assert sorted(record["message_id"] for record in records) == ["1", "2", "3", "5"]
+
+
+def test_rollup_counts_by_target_and_outcome(tmp_path):
+    _, _, daily = asyncio.run(archive(tmp_path, [40, 40, 40, 40]))
+    counts = {(rollup.send_to, rollup.success): rollup.count for rollup in daily}
+    assert counts == {("bob", False): 2, ("alice", True): 2}
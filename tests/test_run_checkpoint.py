@@ -0,0 +1,54 @@
+import pytest
+
+from run_checkpoint import RunCheckpoint
+
+
+@pytest.fixture
+def path(tmp_path):
+    return tmp_path/"checkpoint.db"
+
+
+def test_restarted_run_resumes_with_delivered_uids(path):
+    checkpoint = RunCheckpoint(path)
+    run_id, resumed = checkpoint.begin("alarm")
+    assert not resumed
+    checkpoint.record(run_id, "a", 1)
+    checkpoint.record(run_id, "b", 2, failure_reason="boom")
+    checkpoint.close()
+
+    restarted = RunCheckpoint(path)
+    try:
+        assert restarted.begin("alarm") == (run_id, True)
+        assert restarted.is_delivered(run_id, "a")
+        assert not restarted.is_delivered(run_id, "b")
+        restarted.record(run_id, "b", 2)
+        summary = restarted.summary(run_id)
+        assert (summary["position"], summary["restarts"], summary["delivered"], summary["failed"]) == (2, 1, 2, 0)
+    finally:
+        restarted.close()
+
+
+def test_finished_run_starts_over(path):
+    checkpoint = RunCheckpoint(path)
+    try:
+        run_id, _ = checkpoint.begin("alarm")
+        checkpoint.record(run_id, "a", 1)
+        checkpoint.finish(run_id)
+        assert checkpoint.summary(run_id)["finished"]
+        next_run, resumed = checkpoint.begin("alarm")
+        assert next_run != run_id and not resumed
+        assert not checkpoint.is_delivered(next_run, "a")
+    finally:
+        checkpoint.close()
+
+
+def test_businesses_have_their_own_runs(path):
+    checkpoint = RunCheckpoint(path)
+    try:
+        alarm, _ = checkpoint.begin("alarm")
+        checkpoint.record(alarm, "a", 1)
+        other, resumed = checkpoint.begin("report")
+        assert other != alarm and not resumed
+        assert not checkpoint.is_delivered(other, "a")
+    finally:
+        checkpoint.close()
@@ -0,0 +1,46 @@
+import csv
+
+import pytest
+
+from run_report import RunReportWriter
+
+
+def row(result:str, reason:str="")->dict:
+    return {"发送时间": "2026-01-01 00:00:00", "姓名": "张三", "发送结果": result, "报错原因（若报错）": reason}
+
+
+def read_csv(path)->list:
+    with path.open("r", encoding="utf-8-sig", newline="") as f:
+        return list(csv.DictReader(f))
+
+
+def test_resumed_run_appends_and_keeps_rollup(tmp_path):
+    report = RunReportWriter(tmp_path, 1, "alarm", file_format="csv")
+    report.write(row("成功"))
+    report.write(row("失败", "超时"))
+    report.close(finished=False)
+
+    resumed = RunReportWriter(tmp_path, 1, "alarm", file_format="csv")
+    resumed.write(row("失败", "超时"))
+    assert resumed.rollup() == dict(total=3, succeeded=1, failed=2, failure_reasons={"超时": 2})
+    path = resumed.close(finished=True)
+    assert [r["发送结果"] for r in read_csv(path)] == ["成功", "失败", "失败"]
+
+
+def test_index_has_one_row_per_run(tmp_path):
+    for finished in (False, True):
+        report = RunReportWriter(tmp_path, 1, "alarm", file_format="csv")
+        report.write(row("成功"))
+        report.close(finished=finished)
+    RunReportWriter(tmp_path, 2, "alarm", file_format="csv").close(finished=True)
+    index = read_csv(tmp_path/"index.csv")
+    assert [(r["run_id"], r["是否完成"], r["总数"]) for r in index] == [("1", "是", "2"), ("2", "是", "0")]
+
+
+def test_finished_xlsx_report_replaces_csv(tmp_path):
+    pytest.importorskip("openpyxl")
+    report = RunReportWriter(tmp_path, 1, "alarm")
+    report.write(row("成功"))
+    path = report.close(finished=True)
+    assert path.suffix == ".xlsx" and path.exists()
+    assert not (tmp_path/"alarm-1.csv").exists()
@@ -0,0 +1,87 @@
+import time
+import sqlite3
+from datetime import datetime, timedelta
+
+import pytest
+
+from schemas import SendMessage, MessageStateEnum
+from schemas.general import BusinessesEnum
+from scheduled_delivery import DeliveryTimer, parse_at_list, clean_session_name
+
+
+@pytest.fixture
+def timer(tmp_path):
+    timer = DeliveryTimer(tmp_path/"schedule.db")
+    yield timer
+    timer.close()
+
+
+def scheduled(timer:DeliveryTimer, content:str, in_seconds:float, **kwargs)->SendMessage:
+    message = SendMessage(Content=content, SendTime=datetime.now()+timedelta(seconds=in_seconds), **kwargs)
+    timer.add(message, caller="caller")
+    return message
+
+
+def test_upcoming_soonest_first_until_removed(timer):
+    later = scheduled(timer, "later", 20)
+    sooner = scheduled(timer, "sooner", 10)
+    scheduled(timer, "far", 3600)
+    upcoming = timer.upcoming(time.time()+30)
+    assert [(message.id, caller) for message, caller in upcoming] == [(sooner.id, "caller"), (later.id, "caller")]
+    assert timer.next_due() == pytest.approx(sooner.SendTime.timestamp())
+    assert timer.remove([str(sooner.id)]) == 1
+    assert [message.id for message, _ in timer.upcoming(time.time()+30)] == [later.id]
+    assert timer.pending() == 2
+
+
+def test_survives_reopen(tmp_path, timer):
+    message = scheduled(timer, "a", 60, IdempotencyKey="k")
+    timer.close()
+    reopened = DeliveryTimer(tmp_path/"schedule.db")
+    try:
+        assert reopened.find_duplicate("k") == str(message.id)
+        lifecycle = reopened.lifecycles([str(message.id)])[str(message.id)]
+        assert lifecycle.state == MessageStateEnum.scheduled
+    finally:
+        reopened.close()
+
+
+def test_cancel_by_message_id(timer):
+    message = scheduled(timer, "a", 60)
+    scheduled(timer, "b", 60)
+    assert [m.id for m in timer.cancel("message_id", str(message.id), time.time())] == [message.id]
+    assert timer.pending() == 1
+
+
+def test_session_name_and_at_list():
+    assert clean_session_name("﻿群　聊\xa0") == "群聊"
+    assert parse_at_list(SendMessage(Content="x", SenderWxid="张三，李四，")) == ["张三", "李四"]
+
+
+def test_cancel_by_target_and_business_spares_later_messages(timer):
+    before = scheduled(timer, "before", 60, FromWxid="ops", Business=BusinessesEnum.outage)
+    other = scheduled(timer, "other", 60, FromWxid="dev", Business=BusinessesEnum.invoice)
+    at = time.time()
+    later = scheduled(timer, "later", 60, FromWxid="ops", Business=BusinessesEnum.outage,
+                      CreatedTime=datetime.now()+timedelta(seconds=5))
+    assert [m.id for m in timer.cancel("target", "ops", at)] == [before.id]
+    assert timer.cancel("business", BusinessesEnum.outage.name, at) == []
+    assert [m.id for m in timer.cancel("business", BusinessesEnum.invoice.name, at)] == [other.id]
+    assert [message.id for message, _ in timer.upcoming(float("inf"))] == [later.id]
+
+
+def test_old_timer_gets_match_columns(tmp_path):
+    message = SendMessage(Content="a", FromWxid="ops", SendTime=datetime.now()+timedelta(minutes=1))
+    conn = sqlite3.connect(tmp_path/"old.db")
+    conn.execute(
+        "CREATE TABLE scheduled(message_id TEXT PRIMARY KEY, payload TEXT NOT NULL, caller TEXT NOT NULL DEFAULT '',"
+        " idempotency_key TEXT, send_time REAL NOT NULL, scheduled_at REAL NOT NULL)")
+    conn.execute("INSERT INTO scheduled VALUES (?,?,?,?,?,?)",
+                 (str(message.id), message.model_dump_json(), "", None, message.SendTime.timestamp(), time.time()))
+    conn.commit()
+    conn.close()
+    timer = DeliveryTimer(tmp_path/"old.db")
+    try:
+        assert [m.id for m in timer.cancel("target", "ops", time.time())] == [message.id]
+    finally:
+        timer.close()
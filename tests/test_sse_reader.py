@@ -0,0 +1,80 @@
+import time
+
+import pytest
+import requests
+
+from schemas import SendMessage
+from sse_reader import SSEReader
+
+
+class FakeResponse:
+    def __init__(self, status_code:int, events:list):
+        self.status_code = status_code
+        self.events = events
+        self.text = "error"
+        self.encoding = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def iter_lines(self, delimiter, decode_unicode):
+        for event in self.events:
+            if isinstance(event, BaseException):
+                raise event
+            yield event
+
+
+class FakeSession:
+    "answers every post with the next response, the last one over && over"
+    def __init__(self, *responses:FakeResponse):
+        self.responses = list(responses)
+        self.posts = 0
+
+    def post(self, url, json, stream):
+        self.posts += 1
+        return self.responses.pop(0) if len(self.responses) > 1 else self.responses[0]
+
+
+def event(message:SendMessage)->str:
+    return "data: " + message.model_dump_json()
+
+
+def read(session:FakeSession, **kwargs)->SSEReader:
+    return SSEReader(session, "http://oa/stream", dict(), reconnect_delay=0.01, **kwargs)
+
+
+def test_reconnects_and_skips_messages_sent_again():
+    a, b, c = (SendMessage(Content=content) for content in "abc")
+    session = FakeSession(
+        FakeResponse(200, [event(a), event(b)]),
+        FakeResponse(200, [event(b), ": keepalive", event(c), requests.ConnectionError("reset")]),
+        FakeResponse(200, [event(c), "data: [DONE]"]))
+    with read(session) as reader:
+        assert [message.Content for message in reader] == ["a", "b", "c"]
+    assert (reader.duplicates, reader.reconnects, session.posts) == (2, 2, 3)
+
+
+def test_client_error_is_raised_from_iteration():
+    with read(FakeSession(FakeResponse(403, []))) as reader:
+        with pytest.raises(requests.HTTPError):
+            list(reader)
+
+
+def test_gives_up_after_reconnects_in_a_row_without_messages():
+    session = FakeSession(FakeResponse(503, []))
+    with read(session, max_reconnects=2) as reader:
+        with pytest.raises(ConnectionError):
+            list(reader)
+    assert session.posts == 3
+
+
+def test_full_buffer_holds_the_reader_back():
+    messages = [SendMessage(Content=str(i)) for i in range(3)]
+    with read(FakeSession(FakeResponse(200, [event(m) for m in messages]+["data: [DONE]"])), buffer_size=1) as reader:
+        time.sleep(0.2)
+        assert reader.received == 2
+        assert [message.Content for message in reader] == ["0", "1", "2"]
+    assert reader.blocked_seconds > 0.1
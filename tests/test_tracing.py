@@ -0,0 +1,69 @@
+import time
+import sqlite3
+
+import pytest
+
+import tracing
+from tracing import SpanStore
+
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+    store = SpanStore(tmp_path/"trace.db", flush_interval=60)
+    monkeypatch.setattr(tracing, "span_store", store)
+    yield store
+    store.close()
+
+
+def test_spans_of_correlated_messages_form_a_timeline(store):
+    with tracing.correlate(["m1", "m2"], batch_id="b"):
+        with tracing.span("send_text"):
+            pass
+    with tracing.correlate("m1"):
+        tracing.record_span("queued", time.time()-2, 2.0)
+    with tracing.span("uncorrelated"):
+        pass
+    timeline = store.timeline(message_id="m1")
+    assert [span["name"] for span in timeline["spans"]] == ["queued", "send_text"]
+    assert timeline["batch_id"] == "b"
+    assert store.timeline(batch_id="b")["stages"]["send_text"]["count"] == 2
+    assert store.timeline(message_id="missing") is None
+
+
+def test_record_never_waits_for_a_locked_file(tmp_path, store):
+    locker = sqlite3.connect(tmp_path/"trace.db", isolation_level=None)
+    locker.execute("BEGIN EXCLUSIVE")
+    try:
+        started = time.perf_counter()
+        with tracing.correlate("m"):
+            tracing.record_span("intake", time.time(), 0.1)
+        assert time.perf_counter()-started < 0.5
+    finally:
+        locker.execute("ROLLBACK")
+        locker.close()
+    assert store.timeline(message_id="m")["stages"]["intake"]["count"] == 1
+
+
+def test_background_thread_flushes_and_buffer_is_bounded(tmp_path):
+    store = SpanStore(tmp_path/"trace.db", flush_interval=0.05, max_buffered=2)
+    try:
+        for message_id in ["a", "b", "c"]:
+            store.record("x", time.time(), 0.0, tracing.Correlation((message_id,)))
+        assert store.dropped == 1
+        time.sleep(0.3)
+        reader = sqlite3.connect(tmp_path/"trace.db")
+        assert reader.execute("SELECT COUNT(*) FROM spans").fetchone()[0] == 2
+        reader.close()
+    finally:
+        store.close()
+
+
+def test_close_writes_buffered_spans(tmp_path):
+    store = SpanStore(tmp_path/"trace.db", flush_interval=60)
+    store.record("x", time.time(), 0.0, tracing.Correlation(("a",)))
+    store.close()
+    reopened = SpanStore(tmp_path/"trace.db")
+    try:
+        assert reopened.timeline(message_id="a") is not None
+    finally:
+        reopened.close()
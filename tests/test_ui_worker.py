@@ -0,0 +1,140 @@
+import asyncio
+import sqlite3
+from datetime import datetime, timedelta
+
+import pytest
+
+import ui_worker
+from schemas import SendMessage, BulkTemplate, BulkRecipient
+from tools import ServiceRateEstimator
+from admission import AdmissionController
+from message_queues import PriorityMessageQueue
+from scheduled_delivery import DeliveryTimer
+from bulk_send import BatchStore
+
+
+@pytest.fixture
+def worker(tmp_path, monkeypatch):
+    "single mode worker with a local queue of 2 messages"
+    timer = DeliveryTimer(tmp_path/"schedule.db")
+    monkeypatch.setattr(ui_worker, "delivery_timer", timer)
+    monkeypatch.setattr(ui_worker, "durable_queue", None)
+    monkeypatch.setattr(ui_worker, "message_queue", PriorityMessageQueue(maxsize=2))
+    monkeypatch.setattr(ui_worker, "prestaged", dict())
+    yield ui_worker
+    timer.close()
+
+
+def schedule_due(timer:DeliveryTimer, count:int)->list:
+    messages = [
+        SendMessage(Content=str(i), Priority=3, SendTime=datetime.now()-timedelta(seconds=count-i))
+        for i in range(count)]
+    for message in messages:
+        timer.add(message)
+    return messages
+
+
+async def run_for(coroutine, seconds:float)->asyncio.Task:
+    task = asyncio.create_task(coroutine)
+    await asyncio.sleep(seconds)
+    assert not task.done(), task.exception()
+    return task
+
+
+def test_due_messages_wait_in_timer_while_queue_is_full(worker):
+    messages = schedule_due(worker.delivery_timer, 3)
+
+    async def scenario():
+        task = await run_for(worker.release_scheduled(max_sleep=0.02), 0.2)
+        assert worker.message_queue.qsize() == 2
+        assert worker.delivery_timer.pending() == 1
+        worker.message_queue.get_nowait()
+        await asyncio.sleep(0.2)
+        task.cancel()
+
+    asyncio.run(scenario())
+    assert worker.delivery_timer.pending() == 0
+    assert [worker.message_queue.get_nowait().id for _ in range(2)] == [messages[1].id, messages[2].id]
+
+
+def test_release_bounded_by_admission_delay(worker, monkeypatch):
+    monkeypatch.setattr(worker, "admission_controller", AdmissionController(
+        ServiceRateEstimator(initial=10.0), max_queue_delay=5, max_queue_size=100))
+    schedule_due(worker.delivery_timer, 3)
+
+    async def scenario():
+        (await run_for(worker.release_scheduled(max_sleep=0.02), 0.2)).cancel()
+
+    asyncio.run(scenario())
+    assert worker.message_queue.qsize() == 1
+    assert worker.delivery_timer.pending() == 2
+
+
+def test_queue_full_on_release_keeps_message_and_timer_alive(worker, monkeypatch):
+    async def no_limit():
+        return 10
+    monkeypatch.setattr(worker, "queue_room", no_limit)
+    messages = schedule_due(worker.delivery_timer, 3)
+
+    async def scenario():
+        (await run_for(worker.release_scheduled(max_sleep=0.02), 0.2)).cancel()
+
+    asyncio.run(scenario())
+    assert worker.message_queue.qsize() == 2
+    assert [message.id for message, _ in worker.delivery_timer.upcoming(float("inf"))] == [messages[2].id]
+
+
+def test_feed_batches_survives_a_failing_claim(worker, tmp_path, monkeypatch):
+    store = BatchStore(tmp_path/"batches.db")
+    monkeypatch.setattr(worker, "batch_store", store)
+    monkeypatch.setattr(worker, "batch_in_queue", dict())
+    batch_id = store.create(BulkTemplate(Template="{n}"))
+    store.add(batch_id, [BulkRecipient(FromWxid="a", Variables=dict(n=1))])
+    claim, calls = store.claim, []
+
+    def flaky_claim(limit):
+        calls.append(limit)
+        if len(calls)==1:
+            raise sqlite3.OperationalError("database is locked")
+        return claim(limit)
+    monkeypatch.setattr(store, "claim", flaky_claim)
+
+    async def scenario():
+        (await run_for(worker.feed_batches(poll_interval=0.02), 0.2)).cancel()
+
+    try:
+        asyncio.run(scenario())
+        assert worker.message_queue.get_nowait().Content == "1"
+        assert list(worker.batch_in_queue.values()) == [batch_id]
+    finally:
+        store.close()
+
+
+def test_failed_digest_send_records_every_merged_message(worker, monkeypatch):
+    statuses = []
+
+    class FakeDB:
+        async def create(self, status, table_class):
+            statuses.append(status)
+
+    def broken_at_list(message):
+        raise ValueError("bad at list")
+
+    message, sibling = SendMessage(Content="first", FromWxid="a"), SendMessage(Content="second", FromWxid="a")
+
+    async def take_sibling(message):
+        return [sibling], 0
+
+    monkeypatch.setattr(worker, "db_client", FakeDB())
+    monkeypatch.setattr(worker, "parse_at_list", broken_at_list)
+    monkeypatch.setattr(worker, "take_digest_siblings", take_sibling)
+
+    async def scenario():
+        worker.enqueue(message)
+        consumer = await run_for(worker.execute_send_message(), 0.2)
+        consumer.cancel()
+
+    asyncio.run(scenario())
+    assert [(status.message_id, status.content, status.success) for status in statuses] == [
+        (str(message.id), "first", False), (str(sibling.id), "second", False)]
+    assert statuses[1].failure_reason == "bad at list"
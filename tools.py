@@ -5,12 +5,17 @@ import base64
 from typing import *
 
 from dotenv import load_dotenv
+from pydantic import BaseModel
 from sqlmodel import SQLModel, select
-from sqlalchemy import URL
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy import URL, event, make_url
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, AsyncEngine
 
 from logg import logger
-from chatbots import ChatBotClientBase
+from metrics import stage_timing, SEND_RETRIES
+import tracing
+if TYPE_CHECKING:
+    #NOTE only for typing, chatbots need windows
+    from chatbots import ChatBotClientBase
 
 load_dotenv()
 WAIT_BEFORE_REFRESH = os.getenv("WAIT_BEFORE_REFRESH",3)
@@ -18,25 +23,107 @@ WAIT_BEFORE_REFRESH = float(WAIT_BEFORE_REFRESH)
 
 T = TypeVar("T")
 T_Sqlmodel = TypeVar("T", bound=SQLModel)
-T_ChatBotClient = TypeVar("T_ChatBotClient", bound=ChatBotClientBase)
+T_ChatBotClient = TypeVar("T_ChatBotClient", bound="ChatBotClientBase")
+
+
+class StorageProfile(BaseModel):
+    """
+    sqlite tuning applied to every connection `DB_Client` opens.
+    Refer to https://www.sqlite.org/pragma.html
+    """
+    journal_mode:str="WAL"
+    "WAL lets readers go on while the writer commits"
+    synchronous:str="NORMAL"
+    "NORMAL is durable enough in WAL mode, && fsyncs only at checkpoints"
+    mmap_size:int=256*1024*1024
+    "bytes of DB file memory-mapped for reads"
+    cache_size:int=-64*1024
+    "page cache per connection. Negative value means KiB"
+    busy_timeout:int=5000
+    "milliseconds to wait for a lock before `database is locked` is raised"
+    reader_pool_size:int=4
+    "connections kept for reads. Writes always go through a single dedicated connection"
+
+    def pragmas(self, read_only:bool=False)->List[str]:
+        pragmas = [
+            f"PRAGMA journal_mode={self.journal_mode}",
+            f"PRAGMA synchronous={self.synchronous}",
+            f"PRAGMA mmap_size={self.mmap_size}",
+            f"PRAGMA cache_size={self.cache_size}",
+            f"PRAGMA busy_timeout={self.busy_timeout}",
+        ]
+        if read_only:
+            pragmas.append("PRAGMA query_only=ON")
+        return pragmas
 
 
 class DB_Client:
     def __init__(
             self,
             url: Union[str, URL]="sqlite+aiosqlite:///store.db",
-            debug=True):
-        self.adb_engine = create_async_engine(url, echo=debug)
+            debug=False,
+            profile: Optional[StorageProfile]=StorageProfile()):
+        """
+        Args:
+            url(str|URL): database url.
+            debug(bool): echo every SQL statement.
+            profile(StorageProfile): sqlite tuning. Ignored if not sqlite.
+                With a profile, writes go through one dedicated connection && reads through a pool of
+                `profile.reader_pool_size` connections. If None, a single engine with default settings is used.
+        """
+        url = make_url(url)
+        self.profile = profile
+        if profile and url.get_backend_name()=="sqlite" and url.database not in (None, "", ":memory:"):
+            self.adb_engine = self._create_sqlite_engine(url, debug, pool_size=1, read_only=False)
+            self.reader_engine = self._create_sqlite_engine(url, debug, pool_size=profile.reader_pool_size, read_only=True)
+        else:
+            self.adb_engine = create_async_engine(url, echo=debug)
+            self.reader_engine = self.adb_engine
         self.migrated = False
 
 
+    def _create_sqlite_engine(self, url:URL, debug:bool, pool_size:int, read_only:bool)->AsyncEngine:
+        engine = create_async_engine(
+            url, echo=debug,
+            pool_size=pool_size, max_overflow=0,
+            pool_timeout=self.profile.busy_timeout/1000,
+            connect_args=dict(timeout=self.profile.busy_timeout/1000),
+        )
+        pragmas = self.profile.pragmas(read_only=read_only)
+
+        @event.listens_for(engine.sync_engine, "connect")
+        def set_pragmas(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            for pragma in pragmas:
+                cursor.execute(pragma)
+            cursor.close()
+
+        return engine
+
+
+    async def dispose(self):
+        "close every pooled connection"
+        await self.adb_engine.dispose()
+        if self.reader_engine is not self.adb_engine:
+            await self.reader_engine.dispose()
+
+
     async def migrate(self):
         "you need to run this function before doing any db operation"
         async with self.adb_engine.begin() as conn:
             await conn.run_sync(SQLModel.metadata.create_all)
+            await conn.run_sync(self._create_missing_indexes)
         self.migrated=True
 
 
+    @staticmethod
+    def _create_missing_indexes(conn):
+        "`create_all` skips tables already exist, so indexes added later are created here"
+        for table in SQLModel.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(conn, checkfirst=True)
+
+
     def detect_migrated(self):
         if not self.migrated:
             raise AttributeError("detect models haven't been migrated. You must execute `self.migrate` before doing any db operation")
@@ -55,11 +142,12 @@ class DB_Client:
         """
         self.detect_migrated()
         table_obj = table_class.model_validate(base_obj)
-        async with AsyncSession(self.adb_engine) as asess:
-            asess.add(table_obj)
-            await asess.commit()
-            await asess.refresh(table_obj)
-            return table_obj
+        with tracing.span("db_write"):
+            async with AsyncSession(self.adb_engine) as asess:
+                asess.add(table_obj)
+                await asess.commit()
+                await asess.refresh(table_obj)
+                return table_obj
     
     async def get(
         self, table_class: Type[T_Sqlmodel], **kwargs)-> AsyncGenerator[T_Sqlmodel, None]:
@@ -69,19 +157,57 @@ class DB_Client:
         Args:
             table_class(T_Sqlmodel): class of table model.
             kwargs(dict): dict contains conditions to retrieve.
+                A list/tuple/set value matches any of its items.
         
         Yields:
             out()
         """
         self.detect_migrated()
         statement = select(table_class)
-        async with AsyncSession(self.adb_engine) as asess:
-            for key, value in kwargs.items():
+        for key, value in kwargs.items():
+            if isinstance(value, (list, tuple, set)):
+                statement = statement.where(getattr(table_class, key).in_(value))
+            else:
                 statement = statement.where(getattr(table_class, key) == value)
 
-        result_stream = await asess.stream_scalars(statement)
-        async for result in result_stream:
-            yield result
+        #NOTE keep the session open while streaming, so the connection goes back to pool afterwards
+        async with AsyncSession(self.reader_engine) as asess:
+            result_stream = await asess.stream_scalars(statement)
+            async for result in result_stream:
+                yield result
+
+
+class ServiceRateEstimator:
+    """
+    Exponential moving average of per-message UI service time.
+    Used to estimate how long the queue takes to drain.
+    """
+    def __init__(self, initial:float=10.0, alpha:float=0.2):
+        """
+        Args:
+            initial(float): seconds per message assumed before anything is measured.
+            alpha(float): weight of the newest sample.
+        """
+        self.alpha = alpha
+        self.mean = initial
+        "estimated seconds to send one message"
+        self.samples = 0
+
+    def observe(self, seconds:float):
+        if self.samples==0:
+            self.mean = seconds
+        else:
+            self.mean = self.alpha*seconds + (1-self.alpha)*self.mean
+        self.samples += 1
+
+    @property
+    def rate(self)->float:
+        "estimated messages sent per second"
+        return 1.0/self.mean if self.mean>0 else float("inf")
+
+    def drain_seconds(self, queue_depth:int)->float:
+        "estimated seconds until `queue_depth` messages are all sent"
+        return queue_depth*self.mean
 
 
 async def async_wrapper(callable:Callable[..., T],*args,**kwargs) -> T:
@@ -97,22 +223,36 @@ def b64decode(string:str):
 
 
 def send_stable(chatbot_client: T_ChatBotClient, send_function:Callable[...,T],**kwargs):
+    """
+    send && poll the last message of session until it's confirmed sent. Resend if it fails.
+
+    Args:
+        stage_callback(Callable[[str], Any]): optional, called with "sending" before sending
+            && "confirming" before polling. Popped from kwargs.
+        kwargs: passed to `send_function`
+    """
+    stage_callback = kwargs.pop("stage_callback", None) or (lambda stage: None)
     retries=3
     while retries!=0:
+        stage_callback("sending")
         send_function(**kwargs)
-        time.sleep(WAIT_BEFORE_REFRESH) #NOTE necessary for waiting message sent out.
-        logger.debug("通过获取会话最后一条信息，检测是否发送成功（存在网络不稳定发送失败的情况）")
-        last_msg = chatbot_client.get_session_history_msgs(only_last_msg=True)[0]
-        if last_msg.read_already==None:
-            #NOTE read_already==None: still sending, wait
-            logger.info("【消息发送中】轮询等待消息发送完成")
-        while last_msg.read_already==None:
+        stage_callback("confirming")
+        with stage_timing("confirm"):
+            time.sleep(WAIT_BEFORE_REFRESH) #NOTE necessary for waiting message sent out.
+            logger.debug("通过获取会话最后一条信息，检测是否发送成功（存在网络不稳定发送失败的情况）")
             last_msg = chatbot_client.get_session_history_msgs(only_last_msg=True)[0]
-            if last_msg.send_failure:
-                #NOTE send_failure==True: network problem, needs retry
-                logger.info(f"【消息发送失败】重新发送。剩余发送次数{retries-1}")
-                retries-=1
-                break
+            if last_msg.read_already==None:
+                #NOTE read_already==None: still sending, wait
+                logger.info("【消息发送中】轮询等待消息发送完成")
+            while last_msg.read_already==None:
+                last_msg = chatbot_client.get_session_history_msgs(only_last_msg=True)[0]
+                if last_msg.send_failure:
+                    #NOTE send_failure==True: network problem, needs retry
+                    logger.info(f"【消息发送失败】重新发送。剩余发送次数{retries-1}")
+                    retries-=1
+                    if retries!=0:
+                        SEND_RETRIES.inc()
+                    break
 
         if last_msg.send_failure==False:
             logger.info("【消息发送成功】")
@@ -0,0 +1,211 @@
+import os
+import time
+import sqlite3
+import threading
+import contextvars
+from typing import *
+from pathlib import Path
+from datetime import datetime
+from contextlib import contextmanager
+
+
+class Correlation(NamedTuple):
+    message_ids:Tuple[str, ...]=()
+    "the message being processed, && messages merged into its digest"
+    batch_id:Optional[str]=None
+
+    def __str__(self):
+        if not self.message_ids and not self.batch_id:
+            return "-"
+        parts = []
+        if self.message_ids:
+            extra = len(self.message_ids)-1
+            parts.append(f"msg={self.message_ids[0]}" + (f"+{extra}" if extra else ""))
+        if self.batch_id:
+            parts.append(f"batch={self.batch_id}")
+        return " ".join(parts)
+
+
+correlation:contextvars.ContextVar[Correlation] = contextvars.ContextVar("correlation", default=Correlation())
+"""
+ids of the message being processed by the current task.
+`asyncio.to_thread` (so `async_wrapper`) copies it into the worker thread, so UI work done there is correlated too.
+"""
+
+span_store:"SpanStore" = None
+"spans are dropped if not set"
+
+
+def bind(message_ids:Union[str, Iterable[str], None]=None, batch_id:Optional[str]=None)->contextvars.Token:
+    """
+    set correlation ids for the rest of the current task (or until reset by the returned token).
+    Every asyncio task, so every request && the consumer loop, runs in its own context.
+    """
+    if message_ids is None:
+        message_ids = ()
+    elif isinstance(message_ids, str):
+        message_ids = (message_ids,)
+    return correlation.set(Correlation(tuple(message_ids), batch_id))
+
+
+@contextmanager
+def correlate(message_ids:Union[str, Iterable[str], None]=None, batch_id:Optional[str]=None):
+    "`bind` for the block only"
+    token = bind(message_ids, batch_id)
+    try:
+        yield
+    finally:
+        correlation.reset(token)
+
+
+def record_span(name:str, started_at:float, seconds:float):
+    "record a finished span of the current correlation. `started_at` is a unix timestamp"
+    current = correlation.get()
+    if span_store is None or (not current.message_ids and not current.batch_id):
+        return
+    span_store.record(name, started_at, seconds, current)
+
+
+@contextmanager
+def span(name:str):
+    "time the block as a span of the current correlation"
+    started_at = time.time()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(name, started_at, time.perf_counter()-start)
+
+
+def observe_stage(stage:str, seconds:float):
+    "`metrics.STAGE_OBSERVERS` callback, records UI stages as spans"
+    record_span(stage, time.time()-seconds, seconds)
+
+
+class SpanStore:
+    """
+    Spans of every process in one sqlite file, queried by message id || batch id as a timeline.
+
+    A span is one row per correlated message. `record` only buffers it in memory, as spans are recorded
+    on the event loop too (intake, db writes), which must never wait for the sqlite write lock.
+    A background thread writes the buffer every `flush_interval` seconds, in one transaction.
+    At most `max_buffered` spans wait, newer ones are dropped while the file is locked for long.
+
+    Thread safe. Every process opens its own instance.
+    """
+
+    def __init__(self, path:Union[str,Path], busy_timeout:float=5.0, flush_interval:float=1.0, max_buffered:int=10000):
+        self.path = Path(path)
+        self.pid = os.getpid()
+        self.max_buffered = max_buffered
+        self.dropped = 0
+        "spans dropped as the buffer was full || the write failed"
+        self._buffer:List[tuple] = []
+        self._buffer_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(
+            str(self.path), timeout=busy_timeout,
+            isolation_level=None, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS spans(
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                message_id TEXT,
+                batch_id TEXT,
+                name TEXT NOT NULL,
+                started_at REAL NOT NULL,
+                seconds REAL NOT NULL,
+                pid INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS spans_message ON spans(message_id) WHERE message_id IS NOT NULL;
+            CREATE INDEX IF NOT EXISTS spans_batch ON spans(batch_id) WHERE batch_id IS NOT NULL;
+            CREATE INDEX IF NOT EXISTS spans_started ON spans(started_at);
+        """)
+        self._closed = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_forever, args=(flush_interval,), name="span-flusher", daemon=True)
+        self._flusher.start()
+
+    def close(self):
+        "write the spans buffered && close"
+        self._closed.set()
+        self._flusher.join()
+        self.flush()
+        with self._lock:
+            self._conn.close()
+
+    def record(self, name:str, started_at:float, seconds:float, correlation:Correlation):
+        "buffer the span, it's written by the background thread. Never blocks on the file"
+        rows = [(message_id, correlation.batch_id, name, started_at, seconds, self.pid)
+                for message_id in correlation.message_ids or (None,)]
+        with self._buffer_lock:
+            if len(self._buffer)+len(rows) > self.max_buffered:
+                self.dropped += len(rows)
+                return
+            self._buffer.extend(rows)
+
+    def flush(self):
+        "write the spans buffered. Called by the background thread, && before reading"
+        with self._buffer_lock:
+            rows, self._buffer = self._buffer, []
+        if not rows:
+            return
+        with self._lock:
+            try:
+                self._conn.execute("BEGIN IMMEDIATE")
+                self._conn.executemany(
+                    "INSERT INTO spans(message_id, batch_id, name, started_at, seconds, pid) VALUES (?,?,?,?,?,?)", rows)
+                self._conn.execute("COMMIT")
+            except sqlite3.Error:
+                #NOTE tracing must never break sending, the spans are lost
+                if self._conn.in_transaction:
+                    self._conn.execute("ROLLBACK")
+                self.dropped += len(rows)
+
+    def _flush_forever(self, interval:float):
+        while not self._closed.wait(interval):
+            self.flush()
+
+    def timeline(self, message_id:Optional[str]=None, batch_id:Optional[str]=None, limit:int=1000)->Optional[dict]:
+        """
+        spans of a message || a batch in the order they started, && durations summed up by stage.
+        Returns:
+            out(dict|None): None if nothing is recorded
+        """
+        if message_id is not None:
+            condition, value = "message_id=?", message_id
+        else:
+            condition, value = "batch_id=?", batch_id
+        self.flush()
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT message_id, batch_id, name, started_at, seconds, pid FROM spans WHERE {condition}"
+                " ORDER BY started_at LIMIT ?", (value, limit)).fetchall()
+        if not rows:
+            return None
+        first = rows[0][3]
+        last = max(started_at+seconds for _, _, _, started_at, seconds, _ in rows)
+        stages:dict[str, dict] = dict()
+        for _, _, name, _, seconds, _ in rows:
+            stage = stages.setdefault(name, dict(count=0, seconds=0.0, max_seconds=0.0))
+            stage["count"] += 1
+            stage["seconds"] += seconds
+            stage["max_seconds"] = max(stage["max_seconds"], seconds)
+        return dict(
+            message_id=message_id,
+            batch_id=batch_id or next((row[1] for row in rows if row[1]), None),
+            started_time=datetime.fromtimestamp(first).isoformat(),
+            total_seconds=last-first,
+            stages=stages,
+            spans=[
+                dict(name=name, message_id=span_message_id, offset=started_at-first, seconds=seconds, pid=pid)
+                for span_message_id, _, name, started_at, seconds, pid in rows
+            ],
+        )
+
+    def purge(self, older_than:float)->int:
+        "delete spans started more than `older_than` seconds ago"
+        self.flush()
+        with self._lock:
+            return self._conn.execute(
+                "DELETE FROM spans WHERE started_at<?", (time.time()-older_than,)).rowcount
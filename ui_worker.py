@@ -0,0 +1,598 @@
+# functions conclusion:
+# the only owner of the desktop client. Consumes queued messages one by one, sends them through UI
+# && records their status.
+#
+# It runs inside http_server by default (DEPLOY_MODE=single).
+# With DEPLOY_MODE=split, http_server runs several uvicorn workers that only validate && enqueue
+# into `DurableQueue`, && this module runs as its own process: `python ui_worker.py`
+from typing import *
+import os
+import time
+import asyncio
+import traceback
+import tempfile
+import sqlite3
+import threading
+from pathlib import Path
+from shutil import rmtree
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from dotenv import load_dotenv
+
+from chatbots import CmccChatClient
+from logg import logger, WORK_DIR
+from schemas import SendMessage, HttpMessageStatus, HttpMessageStatusBase, MessageStateEnum
+from tools import async_wrapper, send_stable, DB_Client, ServiceRateEstimator
+from attachment_store import AttachmentStore
+from message_queues import PriorityMessageQueue, effective_deadline
+from message_tracker import MessageTracker
+from admission import AdmissionController
+from durable_queue import DurableQueue
+from bulk_send import BatchStore
+from digest import DigestSelector, render_digest
+from cancellation import CancellationIndex, CancelKind, tombstone_matches
+from scheduled_delivery import DeliveryTimer, PreStaged, parse_at_list, clean_session_name
+import metrics
+import tracing
+from retention import RetentionJob
+from idempotency import IdempotencyIndex
+
+load_dotenv(dotenv_path=WORK_DIR / ".env", override=True)
+WAIT_BEFORE_REFRESH=float(os.getenv("WAIT_BEFORE_REFRESH",5))
+ATTACHMENT_CACHE_MB=float(os.getenv("ATTACHMENT_CACHE_MB", 512))
+PRIORITY_SLACK_SECONDS=float(os.getenv("PRIORITY_SLACK_SECONDS", 600))
+MAX_QUEUE_SIZE=int(os.getenv("MAX_QUEUE_SIZE", 10000))
+MAX_QUEUE_DELAY=float(os.getenv("MAX_QUEUE_DELAY", 3600))
+RETENTION_DAYS=int(os.getenv("RETENTION_DAYS", 0))
+"0 disables retention: message statuses are kept in the status DB forever"
+RETENTION_INTERVAL=float(os.getenv("RETENTION_INTERVAL", 3600))
+ARCHIVE_DIR=os.getenv("ARCHIVE_DIR", str(WORK_DIR / "archive"))
+ARCHIVE_FORMAT=os.getenv("ARCHIVE_FORMAT", "jsonl")
+IDEMPOTENCY_WINDOW=float(os.getenv("IDEMPOTENCY_WINDOW", 86400))
+DURABLE_QUEUE_PATH=os.getenv("DURABLE_QUEUE_PATH", str(WORK_DIR / "queue.db"))
+UI_WORKER_PREFETCH=int(os.getenv("UI_WORKER_PREFETCH", 2))
+UI_WORKER_METRICS_PORT=int(os.getenv("UI_WORKER_METRICS_PORT", 11452))
+SCHEDULE_PATH=os.getenv("SCHEDULE_PATH", str(WORK_DIR / "schedule.db"))
+PRESTAGE_SECONDS=float(os.getenv("PRESTAGE_SECONDS", 60))
+PRESTAGE_LIMIT=int(os.getenv("PRESTAGE_LIMIT", 500))
+BATCH_PATH=os.getenv("BATCH_PATH", str(WORK_DIR / "batches.db"))
+BULK_PREFETCH=int(os.getenv("BULK_PREFETCH", 2))
+DIGEST_WINDOW=float(os.getenv("DIGEST_WINDOW", 0))
+DIGEST_MAX_MESSAGES=int(os.getenv("DIGEST_MAX_MESSAGES", 10))
+DIGEST_MAX_CHARS=int(os.getenv("DIGEST_MAX_CHARS", 2000))
+TRACE_PATH=os.getenv("TRACE_PATH", "")
+"tracing is off unless set"
+TRACE_RETENTION_HOURS=float(os.getenv("TRACE_RETENTION_HOURS", 72))
+WORKER_STATS_NAME="ui_worker"
+"name the UI worker publishes its stats under in `DurableQueue`"
+
+chatbot_client: CmccChatClient = None
+db_client: DB_Client = None
+durable_queue: DurableQueue = None
+"only set when running as its own process"
+message_queue = PriorityMessageQueue(maxsize=MAX_QUEUE_SIZE, slack_per_level=PRIORITY_SLACK_SECONDS) # earliest-deadline-first
+service_estimator = ServiceRateEstimator(initial=WAIT_BEFORE_REFRESH*4)
+message_tracker = MessageTracker(message_queue, service_estimator)
+admission_controller = AdmissionController(service_estimator, max_queue_delay=MAX_QUEUE_DELAY, max_queue_size=MAX_QUEUE_SIZE)
+"bounds scheduled releases && bulk expansion by the queue size && delay http_server admits messages by"
+idempotency_index = IdempotencyIndex(window=IDEMPOTENCY_WINDOW)
+message_semaphore = asyncio.Semaphore(1) # UI操作是不可抢占的
+attachment_store: AttachmentStore = None
+delivery_timer: DeliveryTimer = None
+prestaged:dict[str, PreStaged] = dict()
+"scheduled messages due within `PRESTAGE_SECONDS`, by message id"
+batch_store: BatchStore = None
+cancellation_index = CancellationIndex()
+batch_in_queue:dict[str, str] = dict()
+"batch ids of bulk messages expanded into `message_queue` && not taken yet, by message id"
+temp_dir: str = None
+dequeue_hooks:List[Callable[[SendMessage], Any]] = []
+"called with every message the consumer takes from `message_queue`"
+
+
+def record_queued(message:SendMessage):
+    "record time the message waited in queue as a span, since it was created || became due"
+    now = time.time()
+    since = message.CreatedTime.timestamp() if message.CreatedTime else now
+    if message.SendTime:
+        since = max(since, message.SendTime.timestamp())
+    tracing.record_span("queued", since, max(now-since, 0.0))
+
+
+async def finish_cancelled(message:SendMessage, reason:str):
+    "record a message dropped by cancellation as failed"
+    message_id = str(message.id)
+    cancellation_index.skipped += 1
+    logger.info(f"[message cancelled] {message_id} {reason}")
+    message_tracker.transition(message_id, MessageStateEnum.failed, reason)
+    await db_client.create(HttpMessageStatusBase(
+        message_id=message_id, send_to=message.FromWxid, content=message.Content,
+        success=False, failure_reason=reason), HttpMessageStatus)
+
+
+def cancel(kind:CancelKind, value:str, at:Optional[float]=None):
+    """
+    tombstone messages in local queue, && release pre-staged work of the matched scheduled messages.
+    Stores shared by processes (timer, batch store, durable queue) are cancelled by the API directly.
+    """
+    at = time.time() if at is None else at
+    cancellation_index.cancel(kind, value, at)
+    for message_id, staged in list(prestaged.items()):
+        if tombstone_matches(kind, value, at, staged.message):
+            prestaged.pop(message_id, None)
+            if staged.filepath:
+                attachment_store.release(staged.filepath)
+
+
+async def take_digest_siblings(message:SendMessage)->Tuple[List[SendMessage], int]:
+    """
+    take queued messages to merge into one digest with `message`, if digest mode is on.
+    Siblings that turn out duplicated by idempotency key are finished as failed here.
+    Returns:
+        out(tuple[list[SendMessage], int]): siblings to send along with `message`,
+            && number of messages taken from `message_queue`, which need `task_done`
+    """
+    if DIGEST_WINDOW <= 0:
+        return [], 0
+    selector = DigestSelector(message, DIGEST_WINDOW, DIGEST_MAX_MESSAGES, DIGEST_MAX_CHARS)
+    if selector.key is None:
+        return [], 0
+    taken = message_queue.take(selector.accepts, DIGEST_MAX_MESSAGES-1)
+    from_local = len(taken)
+    if durable_queue is not None and not selector.full:
+        taken += await async_wrapper(
+            durable_queue.claim_matching, selector.accepts, message.FromWxid, DIGEST_MAX_MESSAGES-1-len(taken))
+
+    siblings = []
+    for sibling in taken:
+        sibling_id = str(sibling.id)
+        with tracing.correlate(sibling_id, batch_in_queue.get(sibling_id)):
+            record_queued(sibling)
+        for hook in dequeue_hooks:
+            hook(sibling)
+        metrics.DEQUEUED.inc()
+        prestaged.pop(sibling_id, None)
+        cancelled = cancellation_index.is_cancelled(sibling)
+        if cancelled:
+            await finish_cancelled(sibling, cancelled)
+            continue
+        message_tracker.transition(sibling_id, MessageStateEnum.preparing)
+        original_id = sibling.IdempotencyKey and idempotency_index.claim_send(sibling.IdempotencyKey, sibling_id)
+        if original_id:
+            logger.warning(f"[duplicate skipped] {sibling_id} duplicates {original_id}")
+            message_tracker.transition(sibling_id, MessageStateEnum.failed, f"duplicate of {original_id}")
+            await db_client.create(HttpMessageStatusBase(
+                message_id=sibling_id, send_to=sibling.FromWxid, content=sibling.Content,
+                success=False, failure_reason=f"duplicate of {original_id}"), HttpMessageStatus)
+            continue
+        siblings.append(sibling)
+    if siblings:
+        logger.info(f"[digest] {message.id} merges {len(siblings)} messages to {message.FromWxid}")
+    return siblings, from_local
+
+
+async def execute_send_message():
+    "consumer function"
+    global db_client
+    while True:
+        message:SendMessage = await message_queue.get()
+        message_id = str(message.id)
+        batch_id = batch_in_queue.get(message_id)
+        tracing.bind(message_id, batch_id) #NOTE the consumer runs in its own task, so this only lasts till the next message
+        record_queued(message)
+        for hook in dequeue_hooks:
+            hook(message)
+        metrics.DEQUEUED.inc()
+        service_start = time.perf_counter()
+        staged = prestaged.pop(message_id, None)
+        failure_reasons = []
+        send_to = message.FromWxid
+        log_content = message.Content
+        cancelled = cancellation_index.is_cancelled(message)
+        if cancelled:
+            #NOTE tombstoned, drop it without any UI work
+            await finish_cancelled(message, cancelled)
+            if staged and staged.filepath:
+                attachment_store.release(staged.filepath)
+            message_queue.task_done()
+            continue
+        message_tracker.transition(message_id, MessageStateEnum.preparing)
+        if message.IdempotencyKey:
+            #NOTE check again before UI send. The key may have expired && been admitted again while the original waited in queue
+            original_id = idempotency_index.claim_send(message.IdempotencyKey, message_id)
+            if original_id:
+                logger.warning(f"[duplicate skipped] {message_id} duplicates {original_id}")
+                message_tracker.transition(message_id, MessageStateEnum.failed, f"duplicate of {original_id}")
+                await db_client.create(HttpMessageStatusBase(
+                    message_id=message_id, send_to=send_to, content=log_content,
+                    success=False, failure_reason=f"duplicate of {original_id}"), HttpMessageStatus)
+                if staged and staged.filepath:
+                    attachment_store.release(staged.filepath)
+                message_queue.task_done()
+                continue
+        siblings, siblings_from_queue = await take_digest_siblings(message)
+        group_ids = [message_id]+[str(sibling.id) for sibling in siblings]
+        tracing.bind(group_ids, batch_id)
+        stage_callback = lambda stage: [message_tracker.transition(i, stage) for i in group_ids]
+        async with message_semaphore:
+            #NOTE send text message if exists
+            if message.Content:
+                at_prefix = "" #NOTE sibling statuses below use it, even if the send fails before it's set
+                try:
+                    at_list = staged.at_list if staged else parse_at_list(message)
+                    at_prefix = "".join(["@"+at+" " for at in at_list])
+                    if at_list:
+                        log_content = at_prefix+log_content
+                        logger.debug(f"at_list: {at_list} ; content: {message.Content}")
+                    with tracing.span("send_text"):
+                        await async_wrapper(
+                            send_stable,
+                            chatbot_client,
+                            chatbot_client.send_message,
+                            session_name=staged.session_name if staged else message.FromWxid,
+                            message=render_digest([message]+siblings),
+                            from_clipboard=True,
+                            at_list=at_list,
+                            stage_callback=stage_callback
+                        )
+                except Exception as exc:
+                    logger.error(traceback.format_exc())
+                    failure_reasons.append(str(exc))
+                    metrics.SEND_FAILURES.inc(error=type(exc).__name__)
+                    message_status = HttpMessageStatusBase(
+                        message_id=message_id,
+                        send_to=send_to,
+                        content=log_content,
+                        success=False, failure_reason=str(exc))
+                else:
+                    message_status = HttpMessageStatusBase(
+                        message_id=message_id,
+                        send_to=send_to,
+                        content=log_content,
+                        success=True)
+
+                try: #NOTE needs to catch error here, else asyncio task ignores it and keeps go on.
+                    with metrics.DB_WRITE_SECONDS.time():
+                        result = await db_client.create(message_status, HttpMessageStatus)
+                        #NOTE every message merged into the digest gets its own status
+                        for sibling in siblings:
+                            await db_client.create(message_status.model_copy(update=dict(
+                                message_id=str(sibling.id), content=at_prefix+sibling.Content)), HttpMessageStatus)
+                    logger.info(f"[text message sent] {message_id}")
+                except Exception as e:
+                    raise Exception(e) from e
+            #NOTE send file if exists
+            if message.File:
+                temp_filepath = None
+                log_content = "[file] filename: %s" % message.Filename
+                try:
+                    #NOTE identical contents are stored once && reused by every send
+                    if staged and staged.filepath:
+                        temp_filepath = staged.filepath
+                    else:
+                        with tracing.span("attachment"):
+                            temp_filepath = await async_wrapper(
+                                attachment_store.acquire_b64, message.File, message.Filename)
+                    log_content = "[file] filename: %s" % temp_filepath.name
+                    with tracing.span("send_file"):
+                        await async_wrapper(
+                            send_stable,
+                            chatbot_client,
+                            chatbot_client.send_file,
+                            session_name=staged.session_name if staged else message.FromWxid,
+                            filepath=temp_filepath,
+                            stage_callback=message_tracker.stage_callback(message_id)
+                        )
+                except Exception as exc:
+                    logger.error(traceback.format_exc())
+                    failure_reasons.append(str(exc))
+                    metrics.SEND_FAILURES.inc(error=type(exc).__name__)
+                    message_status = HttpMessageStatusBase(
+                        message_id=message_id,
+                        send_to=send_to,
+                        content=log_content,
+                        success=False, failure_reason=str(exc))
+                else:
+                    message_status = HttpMessageStatusBase(
+                        message_id=message_id,
+                        send_to=send_to,
+                        content=log_content,
+                        success=True)
+                finally:
+                    if temp_filepath:
+                        attachment_store.release(temp_filepath)
+                try: #NOTE needs to catch error here, else asyncio task ignores it and keeps go on.
+                    with metrics.DB_WRITE_SECONDS.time():
+                        result = await db_client.create(message_status, HttpMessageStatus)
+                    logger.info(f"[file message sent] {message_id}")
+                except Exception as e:
+                    raise Exception(e) from e
+
+            service_estimator.observe(time.perf_counter()-service_start)
+            for sent_message in [message]+siblings:
+                sent_id = str(sent_message.id)
+                if failure_reasons:
+                    message_tracker.transition(sent_id, MessageStateEnum.failed, "; ".join(failure_reasons))
+                else:
+                    message_tracker.transition(sent_id, MessageStateEnum.sent)
+                if message_queue.check_deadline(sent_message):
+                    logger.warning(f"[deadline missed] {sent_id} deadline: {sent_message.Deadline}")
+            #XXX mark task done
+            for _ in range(1+siblings_from_queue):
+                message_queue.task_done()
+            logger.info(f"[message left] {message_queue.qsize()}")
+
+
+def prestage(message:SendMessage)->PreStaged:
+    "decode the attachment && resolve the session of a scheduled message ahead of its `SendTime`"
+    filepath = None
+    if message.File:
+        filepath = attachment_store.acquire_b64(message.File, message.Filename)
+    return PreStaged(
+        message_id=str(message.id),
+        message=message.model_copy(update=dict(File=None)),
+        session_name=clean_session_name(message.FromWxid),
+        at_list=parse_at_list(message),
+        filepath=filepath)
+
+
+async def queue_room()->int:
+    "messages scheduled releases && bulk expansion may put into the queue now, as admission would accept"
+    if durable_queue is None:
+        depth = message_queue.qsize()
+    else:
+        #NOTE claimed messages are counted by the durable queue still, bulk recipients expanded here aren't in it
+        depth = await async_wrapper(durable_queue.depth) + len(batch_in_queue)
+    room = admission_controller.room(depth)
+    if message_queue.maxsize > 0:
+        room = min(room, message_queue.maxsize-message_queue.qsize())
+    return room
+
+
+async def release(message:SendMessage, caller:str="")->bool:
+    """
+    put a due scheduled message into the outbound queue.
+    Called on the event loop: `message_queue` isn't thread safe, only the sqlite put runs in a thread.
+    Returns:
+        out(bool): False if the local queue is full, the message stays in timer
+    """
+    if durable_queue is None:
+        try:
+            enqueue(message)
+        except asyncio.QueueFull:
+            return False
+        return True
+    try:
+        await async_wrapper(
+            durable_queue.put, message, deadline=effective_deadline(message, PRIORITY_SLACK_SECONDS), caller=caller)
+    except sqlite3.IntegrityError:
+        #NOTE released already, the worker stopped before removing it from timer
+        pass
+    return True
+
+
+async def release_scheduled(max_sleep:float=1.0):
+    """
+    release scheduled messages into the outbound queue when due.
+    Messages due within `PRESTAGE_SECONDS` are pre-staged first,
+    so a burst sharing the same minute only waits for UI work.
+    """
+    while True:
+        now = time.time()
+        upcoming = await async_wrapper(delivery_timer.upcoming, now+PRESTAGE_SECONDS, PRESTAGE_LIMIT)
+        due = []
+        for message, caller in upcoming:
+            message_id = str(message.id)
+            if message_id not in prestaged:
+                try:
+                    prestaged[message_id] = await async_wrapper(prestage, message)
+                except Exception:
+                    #NOTE decode it again when sending, where the error is recorded as the message's failure
+                    logger.error(f"[prestage failed] {message_id} {traceback.format_exc()}")
+            if message.SendTime.timestamp() <= now:
+                due.append((message, caller))
+
+        if due:
+            #NOTE accepted already, so never rejected: what the queue has no room for waits in timer till next tick
+            room = await queue_room()
+            released = []
+            for message, caller in due[:room]:
+                if not await release(message, caller):
+                    break
+                released.append(message)
+            if released:
+                await async_wrapper(delivery_timer.remove, [str(message.id) for message in released])
+                logger.info(f"[scheduled released] {len(released)} messages")
+            if len(released) < len(due):
+                #NOTE overdue now, so `next_due` wouldn't wait
+                logger.debug(f"[scheduled deferred] {len(due)-len(released)} due messages wait for room in queue")
+                await asyncio.sleep(max_sleep)
+            continue
+
+        next_due = await async_wrapper(delivery_timer.next_due)
+        sleep = max_sleep if next_due is None else min(max(next_due-time.time(), 0.0), max_sleep)
+        await asyncio.sleep(sleep)
+
+
+def enqueue(message:SendMessage):
+    "put the message into local queue. Used by http_server in DEPLOY_MODE=single"
+    message_queue.put_nowait(message)
+    message_tracker.transition(str(message.id), MessageStateEnum.queued)
+
+
+def stats()->dict:
+    "stats published to `DurableQueue` for API workers"
+    return dict(
+        service_seconds=service_estimator.mean,
+        samples=service_estimator.samples,
+        local_queue=message_queue.stats(),
+        attachments=attachment_store.stats() if attachment_store else dict(),
+        idempotency=idempotency_index.stats(),
+        scheduled=delivery_timer.pending() if delivery_timer else 0,
+        bulk_pending=batch_store.pending() if batch_store else 0,
+        cancellation=cancellation_index.stats(),
+        prestaged=len(prestaged),
+    )
+
+
+async def feed_from_durable_queue(poll_interval:float=0.2, stats_interval:float=2.0):
+    """
+    claim messages from `durable_queue` into local queue, keeping at most `UI_WORKER_PREFETCH` there,
+    so ordering is mostly decided by the durable queue, where late urgent messages still overtake.
+    Also applies cancellations recorded by API workers, && publishes stats every `stats_interval` seconds.
+    """
+    last_published = 0.0
+    last_cancellation = 0
+    while True:
+        for seq, kind, value, cancelled_at in await async_wrapper(durable_queue.cancellations_since, last_cancellation):
+            cancel(kind, value, cancelled_at)
+            last_cancellation = seq
+        room = UI_WORKER_PREFETCH - message_queue.qsize()
+        messages = await async_wrapper(durable_queue.claim, room)
+        for message in messages:
+            message_queue.put_nowait(message)
+        if time.time()-last_published > stats_interval:
+            await async_wrapper(durable_queue.set_stats, WORKER_STATS_NAME, stats())
+            await async_wrapper(durable_queue.purge_finished)
+            last_published = time.time()
+        if not messages:
+            await asyncio.sleep(poll_interval)
+
+
+async def feed_batches(poll_interval:float=0.5):
+    """
+    expand bulk recipients into local queue lazily, keeping at most `BULK_PREFETCH` there,
+    so bulk sends interleave with other messages by priority && deadline instead of flooding the queue.
+    Nothing is expanded while the queue has no room by admission, see `queue_room`.
+    """
+    while True:
+        try:
+            room = min(BULK_PREFETCH - len(batch_in_queue), await queue_room())
+            messages = await async_wrapper(batch_store.claim, room)
+            for batch_id, message in messages:
+                batch_in_queue[str(message.id)] = batch_id
+                enqueue(message)
+        except Exception:
+            #NOTE the task is the only one expanding bulk sends, it must outlive a bad claim
+            logger.error(f"[bulk expansion failed] retry in {poll_interval}s {traceback.format_exc()}")
+            messages = []
+        if not messages:
+            await asyncio.sleep(poll_interval)
+
+
+def serve_metrics(port:int)->ThreadingHTTPServer:
+    "serve `/metrics` of this process in a daemon thread. UI stage timings only exist here in DEPLOY_MODE=split"
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = metrics.REGISTRY.render().encode("utf8")
+            self.send_response(200)
+            self.send_header("Content-Type", metrics.CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+async def purge_spans(interval:float=3600.0):
+    "delete spans older than `TRACE_RETENTION_HOURS` every `interval` seconds"
+    while True:
+        purged = await async_wrapper(tracing.span_store.purge, TRACE_RETENTION_HOURS*3600)
+        if purged:
+            logger.info(f"[tracing] purged {purged} spans")
+        await asyncio.sleep(interval)
+
+
+async def start(client:DB_Client)->List[asyncio.Task]:
+    """
+    create the desktop client && start the consumer, along with scheduled delivery, bulk sends && the retention job.
+    Returns:
+        out(list[asyncio.Task]): background tasks, cancel them by `stop`
+    """
+    global chatbot_client, db_client, attachment_store, temp_dir, delivery_timer, batch_store
+    db_client = client
+    chatbot_client = CmccChatClient(cache_session_map=False, wait_before_refresh=WAIT_BEFORE_REFRESH)
+    temp_dir = tempfile.mkdtemp(prefix="desktop-chatbot")
+    attachment_store = AttachmentStore(Path(temp_dir) / "attachments", max_bytes=int(ATTACHMENT_CACHE_MB*1024*1024))
+    delivery_timer = DeliveryTimer(SCHEDULE_PATH)
+    batch_store = BatchStore(BATCH_PATH)
+    requeued, failed = batch_store.recover()
+    logger.info(f"[ui worker] recovered bulk sends: {requeued} requeued, {failed} marked failed")
+    message_tracker.listeners.append(batch_store.publish)
+    dequeue_hooks.append(lambda message: batch_in_queue.pop(str(message.id), None))
+    if TRACE_PATH:
+        #NOTE http_server may have opened it already in DEPLOY_MODE=single
+        tracing.span_store = tracing.span_store or tracing.SpanStore(TRACE_PATH)
+        if tracing.observe_stage not in metrics.STAGE_OBSERVERS:
+            metrics.STAGE_OBSERVERS.append(tracing.observe_stage)
+
+    metrics.QUEUE_DEPTH.set_function(message_queue.qsize)
+    metrics.MISSED_DEADLINES.set_function(
+        lambda : {(business,): count for business, count in message_queue.missed_deadlines.items()})
+    metrics.ATTACHMENT_STORE.set_function(
+        lambda : {(counter,): value for counter, value in attachment_store.stats().items()})
+
+    tasks = []
+    #XXX You cannot create 4 consumers, though number of processes is limited to 1 by semaphore.
+    # cuz every consumer get message from only one message_queue, but only you task can send message.
+    for i in range(1):
+        tasks.append(asyncio.create_task(execute_send_message()))
+    tasks.append(asyncio.create_task(release_scheduled()))
+    tasks.append(asyncio.create_task(feed_batches()))
+    if tracing.span_store:
+        tasks.append(asyncio.create_task(purge_spans()))
+    if RETENTION_DAYS > 0:
+        retention_job = RetentionJob(
+            db_client, archive_dir=ARCHIVE_DIR,
+            retain_days=RETENTION_DAYS, file_format=ARCHIVE_FORMAT)
+        tasks.append(asyncio.create_task(retention_job.run_forever(RETENTION_INTERVAL)))
+    return tasks
+
+
+async def stop(tasks:List[asyncio.Task]):
+    for t in tasks:
+        t.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    if delivery_timer:
+        delivery_timer.close()
+    if batch_store:
+        batch_store.close()
+    if tracing.span_store:
+        await async_wrapper(tracing.span_store.close) #NOTE writes the spans buffered
+        tracing.span_store = None
+    if temp_dir:
+        rmtree(temp_dir, ignore_errors=True) #NOTE remove all files in temp dir
+
+
+async def main():
+    "run as the UI worker process of DEPLOY_MODE=split"
+    global durable_queue
+    durable_queue = DurableQueue(DURABLE_QUEUE_PATH)
+    requeued, failed = durable_queue.recover()
+    logger.info(f"[ui worker] recovered queue: {requeued} requeued, {failed} marked failed")
+    message_tracker.listeners.append(durable_queue.publish)
+
+    client = DB_Client()
+    await client.migrate()
+    tasks = await start(client)
+    tasks.append(asyncio.create_task(feed_from_durable_queue()))
+    metrics_server = serve_metrics(UI_WORKER_METRICS_PORT) if UI_WORKER_METRICS_PORT else None
+    logger.info(f"[ui worker] consuming {DURABLE_QUEUE_PATH}")
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        await stop(tasks)
+        if metrics_server:
+            metrics_server.shutdown()
+        await client.dispose()
+        durable_queue.close()
+        await logger.complete()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())